@@ -0,0 +1,556 @@
+# Benchmarks for the scraping and reporting pipeline
+# Run with: python benchmarks.py table-parser [saved_page.html ...]
+#           python benchmarks.py http-fetch [tickers]
+#           python benchmarks.py normalize [years ...]
+#           python benchmarks.py merge [tickers] [--years N]
+#           python benchmarks.py sheet-update [sheet_rows ...]
+#           python benchmarks.py excel-export [sheet_rows ...]
+#           python benchmarks.py page-load [tickers]
+#           python benchmarks.py scheduler [pages]
+#           python benchmarks.py pipeline [tickers ...] [--rows sheet_rows]
+#           python benchmarks.py import-time
+import contextlib
+import io
+import os
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from urllib.parse import urlsplit
+
+from bs4 import BeautifulSoup
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+
+from color_printer import printb,printg,printr
+from table_parser import read_table
+from normalize import normalize_table, format_for_display
+from excel_export import export_ticker_workbook
+from fetchers import HttpFetcher
+from page_policy import AdaptiveTimeouts
+from replay import PageServer, ReplayEnvironment, SimulatedClock, page_file_name, save_page
+from scheduler import RequestScheduler, ScheduledFetcher, PRIORITY_DAILY, PRIORITY_BACKFILL
+from dropbox_sync import sync_workbooks
+from report import ReportRenderer
+from merge_engine import merge_data, add_rolling_ratios, ROLLING_WINDOWS
+
+import main
+
+############## PAGE FIXTURES ###################################################
+
+def make_fintel_page(rows=250, scripts=400):
+    '''Builds a synthetic Fintel ticker page with the three short volume tables buried in a script heavy document'''
+    rng = random.Random(0)
+    parts = ["<html><head>"]
+    parts += [f"<script>window.__data{i} = {{'k': '{'x' * 200}'}};</script>" for i in range(scripts)]
+    parts.append("</head><body><div class='container'>")
+
+    def table(table_id, headers, date_columns):
+        html = [f'<table id="{table_id}" class="table"><thead><tr>']
+        html += [f"<th>{header}</th>" for header in headers]
+        html.append("</tr></thead><tbody>")
+        for i in range(rows):
+            html.append("<tr>")
+            for j, header in enumerate(headers):
+                if j < date_columns:
+                    html.append(f"<td> {2024 - i // 250}-{1 + i % 12:02d}-{1 + i % 28:02d} </td>")
+                elif header == "":
+                    html.append("<td><a href='#'>+</a></td>")
+                else:
+                    html.append(f"<td> {rng.randint(1000, 9999999):,} </td>")
+            html.append("</tr>")
+        html.append("</tbody></table>")
+        return "".join(html)
+
+    parts.append(table("short-sale-volume-finra-table", ["Market Date", "Short Volume", "", "Total Volume"], 1))
+    parts.append(table("short-sale-volume-combined-table", ["Market Date", "FINRA Short Volume", "BXShort Volume", "AggregateShort Volume*"], 1))
+    parts.append(table("short-interest-nasdaq-table", ["Settlement Date", "Publication Date", "Short Interest"], 2))
+    parts.append("</div></body></html>")
+    return "".join(parts)
+
+def make_yahoo_page(rows=250, scripts=400):
+    '''Builds a synthetic Yahoo history page'''
+    rng = random.Random(0)
+    parts = ["<html><head>"]
+    parts += [f"<script>window.__data{i} = {{'k': '{'x' * 200}'}};</script>" for i in range(scripts)]
+    parts.append("</head><body><table><thead><tr>")
+    parts += [f"<th><span>{header}</span></th>" for header in ["Date", "Open", "High", "Low", "Close*", "Adj Close**", "Volume"]]
+    parts.append("</tr></thead><tbody>")
+    for i in range(rows):
+        parts.append(f"<tr><td>Jan {1 + i % 28:02d}, {2024 - i // 250}</td>")
+        parts += [f"<td>{rng.uniform(10, 20):.2f}</td>" for _ in range(5)]
+        parts.append(f"<td>{rng.randint(1000, 9999999):,}</td></tr>")
+    parts.append("</tbody></table></body></html>")
+    return "".join(parts)
+
+############## LEGACY IMPLEMENTATIONS ##########################################
+
+def bs4_read_fintel_table(page_source, table_name):
+    '''Table extraction as the original Fintel scraper did it with Beautiful Soup'''
+    soup = BeautifulSoup(page_source, 'html.parser')
+    table = soup.find('table', {'id': table_name})
+    headers = [th.text for th in table.find('tr').find_all('th')]
+    data_rows = []
+    for row in table.find_all('tr')[1:]:
+        data_rows.append([td.text.strip() for td in row.find_all('td') if td.text.strip() not in ["+","/","="]])
+    return headers, data_rows
+
+def bs4_read_yahoo_table(page_source):
+    '''Table extraction as scrape_yahoo_data did it with Beautiful Soup'''
+    soup = BeautifulSoup(page_source, 'html.parser')
+    table = soup.find('table')
+    headers = [th.text for th in table.find('tr').find_all('th')]
+    data_rows = [[td.text.strip() for td in row.find_all('td')] for row in table.find_all('tr')[1:11]]
+    return headers, data_rows
+
+def legacy_clean_tables(combined_data, yahoo_data):
+    '''Cleaning and formatting as main and scrape_yahoo_data did it with per cell lambdas'''
+    combined_data = combined_data.copy()
+    yahoo_data = yahoo_data.copy()
+    combined_data['Market Date'] = pd.to_datetime(combined_data['Market Date'], errors='coerce').dt.strftime('%Y-%m-%d')
+    yahoo_data['Market Date'] = pd.to_datetime(yahoo_data['Market Date'], format="%b %d, %Y").dt.strftime('%Y-%m-%d')
+    yahoo_data.iloc[:,1:] = yahoo_data.iloc[:,1:].map(lambda x: pd.to_numeric(x, errors='ignore'))
+    yahoo_data.loc[:,'Close Price'] = yahoo_data.loc[:,'Close Price'].apply(lambda x: f"${x}")
+
+    merged_df = pd.merge(combined_data, yahoo_data)
+    merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].replace('', np.nan).fillna(merged_df['Short Volume'])
+    merged_df = merged_df[["Market Date","Close Price","Aggregate Short Volume","Volume"]]
+    merged_df['Aggregate Short Volume'] = pd.to_numeric(merged_df['Aggregate Short Volume'].str.replace(',',''))
+    merged_df['Volume'] = pd.to_numeric(merged_df['Volume'].str.replace(',',''))
+    merged_df['ASV/V'] = merged_df['Aggregate Short Volume'] / merged_df['Volume']
+    merged_df = merged_df.fillna('')
+    merged_df['ASV/V'] = merged_df['ASV/V'].apply(lambda x: f"{x:.2%}" if x != '' else x)
+    merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].apply(lambda x: f"{x:,.0f}" if x != '' else x)
+    merged_df['Volume'] = merged_df['Volume'].apply(lambda x: f"{x:,.0f}" if x != '' else x)
+
+    # The Excel stage converted the Fintel volumes once more
+    combined_data.iloc[:,1:] = combined_data.iloc[:,1:].map(lambda a: pd.to_numeric(a.replace(",","")) if a else a)
+    return merged_df
+
+def typed_clean_tables(combined_data, yahoo_data):
+    '''Cleaning and formatting through the typed normalization stage'''
+    combined_data = normalize_table(combined_data)
+    yahoo_data = normalize_table(yahoo_data, date_format="%b %d, %Y")
+
+    merged_df = pd.merge(combined_data, yahoo_data)
+    merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].fillna(merged_df['Short Volume'])
+    merged_df = merged_df[["Market Date","Close Price","Aggregate Short Volume","Volume"]]
+    merged_df['ASV/V'] = merged_df['Aggregate Short Volume'] / merged_df['Volume']
+    return format_for_display(merged_df)
+
+def legacy_merge_tables(data, tickers):
+    '''Merge as main did it, one ticker at a time on every shared column, with the rolling ratios added per ticker'''
+    merged = {}
+    for ticker in tickers:
+        merged_df = pd.merge(data[ticker]['combined_data'], data[ticker]['yahoo_data'])
+        merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].fillna(merged_df['Short Volume'])
+        merged_df = merged_df[["Market Date","Close Price","Aggregate Short Volume","Volume"]]
+        merged_df['ASV/V'] = merged_df['Aggregate Short Volume'] / merged_df['Volume']
+        merged_df = merged_df.sort_values("Market Date")
+        for window in ROLLING_WINDOWS:
+            merged_df[f"ASV/V {window}d"] = merged_df['ASV/V'].astype("float64").rolling(window, min_periods=window).mean()
+        merged[ticker] = merged_df
+    return merged
+
+def legacy_update_sheet(data, sheet):
+    '''Sheet update as create_excel_sheet did it, one insert_rows call per new row'''
+    current_dates = [str(date) for date in [cell.value for cell in sheet['A']][2:]]
+    for _, row in data[::-1].iterrows():
+        if row['Market Date'] not in current_dates:
+            sheet.insert_rows(3)
+            main.write_df_row_to_sheet(row, 3, sheet)
+
+def make_sheet_workbook(rows):
+    '''Builds a workbook with a finra-table sheet holding rows days of history'''
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "finra-table"
+    sheet['A1'] = "Ticker = ABC"
+    sheet.append(["Market Date", "Short Volume", "Total Volume"])
+    for date in pd.bdate_range(end="2024-06-28", periods=rows)[::-1].strftime("%Y-%m-%d"):
+        sheet.append([date, 1000, 2000])
+    return workbook
+
+def make_history(years):
+    '''Builds raw scraped Fintel combined and Yahoo tables with years of daily rows'''
+    rng = random.Random(0)
+    dates = pd.bdate_range(end="2024-06-28", periods=252 * years)[::-1]
+    combined_data = pd.DataFrame({
+        "Market Date": dates.strftime("%Y-%m-%d"),
+        "Short Volume": [f"{rng.randint(1000, 9999999):,}" for _ in dates],
+        "BX Short Volume": [f"{rng.randint(1000, 99999):,}" for _ in dates],
+        "Aggregate Short Volume": [f"{rng.randint(1000, 9999999):,}" if rng.random() > 0.1 else "" for _ in dates],
+    })
+    yahoo_data = pd.DataFrame({
+        "Market Date": dates.strftime("%b %d, %Y"),
+        "Close Price": [f"{rng.uniform(10, 20):.2f}" for _ in dates],
+        "Volume": [f"{rng.randint(1000, 9999999):,}" for _ in dates],
+    })
+    return combined_data, yahoo_data
+
+############## BENCHMARKS ######################################################
+
+def report(name, baseline, candidate):
+    printg(f"{name}: bs4 {baseline * 1000:.1f} ms, table_parser {candidate * 1000:.1f} ms ({baseline / candidate:.1f}x)")
+
+def time_call(fn, repeat=5):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+def peak_memory(fn):
+    '''Peak Python memory allocated while running fn, in MB'''
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+def measure(fn):
+    '''Runs fn once and returns (result, wall seconds, CPU seconds of this process, peak Python memory in MB)'''
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        result = fn()
+        return result, time.perf_counter() - wall, time.process_time() - cpu, tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+def bench_table_parser(paths):
+    '''Compares the streaming table parser against the Beautiful Soup extraction on saved or synthetic pages'''
+    fintel_tables = list(main.FINTEL_TABLES.values())
+    pages = [(path, open(path, encoding='utf-8').read()) for path in paths]
+    if not pages:
+        pages = [("synthetic fintel page", make_fintel_page()), ("synthetic yahoo page", make_yahoo_page())]
+
+    for name, page_source in pages:
+        printb(f"Benchmarking {name} ({len(page_source) / 1024:.0f} KB)...")
+        table_ids = [table_id for table_id in fintel_tables if table_id in page_source]
+
+        if table_ids:
+            for table_id in table_ids:
+                if bs4_read_fintel_table(page_source, table_id) != read_table(page_source, table_id, skip_cells=main.FINTEL_SKIP_CELLS):
+                    printr(f"[!] {table_id} output differs from bs4")
+            # The old code built one soup per table, the new code streams each table from the same snapshot
+            baseline = time_call(lambda: [bs4_read_fintel_table(page_source, table_id) for table_id in table_ids])
+            candidate = time_call(lambda: [read_table(page_source, table_id, skip_cells=main.FINTEL_SKIP_CELLS) for table_id in table_ids])
+        else:
+            if bs4_read_yahoo_table(page_source) != read_table(page_source, max_rows=10):
+                printr("[!] Yahoo table output differs from bs4")
+            baseline = time_call(lambda: bs4_read_yahoo_table(page_source))
+            candidate = time_call(lambda: read_table(page_source, max_rows=10))
+
+        report(name, baseline, candidate)
+
+def bench_http_fetch(args):
+    '''Scrapes synthetic Fintel and Yahoo pages for a number of tickers through the HTTP fetcher and a local PageServer'''
+    tickers = [f"t{i}" for i in range(int(args[0]) if args else 50)]
+
+    with tempfile.TemporaryDirectory() as pages_dir:
+        fintel_page, yahoo_page = make_fintel_page(), make_yahoo_page()
+        for ticker in tickers:
+            with open(os.path.join(pages_dir, page_file_name(f"/ss/us/{ticker}")), "w", encoding="utf-8") as f:
+                f.write(fintel_page)
+            with open(os.path.join(pages_dir, page_file_name(f"/quote/{ticker}/history")), "w", encoding="utf-8") as f:
+                f.write(yahoo_page)
+
+        with PageServer(pages_dir) as server:
+            main.FINTEL_BASE_URL = main.YAHOO_BASE_URL = server.base_url
+            fetcher = HttpFetcher()
+            data = {ticker: {} for ticker in tickers}
+
+            def scrape():
+                for ticker in tickers:
+                    main.scrape_fintel_ticker(fetcher, ticker, data)
+                    main.scrape_yahoo_ticker(fetcher, ticker, data)
+
+            elapsed = time_call(scrape, repeat=1)
+            fetcher.quit()
+
+    printg(f"http fetch: {len(tickers)} tickers in {elapsed:.2f} s ({elapsed / len(tickers) * 1000:.1f} ms per ticker)")
+
+def bench_normalize(args):
+    '''Compares the per cell lambda cleaning against the typed normalization stage over multi-year histories'''
+    for years in [int(arg) for arg in args] or [1, 5, 20]:
+        combined_data, yahoo_data = make_history(years)
+        baseline = time_call(lambda: legacy_clean_tables(combined_data, yahoo_data), repeat=3)
+        candidate = time_call(lambda: typed_clean_tables(combined_data, yahoo_data), repeat=3)
+        printg(f"normalize {years} year(s), {len(combined_data)} rows: lambdas {baseline * 1000:.1f} ms, "
+               f"typed {candidate * 1000:.1f} ms ({baseline / candidate:.1f}x)")
+
+def bench_merge(args):
+    '''Compares the per ticker merge against the batched merge engine over --years of history for each number of tickers'''
+    years = 5
+    if "--years" in args:
+        index = args.index("--years")
+        years = int(args[index + 1])
+        args = args[:index] + args[index + 2:]
+    combined_data, yahoo_data = make_history(years)
+    combined_data = normalize_table(combined_data)
+    yahoo_data = normalize_table(yahoo_data, date_format="%b %d, %Y")
+
+    for count in [int(arg) for arg in args] or [10, 100, 500]:
+        tickers = [f"t{i}" for i in range(count)]
+        data = {ticker: {"combined_data": combined_data, "yahoo_data": yahoo_data} for ticker in tickers}
+        baseline = time_call(lambda: legacy_merge_tables(data, tickers), repeat=1)
+        candidate = time_call(lambda: add_rolling_ratios(merge_data(data, tickers)), repeat=1)
+        printg(f"merge {count} tickers, {years} year(s) each: per ticker {baseline * 1000:.1f} ms, "
+               f"batched {candidate * 1000:.1f} ms ({baseline / candidate:.1f}x)")
+
+def bench_sheet_update(args):
+    '''Compares per row insert_rows against the bulk merge-and-rewrite sheet update for 20 new rows'''
+    new_data = pd.DataFrame({
+        "Market Date": pd.bdate_range(start="2024-07-01", periods=20)[::-1].strftime("%Y-%m-%d"),
+        "Short Volume": 1000,
+        "Total Volume": 2000,
+    })
+    for rows in [int(arg) for arg in args] or [1000, 10000, 100000]:
+        baseline = time_call(lambda: legacy_update_sheet(new_data, make_sheet_workbook(rows).active), repeat=1)
+        setup = time_call(lambda: make_sheet_workbook(rows), repeat=1)
+        candidate = time_call(lambda: main.create_excel_sheet(new_data, "finra-table", "abc", make_sheet_workbook(rows)), repeat=1)
+        baseline, candidate = baseline - setup, max(candidate - setup, 1e-6)
+        printg(f"sheet update {rows} rows: insert_rows {baseline * 1000:.1f} ms, bulk rewrite {candidate * 1000:.1f} ms ({baseline / candidate:.1f}x)")
+
+def bench_excel_export(args):
+    '''Compares the in-memory load/update/format/save path against the streaming write-only export'''
+    new_data = pd.DataFrame({
+        "Market Date": pd.bdate_range(start="2024-07-01", periods=20)[::-1].strftime("%Y-%m-%d"),
+        "Short Volume": 1000,
+        "Total Volume": 2000,
+    })
+    for rows in [int(arg) for arg in args] or [1000, 10000, 100000]:
+        current_binary = main.convert_excel_to_binary(make_sheet_workbook(rows))
+
+        def in_memory():
+            workbook = load_workbook(io.BytesIO(current_binary))
+            workbook = main.create_excel_sheet(new_data, "finra-table", "abc", workbook)
+            return main.convert_excel_to_binary(main.format_workbook(workbook))
+
+        def streaming():
+            return export_ticker_workbook("abc", {"finra-table": new_data}, current_binary)
+
+        baseline, candidate = time_call(in_memory, repeat=1), time_call(streaming, repeat=1)
+        baseline_mb, candidate_mb = peak_memory(in_memory), peak_memory(streaming)
+        printg(f"excel export {rows} rows: in-memory {baseline:.2f} s / {baseline_mb:.0f} MB, "
+               f"streaming {candidate:.2f} s / {candidate_mb:.0f} MB ({baseline / candidate:.1f}x time, {baseline_mb / candidate_mb:.1f}x memory)")
+
+def bench_page_load(args):
+    '''Scrapes tickers from a local PageServer where pages take 20-80 ms and one ticker's page hangs, once with the fixed
+    10 s timeout where the first error ends the run and once with adaptive timeouts and retries at the back of the queue'''
+    tickers = [f"t{i}" for i in range(int(args[0]) if args else 20)]
+    stuck = tickers[len(tickers) // 4]
+    rng = random.Random(0)
+
+    def delay(path):
+        return 60 if f"/{stuck}" in path else rng.uniform(0.02, 0.08)
+
+    def run(timeouts, retries, failures):
+        jobs = queue.Queue()
+        for ticker in tickers:
+            jobs.put((ticker, 0))
+        data = {ticker: {} for ticker in tickers}
+        create_fetcher = lambda: HttpFetcher(timeout=10, timeouts=timeouts)
+        try:
+            main.run_driver_worker(create_fetcher, main.scrape_fintel_ticker, jobs, data, retries=retries, failures=failures)
+        except Exception as e:
+            printr(f"run stopped by {type(e).__name__}")
+        return sum(1 for ticker in tickers if data[ticker])
+
+    with tempfile.TemporaryDirectory() as pages_dir:
+        fintel_page = make_fintel_page(rows=50, scripts=10)
+        for ticker in tickers:
+            with open(os.path.join(pages_dir, page_file_name(f"/ss/us/{ticker}")), "w", encoding="utf-8") as f:
+                f.write(fintel_page)
+
+        with PageServer(pages_dir, delay=delay) as server:
+            main.FINTEL_BASE_URL = server.base_url
+            baseline = time_call(lambda: print_done("fixed", run(None, 0, None)), repeat=1)
+            candidate = time_call(lambda: print_done("adaptive", run(AdaptiveTimeouts(minimum=0.5), 1, {})), repeat=1)
+
+    printg(f"page load {len(tickers)} tickers, one hanging: fixed timeout {baseline:.2f} s, adaptive {candidate:.2f} s")
+
+def bench_scheduler(args):
+    '''Drives the request scheduler against a local PageServer: the rate one session gets out of a 0.5/s token bucket and
+    what a site throttling every request for 60 s sees with and without backoff and the circuit breaker (both on a
+    SimulatedClock), and how soon daily pages get through behind four backfill sessions with and without priorities'''
+    pages = int(args[0]) if args else 40
+    with tempfile.TemporaryDirectory() as pages_dir:
+        page = make_fintel_page(rows=10, scripts=0)
+        for i in range(pages):
+            save_page(pages_dir, f"/ss/us/t{i}", page)
+        clock = SimulatedClock()
+        throttle_until = [0.0]
+
+        def status(path):
+            return 429 if clock.now() < throttle_until[0] else None
+
+        with PageServer(pages_dir, status=status) as server:
+            domain = urlsplit(server.base_url).netloc
+            urls = [f"{server.base_url}/ss/us/t{i}" for i in range(pages)]
+
+            fetcher = ScheduledFetcher(HttpFetcher(), RequestScheduler(limits={domain: (0.5, 2)}, clock=clock))
+            for url in urls:
+                fetcher.fetch(url)
+            printg(f"rate: {pages} pages in {clock.now():.0f} simulated s, {pages / clock.now():.2f}/s "
+                   f"against a limit of 0.5/s with a burst of 2")
+
+            def throttled_run(name, scheduler, backoff):
+                clock.time = 0.0
+                throttle_until[0] = 60.0
+                server.requests.clear()
+                fetcher = ScheduledFetcher(HttpFetcher(), scheduler, backoff=backoff, rng=random.Random(0))
+                loaded = 0
+                for url in urls:
+                    try:
+                        fetcher.fetch(url)
+                        loaded += 1
+                    except Exception:
+                        pass
+                throttle_until[0] = 0.0
+                return f"throttled {name}: {len(server.requests)} requests sent, {loaded} of {pages} pages loaded in {clock.now():.0f} simulated s"
+
+            # The retry messages of every failed request would drown the results
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = [
+                    throttled_run("without backoff or breaker", RequestScheduler(limits={domain: (1, 1)}, failure_threshold=10 ** 9, clock=clock), 0),
+                    throttled_run("with backoff and breaker", RequestScheduler(limits={domain: (1, 1)}, clock=clock), 1),
+                ]
+            for result in results:
+                printg(result)
+
+            def priority_run(name, daily_priority):
+                scheduler = RequestScheduler(limits={domain: (20, 1)})
+                daily_done = []
+
+                def session(session_urls, priority):
+                    fetcher = ScheduledFetcher(HttpFetcher(), scheduler, priority)
+                    for url in session_urls:
+                        fetcher.fetch(url)
+
+                backfill = [threading.Thread(target=session, args=(urls[5:][i::4] * 3, PRIORITY_BACKFILL)) for i in range(4)]
+                for thread in backfill:
+                    thread.start()
+                time.sleep(0.3)
+                daily_done.append(time_call(lambda: session(urls[:5], daily_priority), repeat=1))
+                for thread in backfill:
+                    thread.join()
+                printg(f"priority {name}: 5 daily pages behind 4 backfill sessions took {daily_done[0]:.2f} s at 20 pages/s")
+
+            priority_run("first come first served", PRIORITY_BACKFILL)
+            priority_run("daily first", PRIORITY_DAILY)
+
+def print_done(name, done):
+    printb(f"{name}: {done} ticker(s) scraped")
+
+def bench_pipeline(args):
+    '''Runs every stage of the scrape-to-report pipeline against the replay stand-ins (PageServer, FakeDropbox holding
+    workbooks with --rows rows of history, SMTPSink) for each number of tickers and reports wall time, CPU and peak memory
+    per stage, then the whole of main. Time spent in the transform processes of main is not in its CPU or memory.'''
+    rows = 1000
+    if "--rows" in args:
+        index = args.index("--rows")
+        rows = int(args[index + 1])
+        args = args[:index] + args[index + 2:]
+    current_binary = main.convert_excel_to_binary(make_sheet_workbook(rows))
+    fintel_page, yahoo_page = make_fintel_page(), make_yahoo_page()
+
+    for count in [int(arg) for arg in args] or [2, 50, 500]:
+        tickers = [f"t{i}" for i in range(count)]
+        stock_names = {ticker: ticker.upper() for ticker in tickers}
+        dropbox_files = {main.dropbox_workbook_path(ticker): current_binary for ticker in tickers}
+        results = []
+
+        with tempfile.TemporaryDirectory() as pages_dir, tempfile.TemporaryDirectory() as state_dir:
+            for ticker in tickers:
+                save_page(pages_dir, f"/ss/us/{ticker}", fintel_page)
+                save_page(pages_dir, f"/quote/{ticker}/history", yahoo_page)
+
+            with ReplayEnvironment(pages_dir, os.path.join(state_dir, "stages"), dropbox_files) as env:
+                def stage(name, fn):
+                    result, wall, cpu, peak = measure(fn)
+                    results.append((name, wall, cpu, peak))
+                    return result
+
+                data = stage("scrape", lambda: main.scrape_all_data(tickers, fintel_sessions=4, yahoo_sessions=4, backend="http"))
+
+                def store_tables():
+                    with main.HistoryStore() as store:
+                        for ticker in tickers:
+                            for table, table_data in data[ticker].items():
+                                store.append(ticker, table, table_data)
+                stage("store", store_tables)
+
+                def merge():
+                    for ticker in tickers:
+                        data[ticker]["merged_data"] = main.merge_ticker_tables(data[ticker])
+                stage("merge", merge)
+
+                def render():
+                    renderer = ReportRenderer(data, stock_names)
+                    return [renderer.body(tickers)] + [renderer.body([ticker]) for ticker in tickers]
+                bodies = stage("report", render)
+
+                jobs = {ticker: (main.dropbox_workbook_path(ticker), {
+                    "finra-table": main.to_sheet_values(data[ticker]["finra_data"]),
+                    "combined-table": main.to_sheet_values(data[ticker]["combined_data"]),
+                }) for ticker in tickers}
+                stage("excel", lambda: [export_ticker_workbook(ticker, new_sheets, current_binary) for ticker, (_, new_sheets) in jobs.items()])
+                stage("dropbox", lambda: sync_workbooks(env.dropbox, main.create_sync_cache(), jobs, export_ticker_workbook, processes=0))
+
+                messages = [main.create_email([""], "benchmark", body) for body in bodies]
+                stage("email", lambda: main.create_mailer().send_all(messages))
+
+            with ReplayEnvironment(pages_dir, os.path.join(state_dir, "main"), dropbox_files):
+                stage("main", lambda: main.main(tickers, stock_names))
+
+        printg(f"pipeline {count} tickers, {rows} row sheets:")
+        for name, wall, cpu, peak in results:
+            printg(f"  {name:<8} {wall:8.2f} s wall {cpu:8.2f} s cpu {peak:8.1f} MB peak")
+
+# What each cli.py command imports before it starts working, and the eager import graph main.py used to have
+IMPORT_SETS = {
+    "eager main.py": "import main, excel_export, dropbox_sync, replay, session_store, table_parser, page_policy, requests, lxml.etree, openpyxl, dropbox, selenium.webdriver, selenium_stealth",
+    "cli.py --help": "import cli, config",
+    "email": "import cli, config, main",
+    "excel": "import cli, config, main, excel_export",
+    "sync": "import cli, config, main, excel_export, dropbox_sync",
+    "scrape (selenium)": "import cli, config, main, selenium.webdriver, selenium_stealth",
+}
+
+HEAVY_MODULES = ["pandas", "numpy", "requests", "lxml", "cryptography", "openpyxl", "dropbox", "selenium"]
+
+def bench_import_time(args):
+    '''Startup cost of each cli.py command: the time a fresh interpreter takes to import what the command needs,
+    best of 5, on top of the bare interpreter start'''
+    def startup(code):
+        return time_call(lambda: subprocess.run([sys.executable, "-c", code], check=True), repeat=5)
+
+    bare = startup("pass")
+    for name, code in IMPORT_SETS.items():
+        loaded = subprocess.run([sys.executable, "-c", f"{code}; import sys; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"],
+                                check=True, capture_output=True, text=True).stdout.split()
+        printg(f"import {name:<18} {(startup(code) - bare) * 1000:7.0f} ms  loads: {', '.join(loaded) or 'none of ' + ', '.join(HEAVY_MODULES)}")
+
+BENCHMARKS = {
+    "table-parser": bench_table_parser,
+    "http-fetch": bench_http_fetch,
+    "normalize": bench_normalize,
+    "merge": bench_merge,
+    "sheet-update": bench_sheet_update,
+    "excel-export": bench_excel_export,
+    "page-load": bench_page_load,
+    "scheduler": bench_scheduler,
+    "pipeline": bench_pipeline,
+    "import-time": bench_import_time,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python benchmarks.py [{'|'.join(BENCHMARKS)}] [args ...]")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,74 @@
+# Stage outputs of an unfinished run kept on disk, so a restarted run picks up where the last one stopped
+import os
+import pickle
+import shutil
+import threading
+import time
+
+from local_state import STATE_DIR, load_json_state, save_json_state
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+CHECKPOINT_DIR = os.path.join(STATE_DIR, "checkpoint")
+
+# An unfinished run older than this is dropped instead of resumed, its pages are stale by the next trading day
+CHECKPOINT_TTL = 12 * 60 * 60
+
+class RunCheckpoint:
+    '''Keeps the output of every finished stage of the current run in checkpoint_dir: one pickle per (ticker, stage),
+    or per stage for the stages of the whole run (ticker None), and a state.json listing the finished ones.
+    Opening a checkpoint left by a run that died less than ttl seconds ago resumes it, anything older is cleared.'''
+
+    def __init__(self, checkpoint_dir=CHECKPOINT_DIR, ttl=CHECKPOINT_TTL):
+        self.checkpoint_dir = checkpoint_dir
+        self.state_path = os.path.join(checkpoint_dir, "state.json")
+        self.lock = threading.Lock()
+
+        self.state = load_json_state(self.state_path)
+        if self.state is not None and time.time() - self.state["created"] > ttl:
+            printb("Dropping the checkpoint of an unfinished run, it is too old to resume")
+            self.clear()
+        if self.state is None:
+            self.state = {"created": time.time(), "stages": {}}
+        elif self.state["stages"]:
+            printb(f"Resuming the unfinished run from {time.ctime(self.state['created'])}")
+
+    def _key(self, ticker, stage):
+        return stage if ticker is None else f"{stage}:{ticker}"
+
+    def done(self, ticker, stage):
+        '''Checks if the stage has finished for the ticker (or for the run if ticker is None)'''
+        return self._key(ticker, stage) in self.state["stages"]
+
+    def save(self, ticker, stage, value):
+        '''Stores the output of a finished stage and marks it done'''
+        key = self._key(ticker, stage)
+        with self.lock:
+            file_name = key.replace(":", "-") + ".pkl"
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            tmp_path = os.path.join(self.checkpoint_dir, file_name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, os.path.join(self.checkpoint_dir, file_name))
+            self.state["stages"][key] = file_name
+            save_json_state(self.state_path, self.state)
+
+    def load(self, ticker, stage):
+        '''Returns the stored output of a finished stage'''
+        with open(os.path.join(self.checkpoint_dir, self.state["stages"][self._key(ticker, stage)]), "rb") as f:
+            return pickle.load(f)
+
+    def discard(self, ticker, stage):
+        '''Forgets a finished stage so it runs again'''
+        with self.lock:
+            file_name = self.state["stages"].pop(self._key(ticker, stage), None)
+            if file_name is None:
+                return
+            save_json_state(self.state_path, self.state)
+            os.remove(os.path.join(self.checkpoint_dir, file_name))
+
+    def clear(self):
+        '''Removes the checkpoint once the run is complete'''
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        self.state = None
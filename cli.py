@@ -0,0 +1,123 @@
+# Command line entry point. Each command imports only what it needs, so jobs that work from the stored data start
+# without loading Selenium, openpyxl or the Dropbox SDK
+# Run with: python cli.py [--config config.json] [--no-page-cache] run
+#           python cli.py scrape [TICKER ...]
+#           python cli.py email [TICKER ...]
+#           python cli.py excel [--out DIR] [TICKER ...]
+#           python cli.py sync [TICKER ...]
+#           python cli.py backfill START END [TICKER ...]
+#           python cli.py metrics [--since DATE] [--out FILE] [TICKER ...]
+import argparse
+import sys
+
+def cmd_run(config, args):
+    '''The daily job: scrape, store, email and sync'''
+    import main
+    main.main(config=config)
+
+def cmd_scrape(config, args):
+    '''Scrapes the new rows and adds them to the history store without emailing or syncing them.
+    The watermarks stay where they are, so the next run still emails and syncs these rows'''
+    import main
+
+    with main.HistoryStore() as store:
+        main.scrape_and_store(tickers(config, args), store, main.load_watermarks(), config["backend"], config["record_pages_dir"],
+                              config["fintel_sessions"], config["yahoo_sessions"], config["bypass_page_cache"])
+    main.report_metrics()
+
+def cmd_email(config, args):
+    '''Sends the report emails again from the stored data'''
+    import main
+
+    stock_tickers = tickers(config, args)
+    with main.HistoryStore() as store:
+        data = main.load_report_data(store, stock_tickers)
+    messages = main.build_messages(data, stock_tickers, config["stock_names"], config["recipients"], config["ticker_recipients"])
+    failed = main.create_mailer().send_all(messages)
+    main.report_metrics()
+    return 1 if failed else 0
+
+def cmd_excel(config, args):
+    '''Writes the workbooks from the stored data to a local folder'''
+    import main
+
+    with main.HistoryStore() as store:
+        main.export_local_workbooks(store, tickers(config, args), args.out or config["excel_dir"])
+    main.report_metrics()
+
+def cmd_sync(config, args):
+    '''Brings the Dropbox workbooks up to date with the stored data'''
+    import main
+
+    with main.HistoryStore() as store:
+        results = main.sync_dropbox_workbooks(store, tickers(config, args), config["dropbox_folder"])
+    main.report_metrics()
+    return 1 if any(result["error"] is not None for result in results.values()) else 0
+
+def cmd_backfill(config, args):
+    '''Fills the history store with the full history of a period'''
+    import main
+    main.backfill(tickers(config, args), args.start, args.end, sessions=args.sessions,
+                  backend=config["backend"] or "http", requests_per_second=args.rate)
+
+def cmd_metrics(config, args):
+    '''Writes the rolling ASV/V averages and days to cover of the stored history to a CSV file'''
+    import main
+
+    with main.HistoryStore() as store:
+        merged = main.history_metrics(store, tickers(config, args), since=args.since)
+    merged.to_csv(args.out)
+    main.printg(f"[+] Wrote {len(merged)} row(s) to {args.out}")
+
+def tickers(config, args):
+    '''The tickers given on the command line, or the configured ones'''
+    return args.tickers or config["tickers"]
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Short interest scraper and report jobs")
+    parser.add_argument("--config", help="JSON config file (default: ~/.short_interest/config.json)")
+    parser.add_argument("--no-page-cache", action="store_true", help="fetch every page again instead of using the pages cached today")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("run", help=cmd_run.__doc__)
+    for name, handler in [("scrape", cmd_scrape), ("email", cmd_email), ("excel", cmd_excel), ("sync", cmd_sync)]:
+        command = commands.add_parser(name, help=handler.__doc__.split("\n")[0])
+        command.add_argument("tickers", nargs="*", help="tickers to work on (default: the configured ones)")
+        if name == "excel":
+            command.add_argument("--out", help="folder to write the workbooks to (default: excel_dir of the config)")
+
+    backfill = commands.add_parser("backfill", help=cmd_backfill.__doc__)
+    backfill.add_argument("start", help="first date, YYYY-MM-DD")
+    backfill.add_argument("end", help="last date, YYYY-MM-DD")
+    backfill.add_argument("tickers", nargs="*", help="tickers to backfill (default: the configured ones)")
+    backfill.add_argument("--sessions", type=int, default=4, help="sessions per source")
+    backfill.add_argument("--rate", type=float, help="page loads per second per site, at most the scheduler's limits (default: those limits)")
+
+    metrics = commands.add_parser("metrics", help=cmd_metrics.__doc__)
+    metrics.add_argument("tickers", nargs="*", help="tickers to include (default: the configured ones)")
+    metrics.add_argument("--since", help="first date, YYYY-MM-DD (default: all of the stored history)")
+    metrics.add_argument("--out", default="short_interest_metrics.csv", help="CSV file to write")
+    return parser
+
+COMMANDS = {
+    "run": cmd_run,
+    "scrape": cmd_scrape,
+    "email": cmd_email,
+    "excel": cmd_excel,
+    "sync": cmd_sync,
+    "backfill": cmd_backfill,
+    "metrics": cmd_metrics,
+}
+
+def run(argv=None):
+    '''Parses the command line and runs the command, "run" if none is given. Exits with the command's status'''
+    from config import load_config
+
+    args = build_parser().parse_args(argv)
+    config = load_config(args.config)
+    if args.no_page_cache:
+        config["bypass_page_cache"] = True
+    sys.exit(COMMANDS[args.command or "run"](config, args) or 0)
+
+if __name__ == "__main__":
+    run()
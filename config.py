@@ -0,0 +1,45 @@
+# Run configuration: tickers, names, recipients and paths, read from a JSON file
+import json
+import os
+
+from local_state import STATE_DIR
+
+CONFIG_PATH = os.path.join(STATE_DIR, "config.json")
+
+# Used for every key the config file leaves out. None means the default of main.py
+DEFAULT_CONFIG = {
+    # Stocks to scrape data from and the names used for them in the emails
+    "tickers": [""],
+    "stock_names": {"": ""},
+    # Recipients of the email covering every ticker, and of the email of each single ticker
+    "recipients": [""],
+    "ticker_recipients": {"": [""]},
+    # Dropbox folder holding one workbook per ticker
+    "dropbox_folder": None,
+    # Local folder the excel command writes the workbooks to
+    "excel_dir": ".",
+    # "selenium" or "http", see main.scrape_all_data
+    "backend": None,
+    "fintel_sessions": 1,
+    "yahoo_sessions": 1,
+    # Directory to save every scraped page in, see replay.RecordingFetcher
+    "record_pages_dir": None,
+    # Fetch every page again instead of using the pages cached for the trading day, see page_cache.py
+    "bypass_page_cache": False,
+}
+
+def load_config(path=None):
+    '''Returns the configuration in the JSON file at path (CONFIG_PATH if None) on top of DEFAULT_CONFIG.
+    A missing file at the default path gives the defaults, a missing file at an explicit path is an error.'''
+    config = dict(DEFAULT_CONFIG)
+    if path is None and not os.path.exists(CONFIG_PATH):
+        return config
+
+    with open(path or CONFIG_PATH, encoding="utf-8") as f:
+        values = json.load(f)
+
+    unknown = set(values) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown config keys: {', '.join(sorted(unknown))}")
+    config.update(values)
+    return config
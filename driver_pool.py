@@ -0,0 +1,223 @@
+# Lifecycle of the browser sessions: warm drivers handed out from a pool, recycled after too many pages or too much
+# memory, and no chromedriver or Chrome process left behind when the run ends or crashes
+import atexit
+import os
+import threading
+
+from local_state import STATE_DIR, load_json_state, save_json_state
+from metrics import count
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+# Processes started by the drivers of every running pool, keyed by the pid of the run that owns them.
+# A run that finds processes of a run that is gone kills them.
+DRIVER_PIDS_PATH = os.path.join(STATE_DIR, "driver_pids.json")
+
+# A driver is replaced after this many page loads, or once chromedriver, Chrome and its renderers use more memory than this
+MAX_PAGES_PER_DRIVER = 200
+MAX_DRIVER_RSS_MB = 1500
+
+def driver_processes(driver):
+    '''The chromedriver process of a driver and every process under it (Chrome, its renderers and helpers)'''
+    import psutil
+
+    process = getattr(getattr(driver, "service", None), "process", None)
+    if process is None:
+        return []
+    try:
+        root = psutil.Process(process.pid)
+        return [root] + root.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+def processes_rss_mb(processes):
+    '''Resident memory of the processes in MB'''
+    import psutil
+
+    total = 0
+    for process in processes:
+        try:
+            total += process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return total / 2 ** 20
+
+def kill_processes(processes):
+    '''Kills the processes that are still running. Returns how many were'''
+    import psutil
+
+    killed = []
+    for process in processes:
+        try:
+            process.kill()
+            killed.append(process)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    psutil.wait_procs(killed, timeout=5)
+    return len(killed)
+
+class ProcessRegistry:
+    '''Keeps DRIVER_PIDS_PATH up to date with the (pid, start time) of every process the drivers of this run started'''
+
+    def __init__(self, path=DRIVER_PIDS_PATH):
+        self.path = path
+        self.owner = str(os.getpid())
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def track(self, key, processes):
+        '''Records the processes of one driver under key, replacing what was recorded for it before'''
+        import psutil
+
+        entries = []
+        for process in processes:
+            try:
+                entries.append([process.pid, process.create_time()])
+            except psutil.NoSuchProcess:
+                pass
+        with self.lock:
+            if self.processes.get(key) == entries:
+                return
+            self.processes[key] = entries
+            self._save()
+
+    def forget(self, key):
+        with self.lock:
+            if self.processes.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        owners = load_json_state(self.path, {})
+        owners[self.owner] = [entry for entries in self.processes.values() for entry in entries]
+        if not owners[self.owner]:
+            del owners[self.owner]
+        save_json_state(self.path, owners)
+
+    def kill_orphans(self):
+        '''Kills the recorded processes of runs that are no longer running. Returns how many were killed'''
+        import psutil
+
+        with self.lock:
+            owners = load_json_state(self.path, {})
+            orphans = []
+            for owner, entries in list(owners.items()):
+                if owner == self.owner or psutil.pid_exists(int(owner)):
+                    continue
+                for pid, create_time in entries:
+                    # A matching start time makes sure the pid was not reused by an unrelated process since
+                    try:
+                        process = psutil.Process(pid)
+                        if abs(process.create_time() - create_time) < 1:
+                            orphans.append(process)
+                    except psutil.NoSuchProcess:
+                        pass
+                del owners[owner]
+            save_json_state(self.path, owners)
+
+        killed = kill_processes(orphans)
+        if killed:
+            printr(f"[!] Killed {killed} browser process(es) left behind by an earlier run")
+        return killed
+
+# Shared by every pool of the run
+DRIVER_PROCESSES = ProcessRegistry()
+
+class DriverPool:
+    '''Hands out WebDrivers made by create_driver, reusing idle warm ones before starting new ones.
+    After each page load the driver in use is checked and replaced by a fresh one once it has loaded max_pages pages
+    or its processes use more than max_rss_mb MB. close() quits every driver and kills whatever processes they
+    leave behind, and runs at exit if the run dies before calling it. Safe to share between threads.'''
+
+    def __init__(self, create_driver, name="chrome", max_pages=MAX_PAGES_PER_DRIVER, max_rss_mb=MAX_DRIVER_RSS_MB,
+                 registry=DRIVER_PROCESSES):
+        self.create_driver = create_driver
+        self.name = name
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.idle = []
+        self.drivers = {}  # id(driver) -> {"driver", "pages"}
+        self.counts = {"created": 0, "reused": 0, "recycled_pages": 0, "recycled_memory": 0, "broken": 0,
+                       "orphans_killed": registry.kill_orphans(), "peak_rss_mb": 0.0}
+        atexit.register(self.close)
+
+    def acquire(self):
+        '''Returns a warm idle driver, or a new one if none is idle'''
+        with self.lock:
+            if self.idle:
+                self.counts["reused"] += 1
+                return self.idle.pop()
+
+        driver = self.create_driver()
+        with self.lock:
+            self.drivers[id(driver)] = {"driver": driver, "pages": 0}
+            self.counts["created"] += 1
+        self.registry.track(id(driver), driver_processes(driver))
+        return driver
+
+    def page_loaded(self, driver):
+        '''Counts a page load of driver. Returns the driver to use from now on: the same one, or a fresh one if it
+        reached max_pages or max_rss_mb'''
+        processes = driver_processes(driver)
+        rss_mb = processes_rss_mb(processes)
+        self.registry.track(id(driver), processes)
+        with self.lock:
+            entry = self.drivers[id(driver)]
+            entry["pages"] += 1
+            self.counts["peak_rss_mb"] = max(self.counts["peak_rss_mb"], rss_mb)
+            pages = entry["pages"]
+
+        if pages >= self.max_pages:
+            return self.replace(driver, "recycled_pages", f"after {pages} pages")
+        if rss_mb > self.max_rss_mb:
+            return self.replace(driver, "recycled_memory", f"at {rss_mb:.0f} MB")
+        return driver
+
+    def replace(self, driver, reason="broken", detail=""):
+        '''Shuts a driver down and returns a new one in its place'''
+        printb(f"Replacing a {self.name} driver ({detail or reason})")
+        with self.lock:
+            self.counts[reason] += 1
+        count("driver_recycles", pool=self.name, reason=reason)
+        self._shut_down(driver)
+        return self.acquire()
+
+    def release(self, driver):
+        '''Gives a driver back to the pool to be handed out again'''
+        with self.lock:
+            if id(driver) in self.drivers:
+                self.idle.append(driver)
+
+    def _shut_down(self, driver):
+        processes = driver_processes(driver)
+        with self.lock:
+            self.drivers.pop(id(driver), None)
+            if driver in self.idle:
+                self.idle.remove(driver)
+        try:
+            driver.quit()
+        except Exception as e:
+            printr(f"[!] Quitting a {self.name} driver failed: {type(e).__name__}: {e}")
+        kill_processes(processes)
+        self.registry.forget(id(driver))
+
+    def close(self):
+        '''Quits every driver of the pool, in use or idle, and kills their leftover processes'''
+        atexit.unregister(self.close)
+        with self.lock:
+            drivers = [entry["driver"] for entry in self.drivers.values()]
+        for driver in drivers:
+            self._shut_down(driver)
+        if self.counts["created"]:
+            stats = self.stats()
+            printb(f"{self.name} drivers: {stats['created']} started, {stats['reused']} reused, "
+                   f"{stats['recycled_pages'] + stats['recycled_memory']} recycled, {stats['broken']} broken, "
+                   f"peak {stats['peak_rss_mb']:.0f} MB")
+
+    def stats(self):
+        '''Counts of the pool: drivers created, reused warm, recycled for pages or memory and replaced after errors,
+        orphaned processes killed at start, drivers in use and idle, and the highest memory of one driver in MB'''
+        with self.lock:
+            return dict(self.counts, in_use=len(self.drivers) - len(self.idle), idle=len(self.idle))
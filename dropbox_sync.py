@@ -0,0 +1,231 @@
+# Revision and content hash aware Dropbox sync with a local file cache
+import hashlib
+import io
+import json
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from dropbox.exceptions import ApiError
+from dropbox.files import WriteMode, CommitInfo, UploadSessionCursor
+
+from local_state import STATE_DIR
+from metrics import METRICS, call_collecting_metrics
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+DROPBOX_CACHE_DIR = os.path.join(STATE_DIR, "dropbox_cache")
+
+# Dropbox hashes files in 4 MB blocks
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Files above this size are uploaded in chunks through an upload session (files_upload takes at most 150 MB)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Parts of an xlsx file that change on every save even when the data does not
+VOLATILE_XLSX_PARTS = {"docProps/core.xml"}
+
+def dropbox_content_hash(data):
+    '''The content_hash Dropbox reports in file metadata: sha256 over the sha256 of every 4 MB block'''
+    block_hashes = b"".join(hashlib.sha256(data[i:i + DROPBOX_HASH_BLOCK_SIZE]).digest()
+                            for i in range(0, len(data), DROPBOX_HASH_BLOCK_SIZE))
+    return hashlib.sha256(block_hashes).hexdigest()
+
+def stable_content_hash(data):
+    '''Hash of a file's content that ignores save timestamps. For xlsx files the zip entries are hashed by name and content,
+    leaving out the document properties and zip dates that openpyxl rewrites on every save'''
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        return hashlib.sha256(data).hexdigest()
+
+    digest = hashlib.sha256()
+    with archive:
+        for name in sorted(archive.namelist()):
+            if name in VOLATILE_XLSX_PARTS:
+                continue
+            digest.update(name.encode())
+            digest.update(hashlib.sha256(archive.read(name)).digest())
+    return digest.hexdigest()
+
+class SyncConflict(Exception):
+    '''The Dropbox file was changed by someone else since it was downloaded'''
+
+class DropboxSyncCache:
+    '''Keeps a local copy of each synced Dropbox file with the rev and content_hash it was downloaded or uploaded at.
+    Files larger than chunk_size are uploaded in chunks.'''
+
+    def __init__(self, cache_dir=DROPBOX_CACHE_DIR, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+
+    def _paths(self, dropbox_path):
+        key = hashlib.sha256(dropbox_path.lower().encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, key + ".bin"), os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, dropbox_path):
+        '''Returns (data, metadata dict) of the cached copy or (None, None)'''
+        data_path, meta_path = self._paths(dropbox_path)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None, None
+        with open(meta_path, encoding="utf-8") as f:
+            metadata = json.load(f)
+        with open(data_path, "rb") as f:
+            return f.read(), metadata
+
+    def put(self, dropbox_path, data, rev, content_hash):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path, meta_path = self._paths(dropbox_path)
+        with open(data_path, "wb") as f:
+            f.write(data)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"path": dropbox_path, "rev": rev, "content_hash": content_hash}, f)
+
+    def download(self, dbx, dropbox_path, **labels):
+        '''Returns (data, rev) of the Dropbox file, or (None, None) if there is no file at the path.
+        Only downloads the file if the cached copy is not at the current revision. labels go on the download stage'''
+        with METRICS.stage("download", **labels) as record:
+            data, rev = self._download(dbx, dropbox_path, record)
+        return data, rev
+
+    def _download(self, dbx, dropbox_path, record):
+        try:
+            metadata = dbx.files_get_metadata(dropbox_path)
+        except ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                printr(f"No dropbox file found at {dropbox_path}")
+                return None, None
+            raise
+
+        data, cached = self.get(dropbox_path)
+        if cached and cached["rev"] == metadata.rev and cached["content_hash"] == metadata.content_hash:
+            printg(f"Dropbox file at {dropbox_path} is unchanged (rev {metadata.rev}), using the cached copy")
+            record.add(cache_hits=1)
+            return data, metadata.rev
+
+        _, response = dbx.files_download(dropbox_path, rev=metadata.rev)
+        data = response.content
+        record.add(bytes=len(data))
+        if dropbox_content_hash(data) != metadata.content_hash:
+            raise IOError(f"Download of {dropbox_path} does not match its content hash")
+
+        self.put(dropbox_path, data, metadata.rev, metadata.content_hash)
+        printg(f"Downloaded file at {dropbox_path} (rev {metadata.rev})")
+        return data, metadata.rev
+
+    def upload(self, dbx, dropbox_path, data, rev=None, **labels):
+        '''Uploads data over the file at rev (or as a new file if rev is None) and returns the new rev.
+        Skips the upload if data has the same content as the cached copy at rev.
+        Raises SyncConflict if the file on Dropbox is no longer at rev. labels go on the upload stage'''
+        with METRICS.stage("upload", **labels) as record:
+            return self._upload(dbx, dropbox_path, data, rev, record)
+
+    def _upload(self, dbx, dropbox_path, data, rev, record):
+        cached_data, cached = self.get(dropbox_path)
+        if rev is not None and cached and cached["rev"] == rev and stable_content_hash(cached_data) == stable_content_hash(data):
+            printb(f"No changes to {dropbox_path}, skipping the upload")
+            record.add(skipped=1)
+            return rev
+
+        mode = WriteMode.update(rev) if rev is not None else WriteMode.add
+        try:
+            if len(data) > self.chunk_size:
+                metadata = upload_in_chunks(dbx, dropbox_path, data, mode, self.chunk_size)
+            else:
+                metadata = dbx.files_upload(data, dropbox_path, mode=mode)
+        except ApiError as e:
+            if is_write_conflict(e):
+                raise SyncConflict(f"{dropbox_path} was changed on Dropbox after rev {rev}") from e
+            raise
+
+        record.add(bytes=len(data))
+        self.put(dropbox_path, data, metadata.rev, metadata.content_hash)
+        printg(f"[+] Uploaded {dropbox_path} (rev {metadata.rev})")
+        return metadata.rev
+
+def is_write_conflict(error):
+    '''Checks if a files_upload or files_upload_session_finish ApiError is a write conflict'''
+    if not error.error.is_path():
+        return False
+    path_error = error.error.get_path()
+    # files_upload wraps the WriteError in an UploadWriteFailed, the upload session finish reports it directly
+    write_error = path_error.reason if hasattr(path_error, "reason") else path_error
+    return write_error.is_conflict()
+
+def upload_in_chunks(dbx, dropbox_path, data, mode, chunk_size=UPLOAD_CHUNK_SIZE):
+    '''Uploads data through an upload session in chunk_size pieces and commits it to dropbox_path with mode'''
+    session = dbx.files_upload_session_start(data[:chunk_size])
+    cursor = UploadSessionCursor(session_id=session.session_id, offset=chunk_size)
+    while len(data) - cursor.offset > chunk_size:
+        dbx.files_upload_session_append_v2(data[cursor.offset:cursor.offset + chunk_size], cursor)
+        cursor.offset += chunk_size
+    metadata = dbx.files_upload_session_finish(data[cursor.offset:], cursor, CommitInfo(path=dropbox_path, mode=mode))
+    printb(f"Uploaded {dropbox_path} in {-(-len(data) // chunk_size)} chunks")
+    return metadata
+
+########## PIPELINE ##########
+
+def sync_workbooks(dbx, sync_cache, jobs, transform, max_uploads=4, processes=None, built=None, on_built=None):
+    '''Runs download -> transform -> upload for every ticker as a pipeline.
+    jobs maps each ticker to (dropbox path, new sheets) and transform(ticker, new sheets, current bytes or None) returns the
+    new xlsx bytes. All downloads start at once, transforms run in a pool of processes (threads if processes is 0)
+    and uploads go out through at most max_uploads threads. A failure only stops its own ticker.
+    built optionally maps tickers to (xlsx bytes, rev they were built from) made by an earlier run, those go straight to
+    the upload. on_built(ticker, xlsx bytes, rev) is called as each transform finishes.
+    Returns {ticker: {"rev": new rev or None, "stage": last stage reached, "error": None or the error}}'''
+    built = built or {}
+    results = {ticker: {"rev": None, "stage": "upload" if ticker in built else "download", "error": None} for ticker in jobs}
+    if not jobs:
+        return results
+
+    processes = min(len(jobs), os.cpu_count() or 1) if processes is None else processes
+    transform_pool = ProcessPoolExecutor(processes) if processes else ThreadPoolExecutor(len(jobs))
+
+    with ThreadPoolExecutor(len(jobs)) as download_pool, transform_pool, ThreadPoolExecutor(max_uploads) as upload_pool:
+        # future -> (ticker, stage, current rev)
+        pending = {download_pool.submit(sync_cache.download, dbx, path, ticker=ticker): (ticker, "download", None)
+                   for ticker, (path, _) in jobs.items() if ticker not in built}
+        for ticker, (excel_data, rev) in built.items():
+            pending[upload_pool.submit(sync_cache.upload, dbx, jobs[ticker][0], excel_data, rev, ticker=ticker)] = (ticker, "upload", rev)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                ticker, stage, rev = pending.pop(future)
+                path, new_sheets = jobs[ticker]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    results[ticker]["error"] = e
+                    printr(f"[!] {ticker}: {stage} of {path} failed: {type(e).__name__}: {e}")
+                    continue
+
+                if stage == "download":
+                    current_binary, rev = result
+                    results[ticker]["stage"] = "transform"
+                    # Stages timed inside a transform process are sent back with its result
+                    future = transform_pool.submit(call_collecting_metrics, os.getpid(), transform, ticker, new_sheets, current_binary)
+                    pending[future] = (ticker, "transform", rev)
+                elif stage == "transform":
+                    result, events = result
+                    METRICS.extend(events)
+                    if on_built is not None:
+                        on_built(ticker, result, rev)
+                    results[ticker]["stage"] = "upload"
+                    pending[upload_pool.submit(sync_cache.upload, dbx, path, result, rev, ticker=ticker)] = (ticker, "upload", rev)
+                else:
+                    results[ticker].update(stage="done", rev=result)
+
+    report_sync_results(results)
+    return results
+
+def report_sync_results(results):
+    '''Prints one line per ticker with the outcome of its sync'''
+    for ticker, result in results.items():
+        if result["error"] is None:
+            printg(f"[+] {ticker}: synced (rev {result['rev']})")
+        elif isinstance(result["error"], SyncConflict):
+            printr(f"[!] {ticker}: not uploaded, the file was edited on Dropbox since it was downloaded")
+        else:
+            printr(f"[!] {ticker}: failed during {result['stage']}: {type(result['error']).__name__}: {result['error']}")
@@ -0,0 +1,162 @@
+# Streaming Excel export with openpyxl write-only worksheets
+import io
+from copy import copy
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle, Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+from metrics import stage
+from normalize import merge_rows_by_date
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+# Shared styles, the same look format_workbook gives an in-memory workbook
+def create_named_styles():
+    white = "ffffff"
+    blue = "2181ff"
+    return {
+        "ticker": NamedStyle(name="ticker", font=Font(size=20, bold=True)),
+        "header": NamedStyle(name="header", font=Font(bold=True, size=15, color=white),
+                             fill=PatternFill(start_color=blue, end_color=blue, fill_type="solid")),
+        "number": NamedStyle(name="number", font=Font(size=12)),
+    }
+
+def read_sheet_frames(workbook_binary):
+    '''Reads every sheet of an xlsx file in read-only mode. Returns {sheet name: (ticker title, DataFrame)} where the
+    DataFrame holds the data block below the header row, with the header row as its columns'''
+    workbook = load_workbook(io.BytesIO(workbook_binary), read_only=True)
+    frames = {}
+    for sheet in workbook.worksheets:
+        rows = list(sheet.iter_rows(values_only=True))
+        title = rows[0][0] if rows and rows[0] else None
+        headers = list(rows[1]) if len(rows) > 1 else []
+        data_rows = [list(row) for row in rows[2:]]
+
+        # Read-only rows can be ragged and trailing rows empty
+        while data_rows and all(val is None for val in data_rows[-1]):
+            data_rows.pop()
+        width = max([len(headers)] + [len(row) for row in data_rows])
+        headers += [None] * (width - len(headers))
+        data_rows = [row + [None] * (width - len(row)) for row in data_rows]
+
+        frames[sheet.title] = (title, pd.DataFrame(data_rows, columns=headers))
+    workbook.close()
+    return frames
+
+def merge_sheet_rows(existing, data):
+    '''Adds the rows of data whose Market Date is not in the existing sheet frame, on top or in place by date for
+    backfilled ones (see merge_rows_by_date), like create_excel_sheet does. Returns (merged frame, number of rows added)'''
+    if data.empty:
+        # Nothing stored for the sheet yet
+        return (pd.DataFrame() if existing is None else existing), 0
+    if existing is None or existing.shape[1] == 0:
+        existing = pd.DataFrame(columns=data.columns)
+    elif list(existing.columns[:1]) != ['Market Date']:
+        # Write the headers if the sheet does not have them yet
+        existing = existing.set_axis(list(data.columns[:existing.shape[1]]) + [None] * (existing.shape[1] - data.shape[1]), axis=1)
+
+    current_dates = set(existing.iloc[:, 0].astype(str))
+    market_dates = data['Market Date'].astype(str)
+    new_data = data[~market_dates.isin(current_dates) & ~market_dates.duplicated()]
+
+    # Rows are placed by position, under whichever headers the sheet already has
+    width = max(existing.shape[1], new_data.shape[1])
+    columns = list(existing.columns) + list(new_data.columns[existing.shape[1]:])
+    new_rows = [list(row) + [None] * (width - len(row)) for row in new_data.itertuples(index=False, name=None)]
+    existing_rows = [list(row) + [None] * (width - len(row)) for row in existing.itertuples(index=False, name=None)]
+
+    # New rows go on top, backfilled dates older than the rows already there go in place
+    return pd.DataFrame(merge_rows_by_date(new_rows, existing_rows), columns=columns), len(new_data)
+
+def column_widths(title, data):
+    '''Column widths from the DataFrame, the same (longest value + 2) * 1.5 rule format_workbook uses cell by cell'''
+    widths = []
+    for col_num, column in enumerate(data.columns):
+        values = data.iloc[:, col_num]
+        lengths = values[values.notna()].astype(str).str.len()
+        max_length = max(len(str(column)), int(lengths.max()) if len(lengths) else 0)
+        if col_num == 0 and title is not None:
+            max_length = max(max_length, len(str(title)))
+        widths.append((max_length + 2) * 1.5)
+    return widths
+
+def write_sheet(workbook, styles, sheet_name, title, data):
+    '''Streams one sheet into a write-only workbook: ticker title, styled header row and the data block'''
+    sheet = workbook.create_sheet(title=sheet_name)
+
+    # Column dimensions have to be set before any row is written
+    for col_num, width in enumerate(column_widths(title, data), 1):
+        sheet.column_dimensions[get_column_letter(col_num)].width = width
+
+    # Resolving a named style is slow, so resolve each one once and copy its style ids onto every cell
+    templates = {}
+    for name, style in styles.items():
+        templates[name] = WriteOnlyCell(sheet)
+        templates[name].style = style
+
+    def styled(val, style):
+        cell = WriteOnlyCell(sheet, value=val)
+        if cell.is_date:
+            # Dates keep the number format openpyxl gave them, the style ids would reset it to General
+            number_format = cell.number_format
+            cell._style = copy(templates[style.name]._style)
+            cell.number_format = number_format
+        else:
+            cell._style = copy(templates[style.name]._style)
+        return cell
+
+    sheet.append([styled(title, styles["ticker"])])
+    sheet.append([styled(header, styles["header"]) for header in data.columns])
+    for row in data.itertuples(index=False, name=None):
+        # The date column keeps the default font, like format_workbook leaves it
+        sheet.append([row[0]] + [styled(val, styles["number"]) for val in row[1:]])
+
+def write_workbook_binary(sheets):
+    '''Builds an xlsx file from {sheet name: (ticker title, DataFrame)} with write-only worksheets and returns its bytes'''
+    workbook = Workbook(write_only=True)
+    styles = create_named_styles()
+    for style in styles.values():
+        workbook.add_named_style(style)
+
+    for sheet_name, (title, data) in sheets.items():
+        write_sheet(workbook, styles, sheet_name, title, data)
+
+    excel_io = io.BytesIO()
+    workbook.save(excel_io)
+    return excel_io.getvalue()
+
+def export_ticker_workbook(stock_ticker, new_sheets, current_binary=None, fallback=None):
+    '''Streaming replacement for create_excel_sheet + format_workbook + convert_excel_to_binary.
+    Merges the new rows in {sheet name: DataFrame} into the sheets of the current xlsx bytes (if any) and returns the
+    bytes of the formatted workbook. The sheets are rewritten from their values, so a workbook with sheets other than
+    new_sheets is handed to fallback (called with the same arguments) to keep them as they are, or raises ValueError'''
+    with stage("sheet_read", ticker=stock_ticker) as record:
+        sheets = read_sheet_frames(current_binary) if current_binary else {}
+        record.add(bytes=len(current_binary or b""))
+    title = f'Ticker = {stock_ticker.upper()}'
+
+    other_sheets = [sheet_name for sheet_name in sheets if sheet_name not in new_sheets]
+    if other_sheets:
+        if fallback is None:
+            raise ValueError(f"The {stock_ticker} workbook has other sheets ({', '.join(other_sheets)}) the streaming export would not keep")
+        printb(f"The {stock_ticker} workbook has other sheets ({', '.join(other_sheets)}), updating it in memory")
+        return fallback(stock_ticker, new_sheets, current_binary)
+
+    for sheet_name, data in new_sheets.items():
+        printb(f"Creating the {sheet_name} sheet...")
+        with stage("sheet_update", ticker=stock_ticker, sheet=sheet_name) as record:
+            _, existing = sheets.get(sheet_name, (None, None))
+            merged, added = merge_sheet_rows(existing, data)
+            record.add(rows=added)
+        printg(f"Added {added} row(s) to the {sheet_name} sheet")
+        sheets[sheet_name] = (title, merged)
+
+    # Formatting happens as the cells are written, so it is part of serialize here
+    with stage("serialize", ticker=stock_ticker) as record:
+        excel_data = write_workbook_binary(sheets)
+        record.add(bytes=len(excel_data))
+    return excel_data
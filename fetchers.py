@@ -0,0 +1,210 @@
+# Page fetcher backends for the scrapers
+import threading
+import time
+
+from table_parser import find_table_html
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+# Sent with every plain HTTP request so the sites serve the same markup they give the browser
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Text of the bot checks and throttling pages the sites answer with instead of the content
+CHALLENGE_MARKERS = ("Just a moment...", "cf-challenge", "captcha", "unusual traffic", "Too Many Requests")
+
+# Status codes that mean the site wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+class ChallengeError(Exception):
+    '''The site answered with a bot check or a throttling response instead of the page'''
+
+def is_challenge_page(page_source):
+    return any(marker in page_source for marker in CHALLENGE_MARKERS)
+
+class SystemClock:
+    '''Time source of the rate limiters and the scheduler, replay.SimulatedClock stands in for it when measuring'''
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(max(0, seconds))
+
+SYSTEM_CLOCK = SystemClock()
+
+class SeleniumFetcher:
+    '''Fetches pages through a WebDriver and waits for the tables to be rendered before taking the page source.
+    With timeouts (a page_policy.AdaptiveTimeouts) the page load and the wait are limited by the timeout learned for
+    the url's domain instead of the fixed timeout, and every successful load is recorded in it.
+    With pool (a driver_pool.DriverPool the driver came from) the pool may swap the driver for a fresh one after a page
+    load, a driver that errors out is replaced, and quit gives the driver back to the pool instead of closing it.'''
+
+    def __init__(self, driver, timeout=10, timeouts=None, pool=None):
+        self.driver = driver
+        self.timeout = timeout
+        self.timeouts = timeouts
+        self.pool = pool
+
+    def fetch(self, url, table_ids=None):
+        '''Loads the url and returns the page source once every table in table_ids (or any table if None) is on the page'''
+        # Selenium is only imported by the sessions that use a browser
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+
+        timeout = self.timeouts.timeout(url) if self.timeouts else self.timeout
+        start = time.monotonic()
+        try:
+            if self.timeouts:
+                self.driver.set_page_load_timeout(timeout)
+            self.driver.get(url)
+
+            if table_ids:
+                condition = EC.all_of(*[EC.presence_of_element_located((By.ID, table_id)) for table_id in table_ids])
+            else:
+                condition = EC.presence_of_element_located((By.TAG_NAME, "table"))
+            WebDriverWait(self.driver, max(0, timeout - (time.monotonic() - start))).until(condition)
+            page_source = self.driver.page_source
+        except TimeoutException as e:
+            if is_challenge_page(self.driver.page_source):
+                raise ChallengeError(f"Bot check on {url}") from e
+            raise TimeoutError(f"Timed out after {timeout:.1f} s waiting for {url}") from e
+        except WebDriverException as e:
+            # A slow page leaves the browser usable, anything else (a crashed tab, a dead chromedriver) may not
+            if self.pool is not None:
+                self.driver = self.pool.replace(self.driver)
+            raise
+
+        if self.timeouts:
+            self.timeouts.record(url, time.monotonic() - start)
+        if self.pool is not None:
+            self.driver = self.pool.page_loaded(self.driver)
+        return page_source
+
+    def quit(self):
+        if self.pool is not None:
+            self.pool.release(self.driver)
+        else:
+            self.driver.quit()
+
+class HttpFetcher:
+    '''Fetches raw HTML with a pooled requests.Session. If a table is missing from the raw HTML (the page needs JavaScript
+    or the session was challenged) the page is loaded again through the fallback fetcher, which is created on first use
+    by calling create_fallback. timeouts works as for SeleniumFetcher.
+    A throttling status raises ChallengeError and a timeout TimeoutError, the browser would not get through either.'''
+
+    def __init__(self, session=None, create_fallback=None, timeout=10, timeouts=None):
+        self.session = session or create_http_session()
+        self.create_fallback = create_fallback
+        self.fallback = None
+        self.timeout = timeout
+        self.timeouts = timeouts
+
+    def fetch(self, url, table_ids=None):
+        '''Returns the page source of url, falling back to the browser if the tables in table_ids (or any table if None) are not in it'''
+        import requests
+
+        try:
+            start = time.monotonic()
+            timeout = self.timeouts.timeout(url) if self.timeouts else self.timeout
+            response = self.session.get(url, timeout=timeout)
+            if response.status_code in THROTTLE_STATUS_CODES:
+                raise ChallengeError(f"{url} answered {response.status_code}")
+            response.raise_for_status()
+            page_source = response.text
+            if self.timeouts:
+                self.timeouts.record(url, time.monotonic() - start)
+        except requests.Timeout as e:
+            raise TimeoutError(f"Timed out after {timeout:.1f} s waiting for {url}") from e
+        except requests.RequestException as e:
+            printr(f"[!] HTTP fetch of {url} failed: {e}")
+            page_source = ""
+
+        if has_tables(page_source, table_ids):
+            return page_source
+
+        if self.create_fallback is None:
+            if is_challenge_page(page_source):
+                raise ChallengeError(f"Bot check on {url}")
+            raise LookupError(f"Tables {table_ids or 'table'} not found in {url}")
+
+        printb(f"Tables missing from the raw HTML of {url}, falling back to the browser...")
+        if self.fallback is None:
+            self.fallback = self.create_fallback()
+        return self.fallback.fetch(url, table_ids)
+
+    def quit(self):
+        self.session.close()
+        if self.fallback is not None:
+            self.fallback.quit()
+
+class RateLimiter:
+    '''Token bucket shared by every thread using it: up to burst calls go through at once, after that one more every
+    1 / requests_per_second seconds. With burst 1 the calls are simply spaced that far apart.'''
+
+    def __init__(self, requests_per_second, burst=1, clock=SYSTEM_CLOCK):
+        self.rate = requests_per_second
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock.now()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock.now()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        '''Seconds until a token is available, 0 if one is'''
+        with self.lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        '''Takes a token if one is available. Returns whether it did'''
+        with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def wait(self):
+        '''Blocks until a token is taken'''
+        while not self.try_acquire():
+            self.clock.sleep(self.delay())
+
+def has_tables(page_source, table_ids=None):
+    '''Checks that every table in table_ids (or any table if None) is in the page source'''
+    if not table_ids:
+        return find_table_html(page_source) is not None
+    return all(find_table_html(page_source, table_id) is not None for table_id in table_ids)
+
+def create_http_session(cookies=None, pool_size=10):
+    '''Creates a requests.Session with a connection pool of pool_size per host, browser like headers and the given cookies'''
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HTTP_HEADERS)
+
+    for cookie in cookies or []:
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+
+    return session
+
+def get_driver_cookies(driver):
+    '''Returns the cookies of a logged in WebDriver in the format create_http_session takes'''
+    cookies = driver.get_cookies()
+    printg(f"[+] Copied {len(cookies)} cookies from the browser session")
+    return cookies
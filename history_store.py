@@ -0,0 +1,145 @@
+# Local SQLite store of every scraped row, the source of truth for the sheets and reports
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from local_state import STATE_DIR, WATERMARK_COLUMNS
+from normalize import is_float_column
+
+HISTORY_DB_PATH = os.path.join(STATE_DIR, "history.sqlite")
+
+def quote(name):
+    '''Quotes a column or table name for SQL'''
+    return '"' + str(name).replace('"', '""') + '"'
+
+def sql_type(column):
+    '''SQLite column type for a normalized DataFrame column. Prices and ratios are always REAL, whatever the values of
+    the batch that creates the column'''
+    if is_float_column(column.name):
+        return "REAL"
+    if pd.api.types.is_integer_dtype(column):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(column):
+        return "REAL"
+    return "TEXT"
+
+def sql_values(column):
+    '''Plain Python values SQLite can bind: dates as YYYY-MM-DD strings and missing values as None'''
+    if pd.api.types.is_datetime64_any_dtype(column):
+        column = column.dt.strftime("%Y-%m-%d")
+    return [None if pd.isna(val) else val for val in column.astype(object).tolist()]
+
+class HistoryStore:
+    '''Append-only store with one SQLite table per scraped table (finra_data, combined_data, ...).
+    Rows are keyed by (ticker, date), so storing a row that is already there is a no-op and looking dates up is an index
+    lookup. Reads give back the same typed DataFrames normalize_table produces, newest first.'''
+
+    def __init__(self, path=HISTORY_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def columns(self, table):
+        '''{column name: SQLite type} of a stored table, empty if the table does not exist yet'''
+        return {row[1]: row[2] for row in self.connection.execute(f"PRAGMA table_info({quote(table)})")}
+
+    def date_column(self, table, columns=None):
+        '''The column a table's rows are ordered and keyed by'''
+        columns = columns if columns is not None else self.columns(table)
+        return next((column for column in WATERMARK_COLUMNS if column in columns), None)
+
+    def _ensure_table(self, table, data):
+        columns = self.columns(table)
+        if not columns:
+            date_column = self.date_column(table, data.columns)
+            if date_column is None:
+                raise ValueError(f"{table} has none of the date columns {WATERMARK_COLUMNS}")
+            definitions = ["ticker TEXT NOT NULL", f"{quote(date_column)} TEXT NOT NULL"]
+            definitions += [f"{quote(column)} {sql_type(data[column])}" for column in data.columns if column != date_column]
+            definitions.append(f"PRIMARY KEY (ticker, {quote(date_column)})")
+            self.connection.execute(f"CREATE TABLE {quote(table)} ({', '.join(definitions)})")
+            self.connection.execute(f"CREATE INDEX {quote(table + '_date')} ON {quote(table)} ({quote(date_column)})")
+            return
+
+        # Tables only ever gain columns, a column the site stops sending stays empty
+        for column in data.columns:
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {sql_type(data[column])}")
+
+    def append(self, stock_ticker, table, data):
+        '''Stores the rows of a normalized DataFrame that are not stored yet. Returns the number of new rows'''
+        if data.empty:
+            return 0
+
+        with self.lock, self.connection:
+            self._ensure_table(table, data)
+            date_column = self.date_column(table)
+            data = data[data[date_column].notna()]
+
+            columns = ["ticker"] + list(data.columns)
+            rows = zip([stock_ticker] * len(data), *[sql_values(data[column]) for column in data.columns])
+            before = self.connection.total_changes
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO {quote(table)} ({', '.join(map(quote, columns))}) VALUES ({', '.join('?' * len(columns))})",
+                rows)
+            return self.connection.total_changes - before
+
+    def read(self, stock_ticker, table, since=None, until=None, limit=None):
+        '''Returns the stored rows of a ticker's table, newest first, optionally only dates in [since, until] and only the
+        newest limit rows. Returns an empty DataFrame if nothing is stored'''
+        columns = self.columns(table)
+        if not columns:
+            return pd.DataFrame()
+
+        date_column = self.date_column(table, columns)
+        query = f"SELECT * FROM {quote(table)} WHERE ticker = ?"
+        params = [stock_ticker]
+        if since is not None:
+            query += f" AND {quote(date_column)} >= ?"
+            params.append(pd.Timestamp(since).strftime("%Y-%m-%d"))
+        if until is not None:
+            query += f" AND {quote(date_column)} <= ?"
+            params.append(pd.Timestamp(until).strftime("%Y-%m-%d"))
+        query += f" ORDER BY {quote(date_column)} DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+
+        with self.lock:
+            data = pd.read_sql_query(query, self.connection, params=params)
+        data = data.drop(columns="ticker")
+
+        # Give the columns back the types they were stored from
+        for column, column_type in columns.items():
+            if column == "ticker":
+                continue
+            if str(column).endswith("Date"):
+                data[column] = pd.to_datetime(data[column], errors="coerce")
+            elif column_type == "INTEGER":
+                # A column first stored from whole numbers keeps any decimals stored later, those read as Float64
+                values = pd.to_numeric(data[column]).astype("Float64")
+                data[column] = values.astype("Int64") if (values.dropna() % 1 == 0).all() else values
+            elif column_type == "REAL":
+                data[column] = data[column].astype("Float64")
+        return data
+
+    def dates(self, stock_ticker, table):
+        '''The set of dates (as YYYY-MM-DD strings) stored for a ticker's table'''
+        columns = self.columns(table)
+        if not columns:
+            return set()
+        date_column = quote(self.date_column(table, columns))
+        with self.lock:
+            return {row[0] for row in self.connection.execute(f"SELECT {date_column} FROM {quote(table)} WHERE ticker = ?", [stock_ticker])}
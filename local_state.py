@@ -0,0 +1,72 @@
+# Local state kept between runs
+import json
+import os
+import time
+
+# Directory holding the sessions, watermarks and caches of the scraper
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".short_interest")
+
+WATERMARKS_PATH = os.path.join(STATE_DIR, "watermarks.json")
+
+# Date columns tracked per table, the first one found in a table is the one its rows are ordered by
+WATERMARK_COLUMNS = ["Market Date", "Settlement Date"]
+
+def load_json_state(path, default=None):
+    '''Returns the JSON value stored at path, or default if there is none'''
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_json_state(path, value):
+    '''Writes value as JSON to path, replacing the file in one step so a crash never leaves it half written'''
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def load_cached_value(path, ttl):
+    '''Returns a value stored with save_cached_value, or None if there is none or it is older than ttl seconds'''
+    record = load_json_state(path)
+    if record is None or time.time() - record["saved"] > ttl:
+        return None
+    return record["value"]
+
+def save_cached_value(path, value):
+    '''Stores value together with the time it was saved, see load_cached_value'''
+    save_json_state(path, {"saved": time.time(), "value": value})
+
+def load_watermarks(path=WATERMARKS_PATH):
+    '''Returns the stored high water marks as {ticker: {table: {date column: last date}}}'''
+    return load_json_state(path, {})
+
+def save_watermarks(watermarks, path=WATERMARKS_PATH):
+    '''Writes the high water marks to path'''
+    save_json_state(path, watermarks)
+
+def get_watermark(watermarks, stock_ticker, table):
+    '''Returns the last stored date (as a Timestamp) of the table's ordering column, or None if nothing is stored yet'''
+    # pandas is imported where it is needed so loading the config and state files stays cheap
+    import pandas as pd
+
+    marks = watermarks.get(stock_ticker, {}).get(table, {})
+    for column in WATERMARK_COLUMNS:
+        if marks.get(column):
+            return pd.Timestamp(marks[column])
+    return None
+
+def update_watermark(watermarks, stock_ticker, table, data):
+    '''Moves the table's high water marks forward to the newest dates in the DataFrame'''
+    import pandas as pd
+
+    marks = watermarks.setdefault(stock_ticker, {}).setdefault(table, {})
+    for column in WATERMARK_COLUMNS:
+        if column not in data.columns:
+            continue
+        newest = pd.to_datetime(data[column], errors="coerce").max()
+        if pd.isna(newest):
+            continue
+        if not marks.get(column) or newest > pd.Timestamp(marks[column]):
+            marks[column] = newest.strftime("%Y-%m-%d")
+    return watermarks
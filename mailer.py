@@ -0,0 +1,145 @@
+# Pooled SMTP delivery with retries
+import smtplib, ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from metrics import METRICS
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+# Errors after which the connection is thrown away and the message retried
+RETRYABLE_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                    ConnectionError, TimeoutError, ssl.SSLError)
+
+def is_retryable(error):
+    '''Connection errors, and rejections of the message the server says are temporary (4xx codes).
+    A permanent (5xx) rejection would only be refused again.'''
+    if isinstance(error, smtplib.SMTPDataError):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+def build_message(sender_name, sender_email, receiver_emails, subject, body):
+    '''Creates the MIME object for an HTML email'''
+    message = MIMEMultipart()
+    message['Subject'] = subject
+    message['From'] = sender_name + f'<{sender_email}>'
+    message['To'] = ", ".join(receiver_emails)
+
+    # Attach HTML body
+    message.attach(MIMEText(body, 'html'))
+    return message
+
+class Mailer:
+    '''Keeps one authenticated SMTP connection open and sends messages through it.
+    A failed send reconnects and retries up to retries times, waiting backoff * 2 ** attempt seconds in between.
+    Use use_ssl=False and empty credentials to talk to a local stand-in such as aiosmtpd.'''
+
+    def __init__(self, host="smtp.gmail.com", port=465, username="", password="", use_ssl=True,
+                 retries=3, backoff=1.0, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.server = None
+        self.sent = 0
+        self.connections = 0
+
+    def connect(self):
+        if self.server is not None:
+            return self.server
+
+        if self.use_ssl:
+            # Create a secure SSL context
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context(), timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            if self.username:
+                server.login(self.username, self.password)
+        except BaseException:
+            server.close()
+            raise
+
+        self.server = server
+        self.connections += 1
+        return server
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.discard()
+
+    def discard(self):
+        '''Closes the socket of the connection without saying goodbye on it, for connections that are broken'''
+        if self.server is None:
+            return
+        try:
+            self.server.close()
+        except OSError:
+            pass
+        self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, message):
+        '''Sends one MIME message to the recipients in its To header, reconnecting and retrying on connection errors
+        and temporary rejections'''
+        receiver_emails = [email.strip() for email in message['To'].split(",")]
+        sender_email = message['From'].rsplit("<", 1)[-1].rstrip(">")
+        message_text = message.as_string()
+
+        for attempt in range(self.retries + 1):
+            try:
+                # Subjects carry the date, the stage is left unlabelled so every run exports the same series
+                with METRICS.stage("email") as record:
+                    self.connect().sendmail(sender_email, receiver_emails, message_text)
+                    record.add(bytes=len(message_text), recipients=len(receiver_emails))
+                self.sent += 1
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                if not is_retryable(e):
+                    raise
+                self.discard()
+                if attempt == self.retries:
+                    raise
+                METRICS.count("retries", stage="email")
+                delay = self.backoff * 2 ** attempt
+                printr(f"[!] Sending '{message['Subject']}' failed ({type(e).__name__}: {e}), retrying in {delay:.1f} s")
+                time.sleep(delay)
+
+    def send_all(self, messages):
+        '''Sends a queue of messages over the one connection. Returns the (message, error) pairs that could not be sent'''
+        failed = []
+        for message in messages:
+            try:
+                self.send(message)
+                printg(f"[+] Email '{message['Subject']}' sent to {message['To']}")
+            except (smtplib.SMTPException, OSError) as e:
+                printr(f"[!] Email '{message['Subject']}' to {message['To']} failed: {type(e).__name__}: {e}")
+                failed.append((message, e))
+        self.close()
+        return failed
+
+    def send_all_async(self, messages):
+        '''Sends the messages on a background thread so other work can go on meanwhile.
+        Returns a Future whose result is what send_all returns'''
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mailer")
+        future = executor.submit(self.send_all, list(messages))
+        executor.shutdown(wait=False)
+        return future
@@ -1,49 +1,63 @@
-# Selenium Modules
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium_stealth import stealth
-
-
-from bs4 import BeautifulSoup
+# Selenium, requests, lxml, cryptography, openpyxl and the Dropbox SDK are imported inside the functions that use them,
+# so jobs that only need the stored data (see cli.py) start without loading them
+
+from normalize import normalize_table, to_sheet_values, merge_rows_by_date
+from report import ReportRenderer
+from metrics import METRICS, METRICS_JSONL_PATH, METRICS_PROM_PATH, stage, timed, count
+from scheduler import RequestScheduler, ScheduledFetcher, capped_limits, PRIORITY_DAILY, PRIORITY_BACKFILL
+from history_store import HistoryStore
+from checkpoints import RunCheckpoint
+from driver_pool import DriverPool
+from page_cache import PageCache, CachingFetcher
+from merge_engine import merge_data, long_format, add_rolling_ratios, add_days_to_cover, ticker_table
+from config import DEFAULT_CONFIG
+from local_state import STATE_DIR, load_cached_value, save_cached_value, load_watermarks, save_watermarks, get_watermark, update_watermark
 
 import pandas as pd
-import numpy as np
-from openpyxl import Workbook, load_workbook
 
 import os
 import io
-
-import openpyxl
-
-#Dropbox modules
-import dropbox
-from dropbox.exceptions import AuthError, ApiError
-from dropbox.common import PathRoot
-from dropbox import DropboxOAuth2FlowNoRedirect
-from dropbox.dropbox_client import DropboxTeam
+import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 #Email modules
-import smtplib, ssl
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from mailer import Mailer, build_message
 
 # Printing helpers
 from color_printer import printb,printg,printr  
 
 ############## SCRAPING & WEB BROWSING FNS ###################################################
 
-# Fintel Login through Selenium function
-def login_to_fintel(username, password):   
-    """ Sets up Web Driver and completes authentication through Fintel. 
-    Returns WebDriver for user in later scraping fns."""
+# Base URLs of the scraped sites, point these at a replay.PageServer to scrape recorded pages
+FINTEL_BASE_URL = "https://fintel.io"
+YAHOO_BASE_URL = "https://finance.yahoo.com"
+
+# Fetcher backend used by main, see scrape_all_data
+SCRAPE_BACKEND = "selenium"
+
+# Set to a directory to save every page main scrapes there, for replaying with replay.ReplayEnvironment
+RECORD_PAGES_DIR = None
+
+# Every page load of the process goes through it, so the per domain limits hold across sessions, sources and jobs
+SCHEDULER = RequestScheduler()
+
+def create_fintel_driver():
+    """Sets up the stealth Web Driver used for Fintel. Returns the WebDriver without logging in."""
+    from selenium import webdriver
+    from selenium_stealth import stealth
+    from page_policy import apply_page_load_policy, block_heavy_assets
+
     chrome_options = webdriver.ChromeOptions()
     chrome_options.add_argument('--headless=new')
     # chrome_options.add_argument("start-maximized")
     chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
     chrome_options.add_experimental_option('useAutomationExtension', False)
+    apply_page_load_policy(chrome_options)
     driver = webdriver.Chrome(options=chrome_options)
+    block_heavy_assets(driver)
 
     stealth(driver,
         languages=["en-US", "en"],
@@ -53,14 +67,29 @@ def login_to_fintel(username, password):
         renderer="Intel Iris OpenGL Engine",
         fix_hairline=True,
         )
+
+    return driver
+
+# Fintel Login through Selenium function
+@timed("login")
+def login_to_fintel(username, password):   
+    """ Sets up Web Driver and completes authentication through Fintel. 
+    Returns WebDriver for user in later scraping fns."""
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from page_policy import PAGE_TIMEOUTS
+
+    driver = create_fintel_driver()
     
     # First login to get access to all the data
 
-    driver.get("https://fintel.io/auth/login")
+    login_url = f"{FINTEL_BASE_URL}/auth/login"
+    driver.get(login_url)
 
     # driver.get_screenshot_as_file("screenshot.png")
 
-    WebDriverWait(driver, 20).until(
+    WebDriverWait(driver, PAGE_TIMEOUTS.timeout(login_url, default=20)).until(
         EC.presence_of_element_located((By.CLASS_NAME,"btn-primary"))
     )
 
@@ -79,165 +108,385 @@ def login_to_fintel(username, password):
     
     return driver
 
-# Fintel scraping function
-def scrape_fintel_data(driver, stock_ticker, table_name):
-    '''Connects to Fintel using Selenium. Uses Beautiful Soup to parse HTML. Converts HTML to a Pandas DataFrame. Returns the DataFrame'''
+# Where the logged in Fintel cookies are kept between runs
+FINTEL_SESSION_PATH = os.path.join(STATE_DIR, "fintel_session.bin")
 
-    url = f"https://fintel.io/ss/us/{stock_ticker}"
+def is_fintel_session_valid(cookies):
+    """Checks stored Fintel cookies with one cheap request to the login page.
+    Fintel sends logged in users away from the login page, and shows the login form to everyone else."""
+    import requests
+    from fetchers import create_http_session
 
-    driver.get(url)
+    session = create_http_session(cookies)
+    try:
+        response = session.get(f"{FINTEL_BASE_URL}/auth/login", allow_redirects=False, timeout=10)
+    except requests.RequestException as e:
+        printr(f"[!] Could not check the stored Fintel session: {e}")
+        return False
+    finally:
+        session.close()
+
+    if response.is_redirect:
+        return "/auth/login" not in response.headers.get("Location", "")
+    return response.ok and 'id="password"' not in response.text
+
+def get_fintel_cookies(username, password, session_path=FINTEL_SESSION_PATH):
+    """Returns logged in Fintel cookies. Reuses the stored session when it is still valid,
+    otherwise logs in through Selenium once and stores the new session for later runs."""
+    from session_store import save_session, load_session, clear_session
+    from fetchers import get_driver_cookies
+
+    cookies = load_session(session_path)
+    if cookies is not None:
+        if is_fintel_session_valid(cookies):
+            printg("[+] Reusing stored Fintel session")
+            return cookies
+        printb("Stored Fintel session was rejected")
+        clear_session(session_path)
 
-    WebDriverWait(driver, 10).until(
-        EC.presence_of_element_located((By.ID, table_name))
-    )
+    printb("Logging into Fintel...")
+    driver = login_to_fintel(username, password)
+    try:
+        cookies = get_driver_cookies(driver)
+    finally:
+        driver.quit()
 
-    page_source = driver.page_source
+    save_session(session_path, cookies)
+    return cookies
 
-    soup = BeautifulSoup(page_source, 'html.parser')
+def load_fintel_driver(cookies):
+    """Sets up a Fintel Web Driver and loads the logged in cookies into it instead of going through the login form.
+    Returns WebDriver for user in later scraping fns."""
+    driver = create_fintel_driver()
 
-    # Find the table(s) containing the data you need
-    table = soup.find('table', {'id': table_name})
+    # Cookies can only be set for the domain the browser is on
+    driver.get(f"{FINTEL_BASE_URL}/robots.txt")
+    for cookie in cookies:
+        driver.add_cookie({key: value for key, value in cookie.items() if key in ("name", "value", "domain", "path", "secure", "httpOnly", "expiry")})
 
-    # Extract headers from the first row (assuming they are in <th> elements)
-    headers = [th.text.strip().replace("FINRA","") for th in table.find('tr').find_all('th')]
-    headers = [header for header in headers if header != ""]
+    return driver
 
-    # Extract data from subsequent rows
-    data_rows = []
-    for row in table.find_all('tr')[1:]:
-        data = [td.text.strip() for td in row.find_all('td') if td.text.strip() not in ["+","/","="]]
-        data_rows.append(data)
+# Cell contents in Fintel tables that are icons rather than data
+FINTEL_SKIP_CELLS = ("+", "/", "=")
 
-    # Organize data into a DataFrame
-    data = pd.DataFrame(data_rows, columns=headers)
+def fetch_page(fetcher, url, source, stock_ticker, table_ids=None):
+    """Loads a page through the fetcher as one timed page_load stage. Returns the page source"""
+    with stage("page_load", source=source, ticker=stock_ticker) as record:
+        page_source = fetcher.fetch(url, table_ids)
+        record.add(bytes=len(page_source))
+    return page_source
 
-    # Clean and process data
+def scrape_fintel_tables(fetcher, stock_ticker, table_names, known_dates=None):
+    '''Loads the Fintel page for a ticker once, waits for every requested table and parses them all from one page source snapshot.
+    known_dates optionally maps table names to the last date already stored, only rows newer than it are parsed.
+    Returns a dictionary of DataFrames keyed by table name'''
 
-    # Convert Market Dates to date format
-    # Based on tables being scraped from Fintel, if Market Date returns an error, there will be a Settlement and Publication Date
-    try:
-        data['Market Date'] = pd.to_datetime(data['Market Date'], errors= 'coerce').dt.strftime('%Y-%m-%d')
-    except:
-        data['Settlement Date'] = pd.to_datetime(data['Settlement Date'], errors= 'coerce').dt.strftime('%Y-%m-%d')
-        data['Publication Date'] = pd.to_datetime(data['Publication Date'], errors= 'coerce').dt.strftime('%Y-%m-%d')
+    url = f"{FINTEL_BASE_URL}/ss/us/{stock_ticker}"
+
+    page_source = fetch_page(fetcher, url, "fintel", stock_ticker, table_names)
+
+    known_dates = known_dates or {}
+    return {table_name: parse_fintel_table(page_source, table_name, known_dates.get(table_name)) for table_name in table_names}
+
+def stop_at_known_date(known_date, date_format=None):
+    '''Returns a read_table stop_at function for tables listed newest first, which stops at the first row dated
+    on or before known_date. Returns None (read every row) if there is no known date.'''
+    if known_date is None:
+        return None
+
+    def stop_at(cells):
+        date = pd.to_datetime(cells[0], format=date_format, errors='coerce') if cells else pd.NaT
+        return not pd.isna(date) and date <= known_date
+
+    return stop_at
+
+def parse_fintel_table(page_source, table_name, known_date=None):
+    '''Extracts a Fintel table from the page source and converts it into a cleaned Pandas DataFrame.
+    If known_date is given only the rows newer than it are parsed.'''
+    from table_parser import read_table
+
+    # Stream just the table we need out of the page instead of parsing the whole document
+    with stage("parse", table=table_name) as record:
+        headers, data_rows = read_table(page_source, table_name, skip_cells=FINTEL_SKIP_CELLS, stop_at=stop_at_known_date(known_date))
+        record.add(rows=len(data_rows))
+
+    # Headers come from the first row (assuming they are in <th> elements)
+    headers = [header.strip().replace("FINRA","") for header in headers]
+    headers = [header for header in headers if header != ""]
+
+    # Organize data into a DataFrame
+    data = pd.DataFrame(data_rows, columns=headers)
 
     # Clean up column headers
     data.columns = [str(col).replace("BX","BX ").replace("Aggregate","Aggregate ").replace("*","").strip() for col in data.columns]
 
-    return data
+    # Clean and process data
+    # Market, Settlement and Publication Dates become datetimes and the volumes numbers
+    with stage("normalize", table=table_name):
+        return normalize_table(data)
 
 def create_yahoo_driver():
     """Creates and returns a new WebDriver to be used for Yahoo scraping fns."""
+    from selenium import webdriver
+    from page_policy import apply_page_load_policy, block_heavy_assets
+
     chrome_options = webdriver.ChromeOptions()
     chrome_options.add_argument('--headless=new')
     chrome_options.add_argument("start-maximized")
     # chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
     # chrome_options.add_experimental_option('useAutomationExtension', False)
+    apply_page_load_policy(chrome_options)
     driver = webdriver.Chrome(options=chrome_options)
+    block_heavy_assets(driver)
     
     return driver
 
-def scrape_yahoo_data(driver, stock_ticker):
-    '''Connects to Yahoo using Selenium. Uses Beautiful Soup to parse HTML. Converts HTML to a Pandas DataFrame. Returns the DataFrame'''
-
-    url = f"https://finance.yahoo.com/quote/{stock_ticker}/history"
-
-    driver.get(url)
+def scrape_yahoo_data(fetcher, stock_ticker, known_date=None):
+    '''Connects to Yahoo through the fetcher (Selenium or HTTP). Streams the table out of the HTML. Converts HTML to a Pandas DataFrame. Returns the DataFrame
+    If known_date is given only the rows newer than it are parsed.'''
 
-    WebDriverWait(driver, 10).until(
-        EC.presence_of_element_located((By.TAG_NAME, "table"))
-    )
+    url = f"{YAHOO_BASE_URL}/quote/{stock_ticker}/history"
 
-    page_source = driver.page_source
+    page_source = fetch_page(fetcher, url, "yahoo", stock_ticker)
 
-    soup = BeautifulSoup(page_source, 'html.parser')
+    # Only the 10 most recent rows of the first table are needed
+    return parse_yahoo_table(page_source, max_rows=10, known_date=known_date)
 
-    # Find the table(s) containing the data you need
-    table = soup.find('table')
+def parse_yahoo_table(page_source, max_rows=None, known_date=None):
+    '''Extracts the Yahoo history table from the page source as a cleaned DataFrame of Market Date, Close Price and Volume,
+    one row per trading day'''
+    from table_parser import read_table
 
-    headers = [th.text[:6].replace("*","").strip() for th in table.find('tr').find_all('th')]
+    with stage("parse", table="yahoo") as record:
+        headers, data_rows = read_table(page_source, max_rows=max_rows, stop_at=stop_at_known_date(known_date, "%b %d, %Y"))
+        record.add(rows=len(data_rows))
 
-    data_rows = []
-    for row in table.find_all('tr')[1:11]:
-        data = [td.text.strip() for td in row.find_all('td')]
-        data_rows.append(data)
+    headers = [header[:6].replace("*","").strip() for header in headers]
     
     data = pd.DataFrame(data_rows,columns=headers)
 
     data = data[['Date','Close','Volume']] # Get the only columns we want
 
-    data['Date'] = pd.to_datetime(data['Date'],format="%b %d, %Y").dt.strftime('%Y-%m-%d')
-
-    data.iloc[:,1:] = data.iloc[:,1:].map(lambda x: pd.to_numeric(x, errors='ignore'))
-
-    data.rename(columns={'Date': 'Market Date'}, inplace=True)
-    data.rename(columns={'Close': 'Close Price'}, inplace=True)
-
-    data.loc[:,'Close Price'] = data.loc[:,'Close Price'].apply(lambda x: f"${x}")
-
-    return data
-
-def scrape_all_data(stock_tickers):
+    data = data.rename(columns={'Date': 'Market Date', 'Close': 'Close Price'})
+
+    with stage("normalize", table="yahoo"):
+        data = normalize_table(data, date_format="%b %d, %Y")
+
+    # Dividend and split rows span the price columns and have no close price or volume
+    return data.dropna(subset=['Close Price', 'Volume']).reset_index(drop=True)
+
+def yahoo_history_url(stock_ticker, start, end):
+    '''URL of the Yahoo history page covering start to end (inclusive) through the period1/period2 query parameters'''
+    period1 = int(pd.Timestamp(start, tz="UTC").timestamp())
+    period2 = int((pd.Timestamp(end, tz="UTC") + pd.Timedelta(days=1)).timestamp())
+    return f"{YAHOO_BASE_URL}/quote/{stock_ticker}/history?period1={period1}&period2={period2}"
+
+def scrape_yahoo_history(fetcher, stock_ticker, start, end):
+    '''Scrapes every daily row Yahoo has for the ticker between start and end. Returns the DataFrame'''
+    page_source = fetch_page(fetcher, yahoo_history_url(stock_ticker, start, end), "yahoo", stock_ticker)
+    return parse_yahoo_table(page_source)
+
+# Table IDs scraped from each Fintel ticker page, keyed by the name used in the data dictionary
+FINTEL_TABLES = {
+    "finra_data": "short-sale-volume-finra-table",
+    "combined_data": "short-sale-volume-combined-table",
+    "historical_data": "short-interest-nasdaq-table",
+}
+
+def scrape_fintel_ticker(fetcher, stock_ticker, data, watermarks=None):
+    """Scrapes every Fintel table for one ticker with the given fetcher and stores them in data[stock_ticker]
+    If watermarks are given only the rows newer than the stored ones are scraped."""
+    printb(f"Scraping Fintel data for {stock_ticker}...")
+    known_dates = {table_name: get_watermark(watermarks, stock_ticker, data_key)
+                   for data_key, table_name in FINTEL_TABLES.items()} if watermarks else None
+    tables = scrape_fintel_tables(fetcher, stock_ticker, list(FINTEL_TABLES.values()), known_dates)
+    for data_key, table_name in FINTEL_TABLES.items():
+        data[stock_ticker][data_key] = tables[table_name]
+    printg(f"[+] Scraped Fintel data for {stock_ticker}!")
+
+def scrape_yahoo_ticker(fetcher, stock_ticker, data, watermarks=None):
+    """Scrapes the Yahoo history table for one ticker with the given fetcher and stores it in data[stock_ticker]
+    If watermarks are given only the rows newer than the stored ones are scraped."""
+    printb(f"Scraping Yahoo data for {stock_ticker}...")
+    known_date = get_watermark(watermarks, stock_ticker, "yahoo_data") if watermarks else None
+    data[stock_ticker]["yahoo_data"] = scrape_yahoo_data(fetcher, stock_ticker, known_date)
+    printg(f"[+] Scraped Yahoo data for {stock_ticker}!")
+
+def scrape_yahoo_history_ticker(fetcher, stock_ticker, data, start, end):
+    """Scrapes the full Yahoo history between start and end for one ticker and stores it in data[stock_ticker]"""
+    printb(f"Scraping Yahoo history from {start} to {end} for {stock_ticker}...")
+    data[stock_ticker]["yahoo_data"] = scrape_yahoo_history(fetcher, stock_ticker, start, end)
+    printg(f"[+] Scraped {len(data[stock_ticker]['yahoo_data'])} days of Yahoo history for {stock_ticker}!")
+
+def run_driver_worker(create_fetcher, scrape_ticker, jobs, data, retries=2, failures=None):
+    """Worker loop for the scraping pool. Owns a single fetcher (WebDriver or HTTP session) for its whole life and
+    pulls (ticker, attempt) jobs off the shared job queue until it is empty, so each session scrapes its tickers in order.
+    A ticker that fails goes to the back of the queue so it does not hold up the others, and after retries more
+    failed attempts its last error is stored in failures[ticker]."""
+    fetcher = create_fetcher()
+    try:
+        while True:
+            try:
+                stock_ticker, attempt = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                scrape_ticker(fetcher, stock_ticker, data)
+            except Exception as e:
+                # Whatever goes wrong with one ticker (page load, parsing, a broken driver) must not end the session
+                # for the others, the error is retried and then reported with the ticker
+                if attempt < retries:
+                    printr(f"[!] Scraping {stock_ticker} failed ({type(e).__name__}: {e}), retrying after the other tickers")
+                    count("retries", stage="scrape", ticker=stock_ticker)
+                    jobs.put((stock_ticker, attempt + 1))
+                elif failures is not None:
+                    failures[stock_ticker] = e
+                else:
+                    raise
+    finally:
+        fetcher.quit()
+
+def scheduled(create_fetcher, scheduler, priority):
+    """Wraps a fetcher factory so every fetcher it creates waits its turn on the scheduler before each page load"""
+    def create_scheduled_fetcher():
+        return ScheduledFetcher(create_fetcher(), scheduler, priority)
+    return create_scheduled_fetcher
+
+def caching(create_fetcher, cache, bypass=False):
+    """Wraps a fetcher factory so every fetcher it creates serves pages from the cache and only creates the real
+    fetcher once a page is not cached"""
+    def create_caching_fetcher():
+        return CachingFetcher(create_fetcher, cache, bypass)
+    return create_caching_fetcher
+
+def recording(create_fetcher, pages_dir):
+    """Wraps a fetcher factory so every fetcher it creates saves the pages it loads to pages_dir"""
+    from replay import RecordingFetcher
+
+    def create_recording_fetcher():
+        return RecordingFetcher(create_fetcher(), pages_dir)
+    return create_recording_fetcher
+
+def scrape_all_data(stock_tickers, fintel_sessions=1, yahoo_sessions=1, max_workers=None, backend="selenium", watermarks=None,
+                    yahoo_period=None, requests_per_second=None, record_dir=None, priority=PRIORITY_DAILY, bypass_cache=False):
     """ Wrapper function for scrapers from different sources for logic abstraction
+        Scrapes every ticker's Fintel and Yahoo pages through pools of fintel_sessions and yahoo_sessions sessions.
+        Tickers whose pages keep failing are left out.
         Returns a dictionary of dataframes with all the scraped data organized by source and stock ticker
     """
-    data = {}
+    from page_policy import PAGE_TIMEOUTS
+    from fetchers import SeleniumFetcher, HttpFetcher, create_http_session
+
+    data = {stock_ticker: {} for stock_ticker in stock_tickers}
 
-    # Login to Fintel
-    printb("Logging into Fintel...")
     username = "" # Removed for demo
     password = "" # Removed for demo
-    fintel_driver = login_to_fintel(username, password)
 
+    # Never open more sessions than there are tickers, and keep the pool under the concurrency cap
+    fintel_sessions = max(1, min(fintel_sessions, len(stock_tickers)))
+    yahoo_sessions = max(1, min(yahoo_sessions, len(stock_tickers)))
+    if max_workers is not None and fintel_sessions + yahoo_sessions > max_workers:
+        fintel_sessions = max(1, max_workers * fintel_sessions // (fintel_sessions + yahoo_sessions))
+        yahoo_sessions = max(1, max_workers - fintel_sessions)
+
+    failures = {}
+    fintel_jobs = queue.Queue()
+    yahoo_jobs = queue.Queue()
     for stock_ticker in stock_tickers:
+        fintel_jobs.put((stock_ticker, 0))
+        yahoo_jobs.put((stock_ticker, 0))
+
+    # Log in at most once (or not at all if the stored session is still valid) and share the cookies with every session.
+    # Only done once a page is not in the page cache
+    cookies = []
+    cookies_lock = threading.Lock()
 
-        printb(f"Scraping Fintel data for {stock_ticker}...")
-        data[stock_ticker] = {}
+    def fintel_cookies():
+        with cookies_lock:
+            if not cookies:
+                cookies.append(get_fintel_cookies(username, password))
+            return cookies[0]
 
-        # Scrape data from Fintel
-        finra_table_title = "short-sale-volume-finra-table"
-        combined_table_title = "short-sale-volume-combined-table"
-        historical_table_title = "short-interest-nasdaq-table"
+    # Browsers are started on first use, reused by the sessions that need one and recycled as they grow
+    fintel_drivers = DriverPool(lambda: load_fintel_driver(fintel_cookies()), "fintel")
+    yahoo_drivers = DriverPool(create_yahoo_driver, "yahoo")
 
-        printb("Scraping FINRA data...")
-        short_interest_finra_data = scrape_fintel_data(fintel_driver, stock_ticker, finra_table_title)
-        data[stock_ticker]["finra_data"] = short_interest_finra_data
-        printg("[+] Scraped!")
+    def create_fintel_driver_fetcher():
+        return SeleniumFetcher(fintel_drivers.acquire(), timeouts=PAGE_TIMEOUTS, pool=fintel_drivers)
 
-        printb("Scraping Combined data...")
-        short_interest_combined_data = scrape_fintel_data(fintel_driver, stock_ticker, combined_table_title)
-        data[stock_ticker]["combined_data"] = short_interest_combined_data
-        printg("[+] Scraped!")
+    def create_yahoo_driver_fetcher():
+        return SeleniumFetcher(yahoo_drivers.acquire(), timeouts=PAGE_TIMEOUTS, pool=yahoo_drivers)
 
-        printb("Scraping Historical data...")
-        short_interest_historical_data = scrape_fintel_data(fintel_driver, stock_ticker, historical_table_title)
-        data[stock_ticker]["historical_data"] = short_interest_historical_data
-        printg("[+] Scraped!")
+    # The HTTP backend reuses the Fintel cookies and only starts a browser for pages whose tables are missing from the raw HTML
+    if backend == "http":
+        def create_fintel_fetcher():
+            return HttpFetcher(create_http_session(fintel_cookies()), create_fallback=create_fintel_driver_fetcher, timeouts=PAGE_TIMEOUTS)
 
-    fintel_driver.quit()
+        def create_yahoo_fetcher():
+            return HttpFetcher(create_http_session(), create_fallback=create_yahoo_driver_fetcher, timeouts=PAGE_TIMEOUTS)
+    else:
+        create_fintel_fetcher = create_fintel_driver_fetcher
+        create_yahoo_fetcher = create_yahoo_driver_fetcher
 
-    yahoo_driver = create_yahoo_driver()
+    if record_dir:
+        create_fintel_fetcher = recording(create_fintel_fetcher, record_dir)
+        create_yahoo_fetcher = recording(create_yahoo_fetcher, record_dir)
 
-    for stock_ticker in stock_tickers:
+    # A requests_per_second limit gets a scheduler of its own that can only be slower than the domain limits, otherwise
+    # every page load shares SCHEDULER
+    scheduler = RequestScheduler(*capped_limits(requests_per_second)) if requests_per_second else SCHEDULER
+    create_fintel_fetcher = scheduled(create_fintel_fetcher, scheduler, priority)
+    create_yahoo_fetcher = scheduled(create_yahoo_fetcher, scheduler, priority)
 
-        printb(f"Scraping Yahoo data for {stock_ticker}...")
-        yahoo_data = scrape_yahoo_data(yahoo_driver,stock_ticker)
-        data[stock_ticker]["yahoo_data"] = yahoo_data
-        printg("[+] Scraped!")
+    # Cached pages skip the scheduler as well, they cost the sites nothing
+    page_cache = PageCache()
+    create_fintel_fetcher = caching(create_fintel_fetcher, page_cache, bypass_cache)
+    create_yahoo_fetcher = caching(create_yahoo_fetcher, page_cache, bypass_cache)
 
-        
-    yahoo_driver.quit()
+    printb(f"Scraping {len(stock_tickers)} tickers with {fintel_sessions} Fintel and {yahoo_sessions} Yahoo session(s)...")
+    try:
+        with ThreadPoolExecutor(max_workers=fintel_sessions + yahoo_sessions) as executor:
+            scrape_fintel = partial(scrape_fintel_ticker, watermarks=watermarks)
+            if yahoo_period:
+                scrape_yahoo = partial(scrape_yahoo_history_ticker, start=yahoo_period[0], end=yahoo_period[1])
+            else:
+                scrape_yahoo = partial(scrape_yahoo_ticker, watermarks=watermarks)
+            workers = [executor.submit(run_driver_worker, create_fintel_fetcher, scrape_fintel, fintel_jobs, data, failures=failures)
+                       for _ in range(fintel_sessions)]
+            workers += [executor.submit(run_driver_worker, create_yahoo_fetcher, scrape_yahoo, yahoo_jobs, data, failures=failures)
+                        for _ in range(yahoo_sessions)]
+            for worker in workers:
+                worker.result() # Re-raise any error hit outside of a ticker's scrape (e.g. starting a session)
+    finally:
+        fintel_drivers.close()
+        yahoo_drivers.close()
+        page_cache.report()
+        page_cache.close()
+
+    # A ticker missing any of its tables is left out of the run, its watermarks stay put so the next run tries again
+    for stock_ticker, error in failures.items():
+        printr(f"[!] Gave up on {stock_ticker}: {type(error).__name__}: {error}")
+        data.pop(stock_ticker, None)
 
     return data
 
 ################ EXCEL FNS ################################################################3
 
+# "in-memory" loads, edits and formats the whole workbook with openpyxl,
+# "streaming" builds the uploaded workbooks with write-only worksheets (see excel_export.py) and falls back to
+# "in-memory" for workbooks with sheets of their own
+EXCEL_EXPORT_MODE = "in-memory"
+
 # Excel Format helper
-from openpyxl.styles import NamedStyle, Font, PatternFill, Alignment
 from datetime import datetime
-def format_workbook(workbook):
-    '''Excel formatting helper for font sizes, colors, etc.'''
+def format_workbook(workbook, sheet_names=None):
+    '''Excel formatting helper for font sizes, colors, etc. Formats the sheet_names sheets, or every sheet if None'''
+    from openpyxl.styles import Font, PatternFill
+
     for sheet in workbook.worksheets:
+        if sheet_names is not None and sheet.title not in sheet_names:
+            continue
+
         # format the ticker
         sheet['A1'].font = Font(size=20, bold=True)
 
@@ -261,11 +510,8 @@ def format_workbook(workbook):
             max_length = 0
             column = col[0].column_letter # Get the column name
             for cell in col:
-                try: # Necessary to avoid error on empty cells
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
+                if len(str(cell.value)) > max_length:
+                    max_length = len(str(cell.value))
             adjusted_width = (max_length + 2) * 1.5
             sheet.column_dimensions[column].width = adjusted_width
             
@@ -277,6 +523,8 @@ def create_excel_sheet(data, sheet_name, stock_ticker, current_workbook=None):
         Takes a data frame, sheet_name, stock ticker and optional current workbook
         Either adds sheet to current_workbook or creates new workbook with the sheet and returns the workbook'''
     
+    from openpyxl import Workbook
+
     printb(f"Creating the {sheet_name} sheet...")
 
     
@@ -297,21 +545,33 @@ def create_excel_sheet(data, sheet_name, stock_ticker, current_workbook=None):
     # Write ticker to top of file
     sheet['A1'] = f'Ticker = {stock_ticker.upper()}'
 
+    # Nothing stored for the sheet yet
+    if data.empty:
+        printb("No rows to add to the sheet.")
+        return workbook
+
     # Write headers to Excel spreadsheet if not already there
     if sheet['A2'].value != 'Market Date':
         write_df_row_to_sheet(data.columns,2,sheet)
 
-    # Write data to Excel spreadsheet unless date already is in the sheet
-    current_dates = [str(date) for date in [cell.value for cell in sheet['A']][2:]]
-    for _, row in data[::-1].iterrows():
-        if row['Market Date'] not in current_dates:
-            # Insert the row at the top of the sheet
-            printg(f"Adding {row['Market Date']} to the sheet...")
-            sheet.insert_rows(3) # insert blank row at 3 
-            
-            write_df_row_to_sheet(row,3,sheet)
-        else:
-            printb(row['Market Date'], "is already in the sheet.")
+    # Read the existing data block once, keyed by date
+    existing_rows = list(sheet.iter_rows(min_row=3, values_only=True))
+    current_dates = {str(row[0]) for row in existing_rows}
+
+    # Keep only rows whose date is not already in the sheet (or earlier in data)
+    market_dates = data['Market Date'].astype(str)
+    new_data = data[~market_dates.isin(current_dates) & ~market_dates.duplicated()]
+    printb(f"{len(data) - len(new_data)} row(s) already in the sheet.")
+
+    if new_data.empty:
+        return workbook
+
+    printg(f"Adding {len(new_data)} row(s) from {new_data['Market Date'].iloc[-1]} to {new_data['Market Date'].iloc[0]} to the sheet...")
+
+    # New rows go on top of the existing ones in the order they were scraped, newest first.
+    # Backfilled dates older than the rows already there go in place by date
+    new_rows = [list(row) for row in new_data.itertuples(index=False, name=None)]
+    write_rows_to_sheet(merge_rows_by_date(new_rows, [list(row) for row in existing_rows]), 3, sheet)
 
     return workbook
 
@@ -332,6 +592,32 @@ def convert_excel_to_binary(excel_data):
 
     return excel_binary
 
+def update_workbook_in_memory(stock_ticker, new_sheets, current_binary=None):
+    '''Loads the current xlsx bytes (if any), adds the new rows of each sheet in {sheet name: DataFrame} with
+    create_excel_sheet, formats the workbook and returns it as xlsx bytes'''
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(io.BytesIO(current_binary)) if current_binary else None
+    for sheet_name, sheet_data in new_sheets.items():
+        with stage("sheet_update", ticker=stock_ticker, sheet=sheet_name):
+            workbook = create_excel_sheet(sheet_data, sheet_name, stock_ticker, workbook)
+    with stage("format", ticker=stock_ticker):
+        # Sheets the user added are left as they are
+        workbook = format_workbook(workbook, list(new_sheets))
+    with stage("serialize", ticker=stock_ticker) as record:
+        excel_data = convert_excel_to_binary(workbook)
+        record.add(bytes=len(excel_data))
+    return excel_data
+
+def write_rows_to_sheet(rows, row_num, sheet):
+    '''Rewrites the block of rows starting at row_num in one pass. Short rows are padded with empty cells so no old values are left behind'''
+    width = max(len(row) for row in rows)
+    for row_offset, row in enumerate(rows):
+        for col_num in range(1, width + 1):
+            val = row[col_num - 1] if col_num <= len(row) else None
+            sheet.cell(row=row_num + row_offset, column=col_num, value=val)
+    return sheet
+
 def write_df_row_to_sheet(row, row_num, sheet):
     '''Function that takes in a dataframe row and openpyxl sheet and writes everything in the row to the row_num in the sheet'''
     for col_num, val in (enumerate(row.tolist(),1)):
@@ -345,6 +631,8 @@ def get_refresh_token(APP_KEY, APP_SECRET):
     '''Initial dropbox authentication. Prompts user to log in, authorize and retrieve authorization code. 
     Then retrieves the access code and refresh token for future use. This method should only be run once, 
     then the refresh token (does not expire) can be used in subsequent calls.'''
+    import dropbox
+    from dropbox import DropboxOAuth2FlowNoRedirect
 
     auth_flow = DropboxOAuth2FlowNoRedirect(APP_KEY, APP_SECRET, token_access_type='offline')
 
@@ -354,11 +642,8 @@ def get_refresh_token(APP_KEY, APP_SECRET):
     print("3. Copy the authorization code.")
     auth_code = input("Enter the authorization code here: ").strip()
 
-    try:
-        oauth_result = auth_flow.finish(auth_code)
-    except Exception as e:
-        print('Error: %s' % (e,))
-        exit(1)
+    # A wrong or expired code raises here, there is nothing to continue with
+    oauth_result = auth_flow.finish(auth_code)
 
     with dropbox.Dropbox(oauth2_access_token=oauth_result.access_token) as dbx:
         print("Successfully set up client!")
@@ -368,223 +653,212 @@ def get_refresh_token(APP_KEY, APP_SECRET):
     print("refresh token:", oauth_result.refresh_token)    
     return oauth_result.refresh_token
 
-def create_dropbox_instance(APP_KEY, APP_SECRET, REFRESH_TOKEN):
-    dbx = DropboxTeam(
-                    app_key = APP_KEY,
-                    app_secret= APP_SECRET,
-                    oauth2_refresh_token= REFRESH_TOKEN
-    )
-    for member in dbx.team_members_list().members:
-        if member.profile.email == "": # email removed for demo
-            my_id = member.profile.team_member_id
-            return dbx.as_user(my_id)
-    return None
-
-def set_correct_path_root(dbx):
-    """Sets the path root to the team root instead of the user root to access a team level Dropbox folder"""
-    # Make an API call to get current account information
-    account_info = dbx.users_get_current_account()
-
-    # Extract the root namespace ID from the response to use team root instead of user root
-    root_namespace_id = account_info.root_info.root_namespace_id
-
-    # Instantiate PathRoot object with correct root id
-    root_path_root = PathRoot.root(root_namespace_id)
-
-    # Instantiate dropbox instance with the correct path root
-    dbx = dbx.with_path_root(root_path_root)
-
-    return dbx
-
-def download_dropbox_file(dbx,file_path):
-    """Takes in a dropbox instance and file path for a file and returns a bytes representation of the dropbox object"""
-    try:
-        _, response = dbx.files_download(file_path)
-        printg(f"Downloaded file at {file_path}")
-        return response.content
-    except:
-        printr(f"No dropbox file found at {file_path}")
-        return None
-    
-def upload_excel_to_dropbox(dbx, excel_data, dropbox_folder_path, dropbox_file_name):
-    try:
+# Team member whose Dropbox the workbooks live in
+DROPBOX_MEMBER_EMAIL = "" # email removed for demo
+
+# The member ID and root namespace ID are resolved once and kept on disk for DROPBOX_IDS_TTL seconds
+DROPBOX_IDS_PATH = os.path.join(STATE_DIR, "dropbox_ids.json")
+DROPBOX_IDS_TTL = 7 * 24 * 60 * 60
+
+# One client per (app key, member, root) for the whole process, all sharing a single connection pool
+_dropbox_clients = {}
+_dropbox_clients_lock = threading.Lock()
+
+def find_team_member_id(dbx_team, email):
+    """Returns the team_member_id of the team member with the given email, following the member list pagination"""
+    result = dbx_team.team_members_list()
+    while True:
+        for member in result.members:
+            if member.profile.email == email:
+                return member.profile.team_member_id
+        if not result.has_more:
+            return None
+        result = dbx_team.team_members_list_continue(result.cursor)
+
+def resolve_dropbox_ids(dbx_team, email, team_root):
+    """Returns {"email", "team_member_id", "root_namespace_id"} from the disk cache, or from the Dropbox API if the
+    cache is missing, expired or for another member"""
+    ids = load_cached_value(DROPBOX_IDS_PATH, DROPBOX_IDS_TTL)
+    if ids and ids["email"] == email and (ids["root_namespace_id"] or not team_root):
+        return ids
+
+    printb("Resolving the Dropbox team member...")
+    ids = {"email": email, "team_member_id": find_team_member_id(dbx_team, email), "root_namespace_id": None}
+    if ids["team_member_id"] is None:
+        return ids
+
+    if team_root:
+        account_info = dbx_team.as_user(ids["team_member_id"]).users_get_current_account()
+        ids["root_namespace_id"] = account_info.root_info.root_namespace_id
+
+    save_cached_value(DROPBOX_IDS_PATH, ids)
+    return ids
+
+def create_dropbox_instance(APP_KEY, APP_SECRET, REFRESH_TOKEN, email=DROPBOX_MEMBER_EMAIL, team_root=False, max_connections=8):
+    """Returns the shared Dropbox client acting as the team member with the given email, or None if there is no such member.
+    With team_root=True the client uses the team root instead of the user root, to reach team level folders.
+    The member and namespace IDs come from the disk cache when possible and the client is created once per process."""
+    import dropbox
+    from dropbox.common import PathRoot
+    from dropbox.dropbox_client import DropboxTeam
+
+    key = (APP_KEY, email, team_root)
+    with _dropbox_clients_lock:
+        if key in _dropbox_clients:
+            return _dropbox_clients[key]
+
+        dbx_team = DropboxTeam(
+                        app_key = APP_KEY,
+                        app_secret= APP_SECRET,
+                        oauth2_refresh_token= REFRESH_TOKEN,
+                        session= dropbox.create_session(max_connections=max_connections)
+        )
+        ids = resolve_dropbox_ids(dbx_team, email, team_root)
+        if ids["team_member_id"] is None:
+            return None
 
-        # Convert Excel to binary
-        excel_binary = convert_excel_to_binary(excel_data)
-        # Set the correct path root for the dbx object
-        # dbx = set_correct_path_root(dbx)
-        # Specify the Dropbox path for the file
-        dropbox_path = f'{dropbox_folder_path}/{dropbox_file_name}'
+        # as_user and with_path_root reuse the team client's connection pool
+        dbx = dbx_team.as_user(ids["team_member_id"])
+        if team_root:
+            dbx = dbx.with_path_root(PathRoot.root(ids["root_namespace_id"]))
 
-        # Upload the Excel file to Dropbox
+        _dropbox_clients[key] = dbx
+        return dbx
 
-        dbx.files_upload(excel_binary, dropbox_path, mode=dropbox.files.WriteMode('overwrite'))
+# Dropbox folder holding one workbook per ticker
+DROPBOX_FOLDER_PATH = '/Short Interest -  & /Automated'
 
-        printg(f'[+] Successfully uploaded Excel file to {dropbox_path}')
-    except AuthError as e:
-        printr(f'Error authenticating with Dropbox: {e}')
-    except ApiError as e:
-        printr(f'Dropbox API error: {e}')
-    except Exception as e:
-        printr(f'An unexpected error occurred: {e}')
+def dropbox_workbook_path(stock_ticker, dropbox_folder=None):
+    """Dropbox path of a ticker's workbook, in DROPBOX_FOLDER_PATH unless another folder is given"""
+    return f"{dropbox_folder or DROPBOX_FOLDER_PATH}/{stock_ticker.upper()}_Short_Interest_Data.xlsx"
 
 ############ EMAIL FNS ##############################################################3
 
-def send_email(receiver_emails, subject, body):
-
-    port = 465  # For SSL
-    email = "" # Removed for demo
-    password = ""  # Application password (removed for demo)
-
-    # Create a secure SSL context
-    context = ssl.create_default_context()
-
-    sender_email = "" # Removed for demo
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465  # For SSL
+SMTP_USERNAME = "" # Removed for demo
+SMTP_PASSWORD = ""  # Application password (removed for demo)
 
-    # Create the MIME object
-    message = MIMEMultipart()
-    message['Subject'] = subject
-    message['From'] = "" + f'<{sender_email}>' # Removed for demo
-    message['To'] = ", ".join(receiver_emails)
+SENDER_NAME = "" # Removed for demo
+SENDER_EMAIL = "" # Removed for demo
 
-    # Attach HTML body
-    html_message = MIMEText(body, 'html')
-    message.attach(html_message)
+def create_mailer():
+    """Returns a Mailer that keeps one authenticated connection to the Gmail SMTP server"""
+    return Mailer(SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD)
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", port, context=context) as server:
-        server.ehlo()
-        server.login(email, password)
-        server.sendmail(sender_email, receiver_emails, message.as_string())
-        server.quit()
+def create_email(receiver_emails, subject, body):
+    """Builds the HTML email message from the configured sender"""
+    return build_message(SENDER_NAME, SENDER_EMAIL, receiver_emails, subject, body)
 
 ########################################################################################
 
-def main():
-
-    # Combine fintel and yahoo data
-    try: 
-        os.system("taskkill /F /IM excel.exe")
-    except:
+def backfill(stock_tickers, start, end, sessions=4, backend="http", requests_per_second=None):
+    """Fills the history store with everything available between start and end for the tickers: the full Yahoo history
+    of the period and every row on the Fintel pages. Scrapes through the parallel session pool within the domain limits
+    of the scheduler, lowered to requests_per_second page loads per site if given, and stores each table with one bulk
+    insert. Its page loads go behind daily scrapes sharing its scheduler (see scheduler.PRIORITY_BACKFILL) but not
+    behind a daily run in another process, which loads pages at the full rate of its own alongside the backfill.
+    The sheets pick the rows up from the store on the next daily run. Returns {ticker: {table: rows added}}"""
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    data = scrape_all_data(stock_tickers, fintel_sessions=sessions, yahoo_sessions=sessions, backend=backend,
+                           yahoo_period=(start, end), requests_per_second=requests_per_second, priority=PRIORITY_BACKFILL)
+    stock_tickers = [ticker for ticker in stock_tickers if ticker in data]
+
+    added = {}
+    with HistoryStore() as store:
+        for ticker in stock_tickers:
+            added[ticker] = {}
+            for table, table_data in data[ticker].items():
+                date_column = store.date_column(table, table_data.columns)
+                if date_column is not None:
+                    table_data = table_data[table_data[date_column].between(start, end)]
+                added[ticker][table] = store.append(ticker, table, table_data)
+                printg(f"[+] {ticker}: stored {added[ticker][table]} new {table} row(s) from {start:%Y-%m-%d} to {end:%Y-%m-%d}")
+    return added
+
+# Rows of each table's stored history shown in the emails
+REPORT_ROWS = 30
+
+# Stored tables the emails are built from
+REPORT_TABLES = ["finra_data", "combined_data", "historical_data", "yahoo_data"]
+
+def merge_ticker_tables(tables):
+    """Joins a ticker's combined Fintel volumes with its Yahoo prices into the table shown in the emails"""
+    return ticker_table(merge_data({"": tables}), "")
+
+def history_metrics(store, stock_tickers, since=None):
+    """Merges the full stored history of the tickers (from since if given) and adds the rolling ASV/V averages and the
+    days to cover. Returns the long format table indexed by (Ticker, Market Date), see merge_engine"""
+    with stage("merge", tickers=len(stock_tickers)) as record:
+        data = {ticker: {table: store.read(ticker, table, since=since) for table in ["combined_data", "yahoo_data"]}
+                for ticker in stock_tickers}
+        merged = add_rolling_ratios(merge_data(data, stock_tickers))
+        historical = long_format({ticker: store.read(ticker, "historical_data") for ticker in stock_tickers}, "Settlement Date")
+        merged = add_days_to_cover(merged, historical)
+        record.add(rows=len(merged))
+    return merged
+
+def close_excel():
+    """Closes Excel on Windows so no workbook is left open while the run works on them"""
+    if os.name != "nt":
+        return
+    if os.system("taskkill /F /IM excel.exe") != 0:
         print("Tried to close excel but wasn't open")
 
-    # Stocks to scrape data from
-    stock_tickers = [""]
-    data = scrape_all_data(stock_tickers)
-
-    # Combine dataframes for formatting the email tables and excel sheets
-
-    for ticker in stock_tickers: 
-
-        merged_df = pd.merge(data[ticker]['combined_data'],data[ticker]['yahoo_data'])
-        
-        # replace empty ASV values with the FINRA volumes
-        merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].replace('',np.nan)
-        merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].fillna(merged_df['Short Volume'])
-        merged_df = merged_df[["Market Date","Close Price","Aggregate Short Volume","Volume"]]
-
-        # Convert ASV and V columns to numeric to divide them 
-        merged_df['Aggregate Short Volume'] = pd.to_numeric(merged_df['Aggregate Short Volume'].str.replace(',',''))
-        merged_df['Volume'] = pd.to_numeric(merged_df['Volume'].str.replace(',',''))
-
-        # Create the ASV/V column
-        merged_df['ASV/V'] = merged_df['Aggregate Short Volume'] / merged_df['Volume']
-        
-        # Fill NaNs with empty string
-        merged_df = merged_df.fillna('')
-
-        # Format percentages and floats
-        merged_df['ASV/V'] = merged_df['ASV/V'].apply(lambda x: f"{x:.2%}" if x != '' else x)
-        merged_df['Aggregate Short Volume'] = merged_df['Aggregate Short Volume'].apply(lambda x: f"{x:,.0f}" if x != '' else x)
-        merged_df['Volume'] = merged_df['Volume'].apply(lambda x: f"{x:,.0f}" if x != '' else x)
-        data[ticker]['merged_data'] = merged_df
-
-    merged_dfs = []
-    historical_dfs = []
-    for ticker in data.keys():
-        merged_dfs.append(data[ticker]["merged_data"])
-        historical_dfs.append(data[ticker]["historical_data"])
-
-    # Set the subject, body and recipients of the email
-        
-    # Set the subject, body and recipients of the email
-    today = data[""]["merged_data"].iloc[0,0]
-    subject = f"  Short Interest Data for {today}"
-    stock_names = {"": "", "": ""}
+def scrape_and_store(stock_tickers, store, watermarks=None, backend=None, record_dir=None, fintel_sessions=1, yahoo_sessions=1,
+                     bypass_cache=False):
+    """Scrapes the tickers (only rows newer than the watermarks if given) and appends everything to the history store.
+    bypass_cache fetches every page again instead of using the pages cached for the trading day.
+    Returns the scraped data, which leaves out the tickers that could not be scraped"""
+    data = scrape_all_data(stock_tickers, fintel_sessions=fintel_sessions, yahoo_sessions=yahoo_sessions, watermarks=watermarks,
+                           backend=backend or SCRAPE_BACKEND, record_dir=record_dir or RECORD_PAGES_DIR, bypass_cache=bypass_cache)
+
+    # Every scraped row goes into the local history store, the emails and excel sheets are views of it
+    for ticker in data:
+        for table, table_data in data[ticker].items():
+            with stage("store", ticker=ticker, table=table) as record:
+                added = store.append(ticker, table, table_data)
+                record.add(rows=added)
+            printb(f"Stored {added} new {table} row(s) for {ticker}")
+    return data
 
-    body = "<html><body>"
-    body += f"""
-                <p>
-                This is a short interest update for ___stock A___ and __stock B___ as of {datetime.now().strftime("%Y-%m-%d %H:%M")}.<br><br>
-                See current short interest data and historical NASDAQ data for each stock in the tables below.
-                The data was sourced from <a href="https://finance.yahoo.com/">Yahoo Finance</a> and <a href="https://fintel.io/">Fintel.</a>
-                </p>
-            """
+def load_report_data(store, stock_tickers):
+    """Reads the newest REPORT_ROWS rows of every stored table of the tickers and adds the merged table of each.
+    Returns {ticker: {table: DataFrame}} the way scrape_all_data organizes it"""
+    data = {}
+    for ticker in stock_tickers:
+        data[ticker] = {table: store.read(ticker, table, limit=REPORT_ROWS) for table in REPORT_TABLES}
 
+    # Combine dataframes for formatting the email tables, every ticker in one join
+    with stage("merge", tickers=len(stock_tickers)) as record:
+        merged = merge_data(data, stock_tickers)
+        record.add(rows=len(merged))
     for ticker in stock_tickers:
-        result = ""
-        result += f"<h2>{stock_names[ticker]}</h2>"
-        result += "<h3>Short Interest Data</h3>"
-        result += data[ticker]["merged_data"].to_html(index=False)
-        result += "<br>"
-        result += "<h3>Historical Data</h3>"
-        result += data[ticker]["historical_data"].to_html(index=False)
-        result += "<br><br><br>"
-
-        body += result
-
-    body += "</body></html>"
-    
-    recipients = [""]
-
-    # Send the email
-    send_email(recipients, subject, body)
-    printg(f"[+] Email(s) successfully sent to {','.join(recipients)} at {datetime.now()}")
-
-    email_dict = {}
-
-    for ticker in stock_names.keys():
-        email_dict[ticker] = {}
-        subject = f"{ticker.upper()} Short Interest Data for {today}"
-        body = "<html><body>"
-        body += f"""
-                    <p>
-                    This is a short interest update for {stock_names[ticker]} as of {datetime.now().strftime("%Y-%m-%d %H:%M")}.<br><br>
-                    See current short interest data and historical NASDAQ data for each stock in the tables below.
-                    The data was sourced from <a href="https://finance.yahoo.com/">Yahoo Finance</a> and <a href="https://fintel.io/">Fintel.</a>
-                    </p>
-                """
-
-        result = ""
-        result += f"<h2>{stock_names[ticker]}</h2>"
-        result += "<h3>Short Interest Data</h3>"
-        result += data[ticker]["merged_data"].to_html(index=False)
-        result += "<br>"
-        result += "<h3>Historical Data</h3>"
-        result += data[ticker]["historical_data"].to_html(index=False)
-        result += "<br><br><br>"
-
-        body += result
-
-        body += "</body></html>"
-
-        email_dict[ticker]["subject"] = subject
-        email_dict[ticker]["body"] = body
+        data[ticker]['merged_data'] = ticker_table(merged, ticker)
+    return data
 
-    
-    recipients_ = [""] # Removed for demo
+def build_messages(data, stock_tickers, stock_names, recipients, ticker_recipients):
+    """Builds the email covering every ticker for recipients and one email per ticker for the ticker_recipients of it"""
+    merged_dfs = [data[ticker]["merged_data"] for ticker in stock_tickers]
 
-    recipients_ = [""] # Removed for demo
+    # Set the subject, body and recipients of the email
+    today = max((merged_df["Market Date"].max() for merged_df in merged_dfs if not merged_df.empty), default=pd.Timestamp.now()).strftime("%Y-%m-%d")
+    subject = f"  Short Interest Data for {today}"
 
-    # Send the email
-        
-    send_email(recipients_, email_dict[""]["subject"], email_dict[""]["body"])
-    printg(f"[+] Email(s) successfully sent to {','.join(recipients_)} at {datetime.now()}")
+    # Render each ticker's section once and build every email out of the cached sections
+    renderer = ReportRenderer(data, stock_names)
 
-    send_email(recipients_, email_dict[""]["subject"], email_dict[""]["body"])
-    printg(f"[+] Email(s) successfully sent to {','.join(recipients_)} at {datetime.now()}")
+    # Queue the email
+    messages = [create_email(recipients, subject, renderer.body(stock_tickers))]
 
-    # Update and Upload File to Dropbox 
+    # Tickers that could not be scraped get no email of their own
+    for ticker in stock_tickers:
+        if ticker_recipients.get(ticker):
+            messages.append(create_email(ticker_recipients[ticker], f"{ticker.upper()} Short Interest Data for {today}", renderer.body([ticker])))
+    return messages
 
+def connect_dropbox():
+    """Returns the shared Dropbox client of the team member the workbooks belong to"""
     APP_KEY = "" # Removed for demo
     APP_SECRET = "" # Removed for demo
     
@@ -592,39 +866,157 @@ def main():
     # REFRESH_TOKEN = get_refresh_token(APP_KEY,APP_SECRET)
     REFRESH_TOKEN = "" # Removed for demo
 
-    # Create the Dropbox instance
-    dbx = create_dropbox_instance(APP_KEY, APP_SECRET, REFRESH_TOKEN)
+    return create_dropbox_instance(APP_KEY, APP_SECRET, REFRESH_TOKEN)
+
+def create_sync_cache():
+    """Returns the local cache of the synced Dropbox workbooks"""
+    from dropbox_sync import DropboxSyncCache
+    return DropboxSyncCache()
+
+def workbook_sheets(store, stock_ticker):
+    """The sheets of a ticker's workbook built from the full stored history"""
+    return {
+        "finra-table": to_sheet_values(store.read(stock_ticker, "finra_data")),
+        "combined-table": to_sheet_values(store.read(stock_ticker, "combined_data")),
+    }
+
+def workbook_transform():
+    """The function that builds a workbook's new xlsx bytes, see EXCEL_EXPORT_MODE"""
+    from excel_export import export_ticker_workbook
+    if EXCEL_EXPORT_MODE == "streaming":
+        return partial(export_ticker_workbook, fallback=update_workbook_in_memory)
+    return update_workbook_in_memory
+
+def sync_dropbox_workbooks(store, stock_tickers, dropbox_folder=None, built=None, on_built=None):
+    """Brings every ticker's Dropbox workbook up to date with the store.
+    built and on_built are passed on to sync_workbooks. Returns the sync_workbooks results keyed by ticker"""
+    from dropbox_sync import sync_workbooks
+
+    dbx = connect_dropbox()
+    sync_cache = create_sync_cache()
+
+    # The sheets hold the full stored history, rows the workbook already has are left as they are
+    jobs = {stock_ticker: (dropbox_workbook_path(stock_ticker, dropbox_folder), workbook_sheets(store, stock_ticker))
+            for stock_ticker in stock_tickers}
+
+    # Download every workbook at once, rebuild them in a process pool and upload each over the revision it was built from
+    return sync_workbooks(dbx, sync_cache, jobs, workbook_transform(), built=built, on_built=on_built)
+
+def export_local_workbooks(store, stock_tickers, excel_dir):
+    """Writes every ticker's workbook from the store to excel_dir, adding to the file already there if any.
+    Returns the paths written"""
+    transform = workbook_transform()
+    os.makedirs(excel_dir, exist_ok=True)
+    paths = []
     for stock_ticker in stock_tickers:
-        # Dropbox Authentication and Parameters
-        dropbox_folder_path = '/Short Interest -  & /Automated'
-        dropbox_file_name = f"{stock_ticker.upper()}_Short_Interest_Data.xlsx"
-        dropbox_file_path = f"{dropbox_folder_path}/{dropbox_file_name}"
-
-
-
-        # Download the existing sheet from Dropbox in binary form
-        dbx_workbook = download_dropbox_file(dbx,dropbox_file_path)
-
-        # Convert the downloaded binary data to an Excel workbook
-        if dbx_workbook:
-            dbx_workbook = openpyxl.load_workbook(io.BytesIO(dbx_workbook))
+        path = os.path.join(excel_dir, dropbox_workbook_path(stock_ticker).rsplit("/", 1)[-1])
+        current_binary = None
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                current_binary = f.read()
+        excel_data = transform(stock_ticker, workbook_sheets(store, stock_ticker), current_binary)
+        with open(path, "wb") as f:
+            f.write(excel_data)
+        printg(f"[+] Wrote {path}")
+        paths.append(path)
+    return paths
+
+def report_metrics():
+    """Prints and exports the timings and counts of every stage of the run, for dashboards and for finding slow tickers"""
+    METRICS.summary()
+    METRICS.write_json_lines(METRICS_JSONL_PATH)
+    METRICS.write_prometheus(METRICS_PROM_PATH)
+
+def main(stock_tickers=None, stock_names=None, config=None):
+    """The daily job: scrapes the new rows, stores them, emails the reports and syncs the Dropbox workbooks.
+    Tickers, names and recipients come from the config (see config.py), stock_tickers and stock_names override it.
+    Every finished stage is checkpointed, so after a crash or a failed upload the next run only redoes what is left"""
+    config = config or DEFAULT_CONFIG
+    close_excel()
 
-        # Clean up data being added to tables 
-        finra_data = data[stock_ticker]["finra_data"]
-        combined_data = data[stock_ticker]["combined_data"]
-
-        finra_data.iloc[:,1:] = finra_data.iloc[:,1:].map(lambda a: pd.to_numeric(a.replace(",","")))
-        combined_data.iloc[:,1:] = combined_data.iloc[:,1:].map(lambda a: pd.to_numeric(a.replace(",","")))
-        
-        workbook = create_excel_sheet(finra_data, "finra-table", stock_ticker, dbx_workbook)
-
-        workbook = create_excel_sheet(combined_data, "combined-table", stock_ticker, dbx_workbook)
-
-        workbook = format_workbook(workbook)
+    # Stocks to scrape data from
+    stock_tickers = stock_tickers or config["tickers"]
+    stock_names = stock_names or config["stock_names"]
+    METRICS.reset()
 
-        # Upload the Excel sheet to Dropbox directly from memory
-        upload_excel_to_dropbox(dbx, workbook, dropbox_folder_path, dropbox_file_name)
+    # The metrics are exported however the run ends, no-op nights and crashes included
+    outcome = "failed"
+    try:
+        # Only scrape the rows newer than what previous runs already stored
+        watermarks = load_watermarks()
+        store = HistoryStore()
+        checkpoint = RunCheckpoint()
+
+        # Tickers scraped by an unfinished earlier run are taken from its checkpoint, their rows are already stored
+        data = {ticker: checkpoint.load(ticker, "scrape") for ticker in stock_tickers if checkpoint.done(ticker, "scrape")}
+        scraped = scrape_and_store([ticker for ticker in stock_tickers if ticker not in data], store, watermarks, config["backend"],
+                                   config["record_pages_dir"], config["fintel_sessions"], config["yahoo_sessions"],
+                                   config["bypass_page_cache"])
+        for ticker, ticker_data in scraped.items():
+            checkpoint.save(ticker, "scrape", ticker_data)
+        data.update(scraped)
+        stock_tickers = [ticker for ticker in stock_tickers if ticker in data]
+
+        if all(data[ticker][table].empty for ticker in stock_tickers for table in data[ticker]):
+            printg("[+] No new rows since the last run, nothing to do")
+            outcome = "no_new_rows"
+            checkpoint.clear()
+            store.close()
+            return
+
+        # The rendered emails are checkpointed until sent, a resumed run only resends the ones that failed
+        messages = []
+        if not checkpoint.done(None, "email_sent"):
+            if checkpoint.done(None, "emails"):
+                messages = checkpoint.load(None, "emails")
+            else:
+                messages = build_messages(load_report_data(store, stock_tickers), stock_tickers, stock_names,
+                                          config["recipients"], config["ticker_recipients"])
+                checkpoint.save(None, "emails", messages)
+
+        # Send every email over one connection in the background while the Dropbox stage runs
+        email_delivery = create_mailer().send_all_async(messages)
+
+        # Update and Upload File to Dropbox, skipping the tickers an earlier run already uploaded
+        # Workbooks built by an earlier run go straight to the upload
+        sync_tickers = [ticker for ticker in stock_tickers if not checkpoint.done(ticker, "upload")]
+        built = {ticker: checkpoint.load(ticker, "workbook") for ticker in sync_tickers if checkpoint.done(ticker, "workbook")}
+        results = sync_dropbox_workbooks(store, sync_tickers, config["dropbox_folder"], built=built,
+                                         on_built=lambda ticker, excel_data, rev: checkpoint.save(ticker, "workbook", (excel_data, rev)))
+        for stock_ticker, result in results.items():
+            if result["error"] is None:
+                checkpoint.save(stock_ticker, "upload", result["rev"])
+            elif result["stage"] == "upload":
+                # Rebuild from a fresh download next time, the rev it was built from may be stale
+                checkpoint.discard(stock_ticker, "workbook")
+        uploaded_tickers = [stock_ticker for stock_ticker in stock_tickers if checkpoint.done(stock_ticker, "upload")]
+
+        failed_emails = email_delivery.result()
+        printg(f"[+] {len(messages) - len(failed_emails)} of {len(messages)} email(s) sent at {datetime.now()}")
+        if failed_emails:
+            checkpoint.save(None, "emails", [message for message, _ in failed_emails])
+        else:
+            checkpoint.save(None, "email_sent", True)
+
+        # Everything scraped this run has been emailed and stored, move the watermarks forward
+        # Tickers whose upload failed keep their old watermarks so the next run picks their rows up again
+        for stock_ticker in uploaded_tickers:
+            for table, table_data in data[stock_ticker].items():
+                update_watermark(watermarks, stock_ticker, table, table_data)
+        save_watermarks(watermarks)
+        store.close()
+
+        if not failed_emails and len(uploaded_tickers) == len(stock_tickers):
+            outcome = "complete"
+            checkpoint.clear()
+        else:
+            outcome = "incomplete"
+            printr("[!] The run did not finish, the next run resumes it from the checkpoint")
+    finally:
+        count("runs", outcome=outcome)
+        report_metrics()
 
-# Call the main function if the script is run directly
+# Call the main function if the script is run directly, see cli.py for the other jobs
 if __name__ == "__main__":
-    main()
+    import cli
+    cli.run(sys.argv[1:])
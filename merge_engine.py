@@ -0,0 +1,124 @@
+# Batched join of the Fintel short volumes with the Yahoo prices for every ticker at once, and rolling metrics over it
+import numpy as np
+import pandas as pd
+
+# Columns of the merged table next to its (Ticker, Market Date) index
+MERGED_COLUMNS = ["Close Price", "Aggregate Short Volume", "Volume", "ASV/V"]
+
+# Trading days averaged by the rolling ASV/V columns, and by the volume days to cover is measured against
+ROLLING_WINDOWS = [5, 20, 60]
+DAYS_TO_COVER_WINDOW = 20
+
+def empty_merged():
+    return pd.DataFrame({column: pd.Series(dtype="Float64") for column in MERGED_COLUMNS},
+                        index=pd.MultiIndex.from_arrays([[], pd.DatetimeIndex([])], names=["Ticker", "Market Date"]))
+
+def long_format(tables, date_column):
+    '''Stacks {ticker: DataFrame} into one frame indexed by (Ticker, date_column), sorted by ticker and oldest first
+    within each ticker. Rows without a date and empty tables are left out, a date listed twice keeps its last row'''
+    tables = {ticker: table for ticker, table in tables.items() if not table.empty}
+    if not tables:
+        return pd.DataFrame(index=pd.MultiIndex.from_arrays([[], pd.DatetimeIndex([])], names=["Ticker", date_column]))
+
+    # One concat and one sort over plain arrays instead of a keyed concat and a MultiIndex sort
+    tickers = sorted(tables)
+    data = pd.concat([tables[ticker] for ticker in tickers], ignore_index=True)
+    codes = np.repeat(np.arange(len(tickers)), [len(tables[ticker]) for ticker in tickers])
+    dates = data[date_column].to_numpy()
+    order = np.lexsort((dates, codes))
+    order = order[~np.isnat(dates[order])]
+
+    # The stable sort keeps repeated dates in table order, keep the last of each run
+    codes, dates = codes[order], dates[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (codes[1:] != codes[:-1]) | (dates[1:] != dates[:-1])
+    order, codes, dates = order[last], codes[last], dates[last]
+
+    data = data.drop(columns=date_column).take(order)
+    data.index = pd.MultiIndex.from_arrays([pd.Categorical.from_codes(codes, tickers), dates], names=["Ticker", date_column])
+    return data
+
+def to_nullable(values):
+    '''Float64 array of a float numpy array, NaN becoming missing'''
+    return pd.arrays.FloatingArray(values, np.isnan(values))
+
+def group_positions(index):
+    '''Position of every row within its ticker for a long format index sorted by ticker'''
+    codes = index.codes[0]
+    starts = np.r_[0, np.flatnonzero(codes[1:] != codes[:-1]) + 1]
+    return np.arange(len(codes)) - np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+
+def rolling_mean(values, positions, window, min_periods):
+    '''Mean of the last window values of each row's ticker, skipping missing values and missing where fewer than
+    min_periods are present. Uses running sums over the whole column instead of one rolling window per ticker'''
+    values = np.asarray(values, dtype="float64")
+    present = ~np.isnan(values)
+    sums = np.r_[0, np.cumsum(np.where(present, values, 0))]
+    counts = np.r_[0, np.cumsum(present)]
+    end = np.arange(1, len(values) + 1)
+    start = end - np.minimum(positions + 1, window)
+    window_counts = counts[end] - counts[start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (sums[end] - sums[start]) / window_counts
+    return np.where(window_counts >= min_periods, means, np.nan)
+
+def merge_tables(combined, yahoo):
+    '''Joins the long format combined Fintel volumes with the long format Yahoo prices on (Ticker, Market Date), fills
+    missing Aggregate Short Volume from the FINRA Short Volume and adds ASV/V, for every ticker in one pass.
+    Returns the MERGED_COLUMNS for the days both sources have'''
+    if combined.empty or yahoo.empty:
+        return empty_merged()
+
+    merged = combined[["Short Volume", "Aggregate Short Volume"]].join(yahoo[["Close Price", "Volume"]], how="inner")
+    merged["Aggregate Short Volume"] = merged["Aggregate Short Volume"].fillna(merged["Short Volume"])
+    merged["ASV/V"] = merged["Aggregate Short Volume"] / merged["Volume"]
+    return merged[MERGED_COLUMNS]
+
+def add_rolling_ratios(merged, windows=ROLLING_WINDOWS):
+    '''Adds an "ASV/V {n}d" column per window: the mean ASV/V of each ticker's last n trading days, missing until a
+    ticker has n days. Returns merged'''
+    positions = group_positions(merged.index)
+    ratios = merged["ASV/V"].to_numpy(dtype="float64", na_value=np.nan)
+    for window in windows:
+        means = rolling_mean(ratios, positions, window, min_periods=window)
+        merged[f"ASV/V {window}d"] = to_nullable(means)
+    return merged
+
+def add_days_to_cover(merged, historical, window=DAYS_TO_COVER_WINDOW):
+    '''Adds "Short Interest" (the latest one settled on or before each day) and "Days To Cover" (that short interest
+    over the ticker's mean daily volume of the last window trading days) from the long format short interest table
+    indexed by (Ticker, Settlement Date). Returns merged'''
+    if historical.empty or merged.empty:
+        merged["Short Interest"] = pd.Series(pd.NA, index=merged.index, dtype="Float64")
+        merged["Days To Cover"] = pd.Series(pd.NA, index=merged.index, dtype="Float64")
+        return merged
+
+    short_interest = historical["Short Interest"].astype("float64").reset_index()
+    short_interest["Ticker"] = short_interest["Ticker"].astype(str)
+    days = merged.index.to_frame(index=False)
+    days["Ticker"] = days["Ticker"].astype(str)
+    days["row"] = np.arange(len(days))
+    aligned = pd.merge_asof(days.sort_values("Market Date"), short_interest.sort_values("Settlement Date"),
+                            left_on="Market Date", right_on="Settlement Date", by="Ticker")
+    aligned = aligned.sort_values("row")["Short Interest"].to_numpy(dtype="float64")
+
+    volume = rolling_mean(merged["Volume"].to_numpy(dtype="float64", na_value=np.nan), group_positions(merged.index),
+                          window, min_periods=1)
+    merged["Short Interest"] = to_nullable(aligned)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        merged["Days To Cover"] = to_nullable(aligned / volume)
+    return merged
+
+def merge_data(data, tickers=None):
+    '''Merges the tables of data ({ticker: {table: DataFrame}} as scrape_all_data and HistoryStore reads organize it)
+    for the tickers (all of them if None). Returns the long format merged table'''
+    tickers = list(data) if tickers is None else tickers
+    combined = long_format({ticker: data[ticker]["combined_data"] for ticker in tickers}, "Market Date")
+    yahoo = long_format({ticker: data[ticker]["yahoo_data"] for ticker in tickers}, "Market Date")
+    return merge_tables(combined, yahoo)
+
+def ticker_table(merged, ticker, columns=MERGED_COLUMNS):
+    '''One ticker's rows of a long format table the way the emails show them: Market Date as the first column, newest first'''
+    if ticker not in merged.index.get_level_values("Ticker"):
+        return empty_merged().reindex(columns=columns).reset_index(level="Ticker", drop=True).reset_index()
+    return merged.xs(ticker, level="Ticker")[columns].sort_index(ascending=False).reset_index()
@@ -0,0 +1,161 @@
+# Per stage timings and counts of a run, exported as JSON lines and Prometheus text
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from local_state import STATE_DIR
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+METRICS_JSONL_PATH = os.path.join(STATE_DIR, "metrics.jsonl")
+METRICS_PROM_PATH = os.path.join(STATE_DIR, "metrics.prom")
+
+# Prefix of every exported Prometheus metric
+PROMETHEUS_PREFIX = "short_interest"
+
+class StageRecord:
+    '''Counts (rows, bytes, ...) attached to one timed stage, filled in by the code inside the stage'''
+
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+class Metrics:
+    '''Collects one event per timed stage (login, page_load, parse, normalize, merge, sheet_update, format, serialize,
+    upload, email, ...) with its labels, duration, outcome and counts, plus standalone counters such as retries.
+    Safe to share between threads. Events from other processes can be merged in with extend.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Drops the recorded events and starts a new run id'''
+        with self.lock:
+            self.run_id = uuid.uuid4().hex[:12]
+            self.events = []
+
+    def _append(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def extend(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        '''Times the with block as one run of the stage. Yields a StageRecord for counts, a raised error marks it failed'''
+        record = StageRecord()
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield record
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self._append({"run": self.run_id, "time": time.time(), "stage": name, "labels": labels,
+                          "seconds": time.perf_counter() - start, "ok": ok, "counts": record.counts})
+
+    def timed(self, name, **labels):
+        '''Decorator form of stage for functions that are one stage as a whole'''
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1, **labels):
+        '''Records a counter increment outside of a timed stage, e.g. count("retries", stage="email")'''
+        self._append({"run": self.run_id, "time": time.time(), "counter": name, "labels": labels, "value": value})
+
+    def to_json_lines(self):
+        with self.lock:
+            return "".join(json.dumps(event, default=str, sort_keys=True) + "\n" for event in self.events)
+
+    def write_json_lines(self, path=METRICS_JSONL_PATH):
+        '''Appends this run's events to a JSON lines file'''
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(self.to_json_lines())
+
+    def to_prometheus(self):
+        '''Prometheus text exposition of the run: per stage (and label set) totals of seconds, runs, failures and counts,
+        and the standalone counters'''
+        totals = defaultdict(float)
+        with self.lock:
+            events = list(self.events)
+
+        for event in events:
+            labels = tuple(sorted(event["labels"].items()))
+            if "counter" in event:
+                totals[(f"{event['counter']}_total", labels)] += event["value"]
+                continue
+            labels = (("stage", event["stage"]),) + labels
+            totals[("stage_seconds_total", labels)] += event["seconds"]
+            totals[("stage_runs_total", labels)] += 1
+            totals[("stage_failures_total", labels)] += 0 if event["ok"] else 1
+            for name, value in event["counts"].items():
+                totals[(f"stage_{name}_total", labels)] += value
+
+        lines = []
+        for metric in sorted({metric for metric, _ in totals}):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} counter")
+            for (name, labels), value in sorted(totals.items()):
+                if name != metric:
+                    continue
+                label_text = ",".join(f'{key}="{escape_label(label_value)}"' for key, label_value in labels)
+                lines.append(f"{PROMETHEUS_PREFIX}_{metric}{{{label_text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=METRICS_PROM_PATH):
+        '''Writes the Prometheus text to path in one step, for the node exporter textfile collector'''
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def summary(self, top=10):
+        '''Prints the total time of each stage and the slowest single stage runs'''
+        with self.lock:
+            events = [event for event in self.events if "stage" in event]
+
+        by_stage = defaultdict(lambda: [0.0, 0])
+        for event in events:
+            by_stage[event["stage"]][0] += event["seconds"]
+            by_stage[event["stage"]][1] += 1
+        for name, (seconds, runs) in sorted(by_stage.items(), key=lambda item: -item[1][0]):
+            printb(f"{name:<14} {seconds:8.2f} s over {runs} run(s)")
+
+        for event in sorted(events, key=lambda event: -event["seconds"])[:top]:
+            labels = " ".join(f"{key}={value}" for key, value in event["labels"].items())
+            (printb if event["ok"] else printr)(f"slowest: {event['stage']} {labels} {event['seconds']:.2f} s")
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def call_collecting_metrics(parent_pid, fn, *args):
+    '''Calls fn in a worker process and returns (result, events fn recorded there) so the parent can merge them in with
+    METRICS.extend. Returns no events when called in the parent process itself, where they are already recorded.'''
+    start = len(METRICS.events)
+    result = fn(*args)
+    return result, (METRICS.events[start:] if os.getpid() != parent_pid else [])
+
+# Shared by every module of a run
+METRICS = Metrics()
+stage = METRICS.stage
+timed = METRICS.timed
+count = METRICS.count
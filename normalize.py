@@ -0,0 +1,123 @@
+# Typed normalization of scraped tables and display formatting
+import pandas as pd
+
+# Characters stripped from scraped numbers before parsing, e.g. "1,234", "$12.50", "45.1%"
+NUMBER_JUNK = r"[,$%\s]"
+
+# Columns that always hold decimals, typed Float64 even when a batch only has whole numbers or no values at all
+FLOAT_COLUMNS = ["Close Price", "Adj Close", "Open", "High", "Low", "ASV/V"]
+
+def is_date_column(column):
+    return str(column).endswith("Date")
+
+def is_float_column(column):
+    '''Prices and ratios (any column named like a short ratio included)'''
+    return column in FLOAT_COLUMNS or "Ratio" in str(column)
+
+def to_dates(column, date_format=None):
+    '''Parses a column of date strings into datetime64, unparseable dates become NaT'''
+    return pd.to_datetime(column, format=date_format, errors="coerce")
+
+def row_dates(rows):
+    '''Market Dates (the first value) of sheet rows as Timestamps, NaT where they do not parse'''
+    return to_dates(pd.Series([None if row[0] is None else str(row[0]) for row in rows], dtype=object), "mixed")
+
+def merge_rows_by_date(new_rows, existing_rows):
+    '''Merges new sheet rows (lists whose first value is the Market Date) into the existing block, which lists newest
+    first. New rows newer than every existing row go on top as they come, older (backfilled) ones are put in place by
+    date. The existing rows always keep their order. Returns the merged rows'''
+    if not new_rows or not existing_rows:
+        return new_rows + existing_rows
+    new_dates, existing_dates = row_dates(new_rows), row_dates(existing_rows)
+    if existing_dates.isna().all() or not (new_dates <= existing_dates.max()).any():
+        return new_rows + existing_rows
+
+    order = new_dates.sort_values(ascending=False, na_position="last", kind="stable").index
+    pending = [(new_dates[position], new_rows[position]) for position in order]
+    # Whatever is older than every existing row goes under the last dated one, above any empty rows at the bottom
+    last_dated = existing_dates.notna().to_numpy().nonzero()[0][-1] + 1
+    merged = []
+    for date, row in zip(existing_dates[:last_dated], existing_rows[:last_dated]):
+        # Rows without a date are never placed ahead of an existing row
+        while pending and pd.notna(date) and pd.notna(pending[0][0]) and pending[0][0] > date:
+            merged.append(pending.pop(0)[1])
+        merged.append(row)
+    return merged + [row for _, row in pending] + existing_rows[last_dated:]
+
+def to_numbers(column, dtype=None):
+    '''Parses a column of scraped number strings in one vectorized pass.
+    Returns the given nullable dtype, or if None Int64 when every value is a whole number and Float64 otherwise.
+    Returns None if the column is not numeric.'''
+    text = column.astype("string").str.replace(NUMBER_JUNK, "", regex=True)
+    text = text.mask(text == "")
+    numbers = pd.to_numeric(text, errors="coerce")
+
+    # Any value that was there but did not parse means this is a text column
+    if (numbers.isna() & text.notna()).any():
+        return None
+
+    numbers = numbers.astype("Float64")
+    if dtype is not None:
+        return numbers.astype(dtype)
+    if (numbers.dropna() % 1 == 0).all():
+        return numbers.astype("Int64")
+    return numbers
+
+def normalize_table(data, date_format=None):
+    '''Turns a scraped table of strings into typed columns: *Date columns become datetime64, prices and ratios
+    (is_float_column) Float64, other numeric columns Int64 or Float64 by their values, and anything else stays a string.
+    Returns a new DataFrame.'''
+    columns = {}
+    for column in data.columns:
+        if is_date_column(column):
+            columns[column] = to_dates(data[column], date_format)
+            continue
+        numbers = to_numbers(data[column], "Float64" if is_float_column(column) else None)
+        columns[column] = data[column].astype("string") if numbers is None else numbers
+    return pd.DataFrame(columns, index=data.index)
+
+########## DISPLAY FORMATTING ##########
+
+def format_integers(column):
+    return column.map("{:,.0f}".format, na_action="ignore").fillna("")
+
+def format_percentages(column):
+    return column.map("{:.2%}".format, na_action="ignore").fillna("")
+
+def format_prices(column):
+    return column.map("${:,.2f}".format, na_action="ignore").fillna("")
+
+# Columns that are not shown as plain numbers
+DISPLAY_FORMATS = {
+    "Close Price": format_prices,
+    "ASV/V": format_percentages,
+}
+
+def format_for_display(data):
+    '''Formats a normalized table for the emails and reports: dates as YYYY-MM-DD, whole numbers with thousands separators,
+    prices and ratios with their units and missing values as empty strings. Returns a new DataFrame of strings.'''
+    columns = {}
+    for column in data.columns:
+        values = data[column]
+        if column in DISPLAY_FORMATS:
+            columns[column] = DISPLAY_FORMATS[column](values)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            columns[column] = values.dt.strftime("%Y-%m-%d").fillna("")
+        elif pd.api.types.is_integer_dtype(values):
+            columns[column] = format_integers(values)
+        elif pd.api.types.is_float_dtype(values):
+            columns[column] = values.map("{:,.2f}".format, na_action="ignore").fillna("")
+        else:
+            columns[column] = values.fillna("")
+    return pd.DataFrame(columns, index=data.index)
+
+def to_sheet_values(data):
+    '''Converts a normalized table into plain values for the Excel sheets: dates as YYYY-MM-DD strings (as the sheets
+    have always stored them), numbers as numbers and missing values as None. Returns a new DataFrame of objects.'''
+    columns = {}
+    for column in data.columns:
+        values = data[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime("%Y-%m-%d")
+        columns[column] = values.astype(object).where(values.notna(), None)
+    return pd.DataFrame(columns, index=data.index)
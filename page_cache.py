@@ -0,0 +1,138 @@
+# Local cache of scraped page sources keyed by URL and trading day, so reruns during the day skip the sites
+import datetime
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo
+
+from fetchers import has_tables
+from local_state import STATE_DIR
+from metrics import count
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+PAGE_CACHE_PATH = os.path.join(STATE_DIR, "page_cache.sqlite")
+
+# Pages older than this are never served, and the least recently used pages go once the cache is bigger than this
+PAGE_CACHE_TTL = 24 * 60 * 60
+PAGE_CACHE_MAX_BYTES = 200 * 2 ** 20
+
+# FINRA publishes the day's short volumes around 6pm New York time, until then the pages show the day before
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+PUBLICATION_HOUR = 18
+
+def trading_date(now=None):
+    '''The trading day whose data the sites show at now (a timezone aware datetime, default the current time):
+    today from PUBLICATION_HOUR New York time on, before that the day before, and Friday over the weekend.
+    Market holidays are not skipped, they only cost an extra scrape.'''
+    now = (now or datetime.datetime.now(MARKET_TIMEZONE)).astimezone(MARKET_TIMEZONE)
+    day = (now - datetime.timedelta(hours=PUBLICATION_HOUR)).date()
+    while day.weekday() >= 5:
+        day -= datetime.timedelta(days=1)
+    return day.isoformat()
+
+class PageCache:
+    '''SQLite table of zlib compressed page sources keyed by (url, trading date). A page is served for the trading day
+    it was fetched on as long as it is younger than ttl seconds. After each store the least recently used pages are
+    evicted until the cache fits in max_bytes. Counts hits and misses. Safe to share between threads.'''
+
+    def __init__(self, path=PAGE_CACHE_PATH, ttl=PAGE_CACHE_TTL, max_bytes=PAGE_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                url TEXT NOT NULL, trading_date TEXT NOT NULL, stored REAL NOT NULL, used REAL NOT NULL,
+                size INTEGER NOT NULL, body BLOB NOT NULL, PRIMARY KEY (url, trading_date))""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+            self.connection.execute("DELETE FROM pages WHERE stored < ?", (time.time() - ttl,))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, url, day=None):
+        '''Returns the cached page source of url for the trading day (default the current one), or None'''
+        day = day or trading_date()
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT body FROM pages WHERE url = ? AND trading_date = ? AND stored >= ?",
+                                          (url, day, time.time() - self.ttl)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE pages SET used = ? WHERE url = ? AND trading_date = ?", (time.time(), url, day))
+            self.counts["hits" if row is not None else "misses"] += 1
+        count("page_cache_hits" if row is not None else "page_cache_misses", domain=urlsplit(url).netloc)
+        return zlib.decompress(row[0]).decode("utf-8") if row is not None else None
+
+    def put(self, url, page_source, day=None):
+        '''Stores the page source of url for the trading day (default the current one) and evicts what no longer fits'''
+        day = day or trading_date()
+        body = zlib.compress(page_source.encode("utf-8"), 6)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)", (url, day, now, now, len(body), body))
+            self.counts["stored"] += 1
+
+            excess = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0] - self.max_bytes
+            if excess <= 0:
+                return
+            evicted = []
+            for rowid, size in self.connection.execute("SELECT rowid, size FROM pages ORDER BY used"):
+                if excess <= 0:
+                    break
+                evicted.append((rowid,))
+                excess -= size
+            self.connection.executemany("DELETE FROM pages WHERE rowid = ?", evicted)
+            self.counts["evicted"] += len(evicted)
+
+    def stats(self):
+        '''Hits, misses, pages stored and evicted since the cache was opened, and the pages and compressed bytes it holds'''
+        with self.lock:
+            pages, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+            return dict(self.counts, pages=pages, bytes=size)
+
+    def report(self):
+        stats = self.stats()
+        printb(f"Page cache: {stats['hits']} hit(s), {stats['misses']} miss(es), {stats['stored']} stored, "
+               f"{stats['evicted']} evicted, {stats['pages']} page(s) in {stats['bytes'] / 2 ** 20:.1f} MB")
+
+class CachingFetcher:
+    '''Serves pages from a PageCache and only creates the real fetcher (by calling create_fetcher) on the first miss,
+    so a run whose pages are all cached starts no browser and sends no request. Fetched pages that have their tables
+    are stored. With bypass the cache is not read, only refreshed with what is fetched.'''
+
+    def __init__(self, create_fetcher, cache, bypass=False):
+        self.create_fetcher = create_fetcher
+        self.cache = cache
+        self.bypass = bypass
+        self.fetcher = None
+
+    def fetch(self, url, table_ids=None):
+        if not self.bypass:
+            page_source = self.cache.get(url)
+            if page_source is not None and has_tables(page_source, table_ids):
+                return page_source
+
+        if self.fetcher is None:
+            self.fetcher = self.create_fetcher()
+        page_source = self.fetcher.fetch(url, table_ids)
+        if has_tables(page_source, table_ids):
+            self.cache.put(url, page_source)
+        return page_source
+
+    def quit(self):
+        if self.fetcher is not None:
+            self.fetcher.quit()
@@ -0,0 +1,59 @@
+# Page load policy for the browser sessions: eager loading, blocked assets and per domain adaptive timeouts
+import threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# Resources the scrapers never need, blocked through the DevTools protocol before they are requested
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf",
+    "*doubleclick.net*", "*googlesyndication.com*", "*googletagmanager.com*", "*google-analytics.com*",
+    "*adservice.google.com*", "*amazon-adsystem.com*", "*scorecardresearch.com*", "*taboola.com*",
+]
+
+def apply_page_load_policy(chrome_options):
+    '''Makes driver.get return once the DOM is ready instead of after every image and script has loaded,
+    and turns off images in the browser profile. Returns the options'''
+    chrome_options.page_load_strategy = "eager"
+    chrome_options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    return chrome_options
+
+def block_heavy_assets(driver, patterns=BLOCKED_URL_PATTERNS):
+    '''Blocks images, fonts and ad hosts for every later page load of a Chrome driver'''
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(patterns)})
+    return driver
+
+class AdaptiveTimeouts:
+    '''Learns how long pages of each domain take and hands out timeouts from the recent latencies:
+    factor times the given percentile of the last window loads, kept between minimum and maximum seconds.
+    Domains without enough history get the default timeout. Safe to share between threads.'''
+
+    def __init__(self, default=10, minimum=2, maximum=30, percentile=95, factor=2, window=50, min_samples=5):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.factor = factor
+        self.min_samples = min_samples
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, url, seconds):
+        '''Adds the load time of a page that loaded successfully'''
+        with self.lock:
+            self.latencies[urlsplit(url).netloc].append(seconds)
+
+    def timeout(self, url, default=None):
+        '''Seconds to wait for a page of url's domain before giving up on it.
+        default overrides the timeout used while the domain has too little history'''
+        with self.lock:
+            samples = list(self.latencies.get(urlsplit(url).netloc, ()))
+        if len(samples) < self.min_samples:
+            return self.default if default is None else default
+        return float(min(self.maximum, max(self.minimum, self.factor * np.percentile(samples, self.percentile))))
+
+# Shared by every fetcher of the run so all sessions learn from each other's page loads
+PAGE_TIMEOUTS = AdaptiveTimeouts()
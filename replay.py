@@ -0,0 +1,321 @@
+# Local stand-ins for the scraped sites, the Dropbox API and the SMTP server, and a recorder for live pages
+import datetime
+import os
+import socketserver
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+from dropbox.exceptions import ApiError
+from dropbox.files import (FileMetadata, GetMetadataError, DownloadError, UploadError, UploadWriteFailed,
+                           WriteError, WriteConflictError, WriteMode, UploadSessionStartResult,
+                           UploadSessionFinishError)
+from dropbox.files import LookupError as DropboxLookupError
+
+import driver_pool
+from checkpoints import RunCheckpoint
+from dropbox_sync import dropbox_content_hash, DropboxSyncCache
+from history_store import HistoryStore
+from local_state import load_watermarks, save_watermarks
+from mailer import Mailer
+from page_cache import PageCache
+from scheduler import RequestScheduler
+
+def page_file_name(url):
+    '''File name a recorded page is saved under, e.g. https://fintel.io/ss/us/abc -> ss_us_abc.html'''
+    path = urlsplit(url).path.strip("/") or "index"
+    return path.replace("/", "_") + ".html"
+
+def save_page(pages_dir, url, page_source):
+    '''Writes a page source to pages_dir under the name PageServer serves it from'''
+    os.makedirs(pages_dir, exist_ok=True)
+    with open(os.path.join(pages_dir, page_file_name(url)), "w", encoding="utf-8") as f:
+        f.write(page_source)
+
+class RecordingFetcher:
+    '''Wraps a fetcher and saves every page it fetches to pages_dir, so a live run can be replayed with PageServer later'''
+
+    def __init__(self, fetcher, pages_dir):
+        self.fetcher = fetcher
+        self.pages_dir = pages_dir
+
+    def fetch(self, url, table_ids=None):
+        page_source = self.fetcher.fetch(url, table_ids)
+        save_page(self.pages_dir, url, page_source)
+        return page_source
+
+    def quit(self):
+        self.fetcher.quit()
+
+class SimulatedClock:
+    '''Stands in for fetchers.SYSTEM_CLOCK so rate limits, backoff and breaker cooldowns can be measured without waiting:
+    sleep moves the clock forward at once. Sleeps of different threads add up, so measure one thread per clock.'''
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.slept = 0.0
+        self.lock = threading.Lock()
+
+    def now(self):
+        with self.lock:
+            return self.time
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.time += max(0, seconds)
+            self.slept += max(0, seconds)
+        # Let the other threads run as a real sleep would
+        time.sleep(0)
+
+class PageServer:
+    '''Serves recorded page sources from pages_dir over HTTP on localhost so the scrapers can be pointed at it
+    instead of the live sites. Use as a context manager, base_url is set once the server is running.
+    delay is an optional function of the request path returning how many seconds to stall before answering.
+    status is an optional function of the request path returning an HTTP error status (e.g. 429) to answer with
+    instead of the page, or None to serve it.'''
+
+    def __init__(self, pages_dir, port=0, delay=None, status=None):
+        self.pages_dir = pages_dir
+        self.port = port
+        self.delay = delay
+        self.status = status
+        self.base_url = None
+        self.requests = []
+        self.server = None
+
+    def __enter__(self):
+        pages_dir = self.pages_dir
+        requests = self.requests
+        delay = self.delay
+        status = self.status
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                if delay is not None:
+                    time.sleep(delay(self.path))
+                error_status = status(self.path) if status is not None else None
+                if error_status is not None:
+                    self.send_error(error_status)
+                    return
+                file_path = os.path.join(pages_dir, page_file_name(self.path))
+                if not os.path.exists(file_path):
+                    self.send_error(404)
+                    return
+                with open(file_path, "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeDropboxResponse:
+    '''Stands in for the requests.Response files_download returns'''
+
+    def __init__(self, content):
+        self.content = content
+
+class FakeDropbox:
+    '''In-memory stand-in for the dbx.files_* calls the scraper makes. Follows the Dropbox rules for revisions and
+    WriteMode so conflicts can be tested, and counts calls and bytes moved in each direction.'''
+
+    def __init__(self, files=None):
+        self.files = {}
+        self.calls = []
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self._revs = 0
+        self.sessions = {}
+        for path, data in (files or {}).items():
+            self._store(path, data)
+
+    def _store(self, path, data):
+        self._revs += 1
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        metadata = FileMetadata(name=path.rsplit("/", 1)[-1], id=f"id:{abs(hash(path.lower()))}", client_modified=now,
+                                server_modified=now, rev=f"{self._revs:016x}", size=len(data), path_lower=path.lower(),
+                                path_display=path, content_hash=dropbox_content_hash(data))
+        self.files[path.lower()] = (data, metadata)
+        return metadata
+
+    def _not_found(self, path, error_type):
+        return ApiError("fake", error_type.path(DropboxLookupError.not_found), f"{path} not found", "en")
+
+    def files_get_metadata(self, path):
+        self.calls.append(("files_get_metadata", path))
+        if path.lower() not in self.files:
+            raise self._not_found(path, GetMetadataError)
+        return self.files[path.lower()][1]
+
+    def files_download(self, path, rev=None):
+        self.calls.append(("files_download", path))
+        if path.lower() not in self.files:
+            raise self._not_found(path, DownloadError)
+        data, metadata = self.files[path.lower()]
+        self.bytes_downloaded += len(data)
+        return metadata, FakeDropboxResponse(data)
+
+    def files_upload(self, f, path, mode=None, **kwargs):
+        self.calls.append(("files_upload", path))
+        mode = mode or WriteMode.add
+        current = self.files.get(path.lower())
+        conflict = current is not None and (mode.is_add() or mode.is_update() and mode.get_update() != current[1].rev)
+        if conflict:
+            reason = WriteError.conflict(WriteConflictError.file)
+            raise ApiError("fake", UploadError.path(UploadWriteFailed(reason=reason, upload_session_id="")), "conflict", "en")
+
+        self.bytes_uploaded += len(f)
+        return self._store(path, f)
+
+    def files_upload_session_start(self, f, **kwargs):
+        self.calls.append(("files_upload_session_start", None))
+        session_id = f"session{len(self.sessions)}"
+        self.sessions[session_id] = bytearray(f)
+        self.bytes_uploaded += len(f)
+        return UploadSessionStartResult(session_id=session_id)
+
+    def files_upload_session_append_v2(self, f, cursor, **kwargs):
+        self.calls.append(("files_upload_session_append_v2", None))
+        session = self.sessions[cursor.session_id]
+        if cursor.offset != len(session):
+            raise ValueError(f"Upload session {cursor.session_id} is at offset {len(session)}, not {cursor.offset}")
+        session += f
+        self.bytes_uploaded += len(f)
+
+    def files_upload_session_finish(self, f, cursor, commit, **kwargs):
+        self.calls.append(("files_upload_session_finish", commit.path))
+        self.files_upload_session_append_v2(f, cursor)
+        data = bytes(self.sessions.pop(cursor.session_id))
+        self.bytes_uploaded -= len(data)
+        try:
+            return self.files_upload(data, commit.path, mode=commit.mode)
+        except ApiError as e:
+            # The session finish reports the WriteError without the UploadWriteFailed wrapper
+            raise ApiError("fake", UploadSessionFinishError.path(e.error.get_path().reason), "conflict", "en") from None
+
+class SMTPSink:
+    '''Plain SMTP server on localhost that accepts every message and keeps it in messages as (sender, recipients, data).
+    Point a Mailer at it with use_ssl=False and no credentials. Use as a context manager.'''
+
+    def __init__(self, port=0):
+        self.port = port
+        self.host = "127.0.0.1"
+        self.messages = []
+        self.server = None
+
+    def __enter__(self):
+        messages = self.messages
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def handle(self):
+                self.reply("220 localhost SMTPSink")
+                sender, recipients = None, []
+                for line in self.rfile:
+                    command = line.decode("utf-8", "replace").strip()
+                    verb = command[:4].upper()
+                    if verb in ("EHLO", "HELO"):
+                        self.reply("250 localhost")
+                    elif verb == "MAIL":
+                        sender, recipients = command.split(":", 1)[1].strip().strip("<>"), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        lines = []
+                        for data_line in self.rfile:
+                            if data_line.rstrip(b"\r\n") == b".":
+                                break
+                            lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                        messages.append((sender, recipients, b"".join(lines)))
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+class ReplayEnvironment:
+    '''Runs main against local stand-ins: pages from pages_dir through a PageServer, a FakeDropbox holding
+    dropbox_files, an SMTPSink and local state (watermarks, history store, Dropbox cache, metrics, driver pids) under
+    state_dir.
+    The Fintel login is skipped and pages are fetched over HTTP without rate limits. Use as a context manager, main is
+    restored on exit.'''
+
+    def __init__(self, pages_dir, state_dir, dropbox_files=None, delay=None):
+        self.pages = PageServer(pages_dir, delay=delay)
+        self.smtp = SMTPSink()
+        self.dropbox = FakeDropbox(dropbox_files)
+        self.state_dir = state_dir
+        self.saved = {}
+
+    def _patch(self, module, replacements):
+        for name, value in replacements.items():
+            self.saved[module, name] = getattr(module, name)
+            setattr(module, name, value)
+
+    def __enter__(self):
+        import main
+
+        self.pages.__enter__()
+        self.smtp.__enter__()
+        watermarks_path = os.path.join(self.state_dir, "watermarks.json")
+        driver_pids_path = os.path.join(self.state_dir, "driver_pids.json")
+        # Browser processes of a replay must not be recorded next to (or killed as orphans of) the real runs
+        registry = driver_pool.ProcessRegistry(driver_pids_path)
+        self._patch(driver_pool, {"DRIVER_PIDS_PATH": driver_pids_path, "DRIVER_PROCESSES": registry})
+        self._patch(main, {
+            "FINTEL_BASE_URL": self.pages.base_url,
+            "YAHOO_BASE_URL": self.pages.base_url,
+            "SCRAPE_BACKEND": "http",
+            "get_fintel_cookies": lambda *args, **kwargs: [],
+            "create_dropbox_instance": lambda *args, **kwargs: self.dropbox,
+            "create_mailer": lambda: Mailer(self.smtp.host, self.smtp.port, use_ssl=False, retries=0),
+            "load_watermarks": partial(load_watermarks, watermarks_path),
+            "save_watermarks": partial(save_watermarks, path=watermarks_path),
+            "HistoryStore": partial(HistoryStore, os.path.join(self.state_dir, "history.sqlite")),
+            "create_sync_cache": partial(DropboxSyncCache, os.path.join(self.state_dir, "dropbox_cache")),
+            "RunCheckpoint": partial(RunCheckpoint, os.path.join(self.state_dir, "checkpoint")),
+            "SCHEDULER": RequestScheduler(limits={}, default_limit=None),
+            "PageCache": partial(PageCache, os.path.join(self.state_dir, "page_cache.sqlite")),
+            "METRICS_JSONL_PATH": os.path.join(self.state_dir, "metrics.jsonl"),
+            "METRICS_PROM_PATH": os.path.join(self.state_dir, "metrics.prom"),
+            "DriverPool": partial(driver_pool.DriverPool, registry=registry),
+        })
+        return self
+
+    def __exit__(self, *exc):
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+        self.saved.clear()
+        self.smtp.__exit__(*exc)
+        self.pages.__exit__(*exc)
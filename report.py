@@ -0,0 +1,59 @@
+# HTML report rendering for the emails
+from datetime import datetime
+from html import escape
+
+from normalize import format_for_display
+
+INTRO_TEMPLATE = """
+                <p>
+                This is a short interest update for {names} as of {as_of}.<br><br>
+                See current short interest data and historical NASDAQ data for each stock in the tables below.
+                The data was sourced from <a href="https://finance.yahoo.com/">Yahoo Finance</a> and <a href="https://fintel.io/">Fintel.</a>
+                </p>
+            """
+
+def render_table(data):
+    '''Renders a DataFrame of display strings as an HTML table, the same markup DataFrame.to_html(index=False) produces
+    without going through its generic formatter'''
+    parts = ['<table border="1" class="dataframe">\n  <thead>\n    <tr style="text-align: right;">\n']
+    parts += [f"      <th>{escape(str(column), quote=False)}</th>\n" for column in data.columns]
+    parts.append("    </tr>\n  </thead>\n  <tbody>\n")
+    for row in data.itertuples(index=False, name=None):
+        parts.append("    <tr>\n")
+        parts += [f"      <td>{escape(str(val), quote=False)}</td>\n" for val in row]
+        parts.append("    </tr>\n")
+    parts.append("  </tbody>\n</table>")
+    return "".join(parts)
+
+def join_names(names):
+    '''"A", "A and B", "A, B and C"'''
+    names = list(names)
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+
+class ReportRenderer:
+    '''Renders the email section of each ticker once and builds any number of emails out of the cached sections'''
+
+    def __init__(self, data, stock_names, as_of=None):
+        self.data = data
+        self.stock_names = stock_names
+        self.as_of = as_of or datetime.now().strftime("%Y-%m-%d %H:%M")
+        self.fragments = {}
+
+    def fragment(self, ticker):
+        '''The HTML section for one ticker: its short interest table and its historical table'''
+        if ticker not in self.fragments:
+            self.fragments[ticker] = "".join([
+                f"<h2>{self.stock_names[ticker]}</h2>",
+                "<h3>Short Interest Data</h3>",
+                render_table(format_for_display(self.data[ticker]["merged_data"])),
+                "<br>",
+                "<h3>Historical Data</h3>",
+                render_table(format_for_display(self.data[ticker]["historical_data"])),
+                "<br><br><br>",
+            ])
+        return self.fragments[ticker]
+
+    def body(self, tickers):
+        '''The HTML body of an email covering the given tickers, in order'''
+        intro = INTRO_TEMPLATE.format(names=join_names(self.stock_names[ticker] for ticker in tickers), as_of=self.as_of)
+        return "".join(["<html><body>", intro] + [self.fragment(ticker) for ticker in tickers] + ["</body></html>"])
@@ -0,0 +1,231 @@
+# Request scheduler under every page load: a token bucket and a circuit breaker per domain, priorities so the daily
+# tickers go before the backfill, and jittered exponential backoff on timeouts and bot checks
+import heapq
+import itertools
+import random
+import threading
+from urllib.parse import urlsplit
+
+from fetchers import RateLimiter, ChallengeError, SYSTEM_CLOCK
+from metrics import count
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+# Lower goes first
+PRIORITY_DAILY = 0
+PRIORITY_BACKFILL = 1
+
+# (page loads per second, burst) allowed per domain, and for any other domain. None means no limit.
+# The limits hold within one process, runs in separate processes each get the full rate
+DOMAIN_LIMITS = {
+    "fintel.io": (0.5, 2),
+    "finance.yahoo.com": (1, 3),
+}
+DEFAULT_LIMIT = (1, 2)
+
+def capped_limit(limit, requests_per_second):
+    '''limit lowered to requests_per_second page loads per second, without a burst, if that is slower'''
+    if limit is None or requests_per_second < limit[0]:
+        return (requests_per_second, 1)
+    return limit
+
+def capped_limits(requests_per_second, limits=DOMAIN_LIMITS, default_limit=DEFAULT_LIMIT):
+    '''(limits, default limit) for a RequestScheduler that loads no more than requests_per_second pages per second of a
+    domain. The limits stay a ceiling, a higher requests_per_second does not raise them'''
+    return ({domain: capped_limit(limit, requests_per_second) for domain, limit in limits.items()},
+            capped_limit(default_limit, requests_per_second))
+
+# Errors worth waiting out and trying again, anything else fails the page at once
+RETRYABLE_ERRORS = (TimeoutError, ChallengeError)
+
+class CircuitOpenError(Exception):
+    '''Page loads of a domain are paused after too many failures in a row, for retry_after more seconds'''
+
+    def __init__(self, message, retry_after=0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    '''Opens after failure_threshold retryable failures in a row and fails every request for cooldown seconds, then
+    lets a single trial request through (half-open): its success closes the breaker, its failure opens it for another
+    cooldown. RequestScheduler holds the other requests back until the trial's outcome is recorded'''
+
+    def __init__(self, failure_threshold=5, cooldown=60, clock=SYSTEM_CLOCK):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.clock.now() - self.opened_at >= self.cooldown else "open"
+
+    def retry_after(self):
+        '''Seconds until the breaker lets a trial request through, 0 if it is closed or half-open'''
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.cooldown - self.clock.now())
+
+    def allow(self):
+        '''Checks if a request may go out now'''
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        '''Counts a failure. Returns True if this opened the breaker'''
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = self.clock.now()
+                self.trial = False
+                return True
+            return False
+
+class RequestScheduler:
+    '''Decides when each page load may go out. Every domain has a RateLimiter (DOMAIN_LIMITS) and a CircuitBreaker, and
+    requests waiting on the same domain go out in priority order, first come first served within a priority.
+    Every acquire has to be followed by record_success or record_failure once the page load is over.
+    Share one scheduler between every fetcher of the process so the limits hold across sessions, sources and jobs.'''
+
+    def __init__(self, limits=DOMAIN_LIMITS, default_limit=DEFAULT_LIMIT, failure_threshold=5, cooldown=60, clock=SYSTEM_CLOCK):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.domains = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def _domain(self, url):
+        '''(limiter or None, breaker, waiting heap) of the url's domain, created on first use. Call with the condition held'''
+        domain = urlsplit(url).netloc
+        if domain not in self.domains:
+            limit = self.limits.get(domain.removeprefix("www."), self.default_limit)
+            limiter = RateLimiter(limit[0], burst=limit[1], clock=self.clock) if limit else None
+            self.domains[domain] = (limiter, CircuitBreaker(self.failure_threshold, self.cooldown, self.clock), [])
+        return self.domains[domain]
+
+    def acquire(self, url, priority=PRIORITY_DAILY):
+        '''Blocks until a page load of url may go out, also while another request is making the trial of the domain's
+        half-open breaker. Raises CircuitOpenError if the breaker is open'''
+        with self.condition:
+            limiter, breaker, waiting = self._domain(url)
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(waiting, ticket)
+
+        try:
+            while True:
+                with self.condition:
+                    if waiting[0] != ticket:
+                        self.condition.wait()
+                        continue
+                    if not breaker.allow():
+                        if breaker.trial:
+                            # Another request is making the trial, its outcome decides whether this one goes out
+                            self.condition.wait()
+                            continue
+                        raise CircuitOpenError(f"Page loads of {urlsplit(url).netloc} are paused after repeated failures",
+                                               breaker.retry_after())
+                    if limiter is None or limiter.try_acquire():
+                        return
+                    delay = limiter.delay()
+
+                # First in line but out of tokens, a request of higher priority arriving meanwhile takes over the line
+                self.clock.sleep(delay)
+        finally:
+            with self.condition:
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+                self.condition.notify_all()
+
+    def record_success(self, url):
+        with self.condition:
+            _, breaker, _ = self._domain(url)
+            breaker.record_success()
+            self.condition.notify_all()
+
+    def record_failure(self, url):
+        with self.condition:
+            _, breaker, _ = self._domain(url)
+            opened = breaker.record_failure()
+            self.condition.notify_all()
+        if opened:
+            printr(f"[!] Pausing page loads of {urlsplit(url).netloc} for {self.cooldown} s after repeated failures")
+            count("circuit_opens", domain=urlsplit(url).netloc)
+
+    def stats(self):
+        '''State of the breaker and the number of waiting requests of every domain seen'''
+        with self.condition:
+            return {domain: {"breaker": breaker.state, "waiting": len(waiting)}
+                    for domain, (_, breaker, waiting) in self.domains.items()}
+
+def backoff_delay(attempt, base=1, maximum=60, rng=random):
+    '''Seconds to wait before retry number attempt (from 0): a random time up to base * 2 ** attempt, capped at maximum
+    ("full jitter", so sessions that failed together do not come back together)'''
+    return rng.uniform(0, min(maximum, base * 2 ** attempt))
+
+class ScheduledFetcher:
+    '''Wraps a fetcher so every page load waits for its turn on the scheduler at the given priority.
+    Timeouts and bot checks (RETRYABLE_ERRORS) count against the domain's breaker and are retried up to retries times
+    after a backoff_delay. An open breaker is waited out as one of the retries. The last error is raised if every
+    attempt fails.'''
+
+    def __init__(self, fetcher, scheduler, priority=PRIORITY_DAILY, retries=3, backoff=1, rng=random):
+        self.fetcher = fetcher
+        self.scheduler = scheduler
+        self.priority = priority
+        self.retries = retries
+        self.backoff = backoff
+        self.rng = rng
+
+    def fetch(self, url, table_ids=None):
+        for attempt in range(self.retries + 1):
+            try:
+                self.scheduler.acquire(url, self.priority)
+            except CircuitOpenError as e:
+                if attempt == self.retries:
+                    raise
+                # Wait until the breaker lets a trial request through
+                self.scheduler.clock.sleep(max(e.retry_after, backoff_delay(attempt, self.backoff, rng=self.rng)))
+                continue
+
+            try:
+                page_source = self.fetcher.fetch(url, table_ids)
+            except RETRYABLE_ERRORS as e:
+                self.scheduler.record_failure(url)
+                if attempt == self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff, rng=self.rng)
+                printr(f"[!] {type(e).__name__} loading {url}: {e}, retrying in {delay:.1f} s")
+                count("retries", stage="page_load", reason=type(e).__name__)
+                self.scheduler.clock.sleep(delay)
+                continue
+            except Exception:
+                # The site answered, the page itself is the problem
+                self.scheduler.record_success(url)
+                raise
+            self.scheduler.record_success(url)
+            return page_source
+
+    def quit(self):
+        self.fetcher.quit()
@@ -0,0 +1,80 @@
+# Encrypted on-disk store for logged in browser sessions
+import json
+import os
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from local_state import STATE_DIR
+
+# Printing helpers
+from color_printer import printb,printg,printr
+
+# Environment variable holding the Fernet key. If it is not set a key file is created in STATE_DIR
+SESSION_KEY_ENV = "SHORT_INTEREST_SESSION_KEY"
+
+# How long a session is trusted when none of its cookies carry an expiry
+DEFAULT_SESSION_TTL = 12 * 60 * 60
+
+def get_session_key(key_path=None):
+    '''Returns the key used to encrypt stored sessions, from the environment or from a key file that is created on first use'''
+    key = os.environ.get(SESSION_KEY_ENV)
+    if key:
+        return key.encode()
+
+    key_path = key_path or os.path.join(STATE_DIR, "session.key")
+    if os.path.exists(key_path):
+        with open(key_path, "rb") as f:
+            return f.read().strip()
+
+    os.makedirs(os.path.dirname(key_path), exist_ok=True)
+    key = Fernet.generate_key()
+    # Only the owner may read the key
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def session_expiry(cookies, ttl=DEFAULT_SESSION_TTL):
+    '''A session is kept until its last cookie expires, or for ttl seconds if no cookie has an expiry.
+    Short lived bot check and tracking cookies do not end it, the site decides whether the session still works'''
+    expiries = [cookie["expiry"] for cookie in cookies if cookie.get("expiry")]
+    return max(expiries) if expiries else time.time() + ttl
+
+def save_session(path, cookies, key=None):
+    '''Encrypts the cookies together with their expiry and writes them to path'''
+    record = {"cookies": cookies, "expires": session_expiry(cookies), "saved": time.time()}
+    token = Fernet(key or get_session_key()).encrypt(json.dumps(record).encode())
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+    printg(f"[+] Saved session to {path}")
+
+def load_session(path, key=None):
+    '''Returns the stored cookies that have not expired, or None if there is no stored session, it has expired or it
+    cannot be decrypted'''
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            record = json.loads(Fernet(key or get_session_key()).decrypt(f.read()))
+    except (InvalidToken, ValueError) as e:
+        printr(f"[!] Could not read stored session at {path}: {e!r}")
+        return None
+
+    if record["expires"] <= time.time():
+        printb(f"Stored session at {path} has expired")
+        return None
+
+    # Cookies that expired on their own are dropped, the browser would not send them either
+    now = time.time()
+    return [cookie for cookie in record["cookies"] if not cookie.get("expiry") or cookie["expiry"] > now]
+
+def clear_session(path):
+    '''Removes a stored session, e.g. after the site rejected it'''
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,62 @@
+# Streaming HTML table extraction
+import io
+import re
+
+def find_table_html(page_source, table_id=None):
+    '''Scans the page source to the <table> with the given id (or the first table if no id is given) and
+    returns just that table's HTML. Returns None if the table is not on the page.'''
+    if table_id is None:
+        match = re.search(r'<table\b', page_source, re.IGNORECASE)
+    else:
+        match = re.search(r'<table\b[^>]*\bid\s*=\s*["\']?' + re.escape(table_id) + r'["\'\s>]', page_source, re.IGNORECASE)
+    if match is None:
+        return None
+
+    # Walk forward to the matching </table>, skipping over any nested tables
+    start = match.start()
+    depth = 0
+    for tag in re.finditer(r'<(/?)table\b', page_source[start:], re.IGNORECASE):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            end = page_source.index('>', start + tag.end()) + 1
+            return page_source[start:end]
+
+    # Unclosed table, let the parser recover what it can
+    return page_source[start:]
+
+def iter_table_rows(table_html, max_rows=None):
+    '''Yields (header_cells, data_cells) for each <tr> in the table HTML without building a DOM of the page.
+    header_cells holds the raw text of the <th> elements and data_cells the raw text of the <td> elements.
+    Stops once max_rows rows have been yielded.'''
+    from lxml import etree
+
+    rows = etree.iterparse(io.BytesIO(table_html.encode('utf-8')), events=('end',), tag='tr', html=True, encoding='utf-8')
+    for count, (_, row) in enumerate(rows):
+        if max_rows is not None and count >= max_rows:
+            return
+        header_cells = [''.join(cell.itertext()) for cell in row.iter('th')]
+        data_cells = [''.join(cell.itertext()) for cell in row.iter('td')]
+        row.clear()
+        yield header_cells, data_cells
+
+def read_table(page_source, table_id=None, max_rows=None, skip_cells=(), stop_at=None):
+    '''Extracts a table from a page source. Headers are the raw <th> texts of the first row and every later row
+    is a list of stripped <td> texts with any cell in skip_cells dropped. max_rows limits the number of data rows read.
+    stop_at is an optional function of a data row, parsing stops before the first row it returns True for.
+    Returns (headers, data_rows) or None if the table is not on the page.'''
+    table_html = find_table_html(page_source, table_id)
+    if table_html is None:
+        return None
+
+    rows = iter_table_rows(table_html, None if max_rows is None else max_rows + 1)
+    headers = next((header_cells for header_cells, _ in rows), [])
+
+    data_rows = []
+    for _, data_cells in rows:
+        cells = [cell.strip() for cell in data_cells]
+        cells = [cell for cell in cells if cell not in skip_cells]
+        if stop_at is not None and stop_at(cells):
+            break
+        data_rows.append(cells)
+
+    return headers, data_rows
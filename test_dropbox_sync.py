@@ -0,0 +1,110 @@
+# Download, transform and upload pipeline of dropbox_sync, run against the in-memory replay.FakeDropbox
+import pytest
+
+from dropbox_sync import DropboxSyncCache, SyncConflict, sync_workbooks
+from metrics import METRICS
+from replay import FakeDropbox
+
+PATH = "/Automated/ABC_Short_Interest_Data.xlsx"
+
+def append_row(ticker, new_sheets, current_binary):
+    return (current_binary or b"") + b"|row"
+
+def unchanged(ticker, new_sheets, current_binary):
+    return current_binary
+
+def calls(dbx, name):
+    return [path for call, path in dbx.calls if call == name]
+
+def sync(dbx, cache, transform):
+    return sync_workbooks(dbx, cache, {"abc": (PATH, {})}, transform, processes=0)["abc"]
+
+@pytest.fixture
+def cache(tmp_path):
+    return DropboxSyncCache(str(tmp_path / "dropbox_cache"))
+
+def test_downloads_transforms_and_uploads_over_the_downloaded_rev(cache):
+    dbx = FakeDropbox({PATH: b"v1"})
+    rev = dbx.files_get_metadata(PATH).rev
+
+    result = sync(dbx, cache, append_row)
+
+    assert result["error"] is None and result["stage"] == "done"
+    assert dbx.files[PATH.lower()][0] == b"v1|row"
+    assert result["rev"] == dbx.files_get_metadata(PATH).rev != rev
+    assert calls(dbx, "files_download") == [PATH]
+    assert calls(dbx, "files_upload") == [PATH]
+
+def test_new_file_is_added(cache):
+    dbx = FakeDropbox()
+    result = sync(dbx, cache, append_row)
+    assert result["error"] is None
+    assert dbx.files[PATH.lower()][0] == b"|row"
+    assert calls(dbx, "files_download") == []
+
+def test_unchanged_rev_is_not_downloaded_again(cache):
+    dbx = FakeDropbox({PATH: b"v1"})
+    sync(dbx, cache, append_row)
+    dbx.calls.clear()
+
+    result = sync(dbx, cache, append_row)
+
+    assert result["error"] is None
+    assert calls(dbx, "files_get_metadata") == [PATH]
+    assert calls(dbx, "files_download") == []
+    assert dbx.files[PATH.lower()][0] == b"v1|row|row"
+
+def test_file_changed_on_dropbox_is_downloaded_again(cache):
+    dbx = FakeDropbox({PATH: b"v1"})
+    sync(dbx, cache, append_row)
+    dbx._store(PATH, b"edited")
+    dbx.calls.clear()
+
+    sync(dbx, cache, append_row)
+
+    assert calls(dbx, "files_download") == [PATH]
+    assert dbx.files[PATH.lower()][0] == b"edited|row"
+
+def test_unchanged_workbook_is_not_uploaded(cache):
+    dbx = FakeDropbox({PATH: b"v1"})
+    rev = dbx.files_get_metadata(PATH).rev
+    sync(dbx, cache, unchanged)
+
+    assert calls(dbx, "files_upload") == []
+    assert dbx.files_get_metadata(PATH).rev == rev
+
+@pytest.mark.parametrize("chunk_size", [None, 4])
+def test_file_edited_during_the_sync_is_a_conflict(tmp_path, chunk_size):
+    # A chunk size smaller than the file sends the upload through an upload session, whose finish call reports the
+    # conflict without the UploadWriteFailed wrapper
+    cache = DropboxSyncCache(str(tmp_path / "dropbox_cache"), **({"chunk_size": chunk_size} if chunk_size else {}))
+    dbx = FakeDropbox({PATH: b"version 1"})
+
+    def edited_meanwhile(ticker, new_sheets, current_binary):
+        dbx._store(PATH, b"edited by hand")
+        return current_binary + b"|row"
+
+    result = sync(dbx, cache, edited_meanwhile)
+
+    assert isinstance(result["error"], SyncConflict)
+    assert result["stage"] == "upload" and result["rev"] is None
+    assert dbx.files[PATH.lower()][0] == b"edited by hand"
+    if chunk_size:
+        assert calls(dbx, "files_upload_session_finish") == [PATH]
+
+def test_large_file_is_uploaded_in_chunks(tmp_path):
+    cache = DropboxSyncCache(str(tmp_path / "dropbox_cache"), chunk_size=4)
+    dbx = FakeDropbox({PATH: b"version 1"})
+
+    result = sync(dbx, cache, append_row)
+
+    assert result["error"] is None
+    assert dbx.files[PATH.lower()][0] == b"version 1|row"
+    assert len(calls(dbx, "files_upload_session_start")) == 1
+    assert calls(dbx, "files_upload_session_finish") == [PATH]
+
+def test_stages_are_labelled_by_ticker(cache):
+    METRICS.reset()
+    sync(FakeDropbox({PATH: b"v1"}), cache, append_row)
+    labels = {event["stage"]: event["labels"] for event in METRICS.events if event.get("stage") in ("download", "upload")}
+    assert labels == {"download": {"ticker": "abc"}, "upload": {"ticker": "abc"}}
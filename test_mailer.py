@@ -0,0 +1,47 @@
+# Pooled delivery and retries of the mailer, sent to the local replay.SMTPSink
+import smtplib
+import socket
+
+import pytest
+
+from mailer import Mailer, build_message, is_retryable
+from replay import SMTPSink
+
+def message(number):
+    return build_message("Bot", "bot@example.com", ["a@example.com", "b@example.com"], f"Report {number}", "<p>hi</p>")
+
+@pytest.fixture
+def sink():
+    with SMTPSink() as sink:
+        yield sink
+
+def mailer_for(sink):
+    return Mailer(sink.host, sink.port, use_ssl=False, backoff=0, timeout=5)
+
+def test_queue_is_sent_over_one_connection(sink):
+    mailer = mailer_for(sink)
+
+    failed = mailer.send_all([message(number) for number in range(3)])
+
+    assert failed == []
+    assert mailer.sent == 3 and mailer.connections == 1 and mailer.server is None
+    assert [recipients for _, recipients, _ in sink.messages] == [["a@example.com", "b@example.com"]] * 3
+    assert [b"Subject: Report %d" % number in data for number, (_, _, data) in enumerate(sink.messages)] == [True] * 3
+
+def test_dropped_connection_is_reopened_and_the_message_retried(sink):
+    with mailer_for(sink) as mailer:
+        mailer.send(message(1))
+        dropped = mailer.server
+        dropped.sock.shutdown(socket.SHUT_RDWR)
+
+        mailer.send(message(2))
+
+        assert mailer.connections == 2 and mailer.server is not dropped
+        assert dropped.sock is None
+    assert mailer.sent == 2 and len(sink.messages) == 2
+
+def test_only_temporary_rejections_are_retried():
+    assert is_retryable(smtplib.SMTPServerDisconnected())
+    assert is_retryable(smtplib.SMTPDataError(451, b"try again later"))
+    assert not is_retryable(smtplib.SMTPDataError(554, b"rejected"))
+    assert not is_retryable(smtplib.SMTPRecipientsRefused({}))
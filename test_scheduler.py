@@ -0,0 +1,161 @@
+# Rate, priority and circuit breaker behaviour of the request scheduler, measured on a simulated clock
+import threading
+import time
+
+import pytest
+
+from replay import SimulatedClock
+from scheduler import RequestScheduler, CircuitBreaker, CircuitOpenError, capped_limits, PRIORITY_DAILY, PRIORITY_BACKFILL
+
+URL = "https://fintel.io/ss/us/abc"
+
+class RecordingLimiter:
+    '''Lets every request through and records the thread of each, in the order the scheduler let them go'''
+
+    def __init__(self):
+        self.order = []
+
+    def try_acquire(self):
+        self.order.append(threading.current_thread().name)
+        return True
+
+    def delay(self):
+        return 0.0
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+def start_thread(name, target):
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def test_token_bucket_holds_the_domain_rate():
+    clock = SimulatedClock()
+    scheduler = RequestScheduler(limits={"fintel.io": (0.5, 2)}, clock=clock)
+
+    # The burst goes out at once, every later page load waits 1 / rate seconds
+    scheduler.acquire(URL)
+    scheduler.acquire(URL)
+    assert clock.now() == 0
+    for _ in range(8):
+        scheduler.acquire(URL)
+    assert clock.now() == pytest.approx(16)
+
+def test_unlimited_domain_never_waits():
+    clock = SimulatedClock()
+    scheduler = RequestScheduler(limits={"fintel.io": None}, clock=clock)
+    for _ in range(100):
+        scheduler.acquire(URL)
+    assert clock.slept == 0
+
+def test_requested_rate_only_lowers_the_domain_limits():
+    limits = {"fintel.io": (0.5, 2), "finance.yahoo.com": (1, 3), "example.com": None}
+    assert capped_limits(0.25, limits, (1, 2)) == ({"fintel.io": (0.25, 1), "finance.yahoo.com": (0.25, 1),
+                                                    "example.com": (0.25, 1)}, (0.25, 1))
+    assert capped_limits(0.8, limits, (1, 2)) == ({"fintel.io": (0.5, 2), "finance.yahoo.com": (0.8, 1),
+                                                   "example.com": (0.8, 1)}, (0.8, 1))
+    assert capped_limits(10, limits, None)[0]["fintel.io"] == (0.5, 2)
+
+    clock = SimulatedClock()
+    scheduler = RequestScheduler(*capped_limits(10), clock=clock)
+    for _ in range(10):
+        scheduler.acquire(URL)
+    assert clock.now() == pytest.approx(16)
+
+def test_daily_requests_go_before_backfill():
+    scheduler = RequestScheduler(clock=SimulatedClock())
+    _, breaker, waiting = scheduler._domain(URL)
+    limiter = RecordingLimiter()
+    scheduler.domains["fintel.io"] = (limiter, breaker, waiting)
+
+    # Hold the line with a ticket ahead of everyone until every request is queued
+    blocker = (-1, -1)
+    with scheduler.condition:
+        waiting.append(blocker)
+
+    threads = []
+    for name, priority in [("backfill-1", PRIORITY_BACKFILL), ("backfill-2", PRIORITY_BACKFILL),
+                           ("daily-1", PRIORITY_DAILY), ("daily-2", PRIORITY_DAILY)]:
+        threads.append(start_thread(name, lambda priority=priority: scheduler.acquire(URL, priority)))
+        wait_until(lambda: len(waiting) == len(threads) + 1)
+
+    with scheduler.condition:
+        waiting.remove(blocker)
+        scheduler.condition.notify_all()
+    for thread in threads:
+        thread.join(5)
+
+    assert limiter.order == ["daily-1", "daily-2", "backfill-1", "backfill-2"]
+
+def test_breaker_opens_half_opens_and_closes():
+    clock = SimulatedClock()
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=60, clock=clock)
+
+    for _ in range(2):
+        assert not breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    assert breaker.retry_after() == 60
+
+    clock.sleep(30)
+    assert breaker.state == "open" and breaker.retry_after() == 30
+
+    # One trial after the cooldown, its failure opens the breaker for another cooldown
+    clock.sleep(30)
+    assert breaker.state == "half-open" and breaker.retry_after() == 0
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == "open" and breaker.retry_after() == 60
+
+    # A successful trial closes it
+    clock.sleep(60)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow() and breaker.allow()
+
+def open_breaker(scheduler, clock):
+    '''Fails page loads until the breaker of URL opens, then waits out its cooldown so it is half-open'''
+    for _ in range(scheduler.failure_threshold):
+        scheduler.acquire(URL)
+        scheduler.record_failure(URL)
+    with pytest.raises(CircuitOpenError) as error:
+        scheduler.acquire(URL)
+    assert error.value.retry_after == scheduler.cooldown
+    clock.sleep(scheduler.cooldown)
+
+@pytest.mark.parametrize("trial_succeeds", [True, False])
+def test_requests_wait_for_the_trial_of_a_half_open_breaker(trial_succeeds):
+    clock = SimulatedClock()
+    scheduler = RequestScheduler(limits={"fintel.io": None}, failure_threshold=2, cooldown=60, clock=clock)
+    open_breaker(scheduler, clock)
+
+    # This request makes the trial, the next one is held back until its outcome is recorded instead of failing
+    scheduler.acquire(URL)
+    outcome = []
+
+    def second_request():
+        try:
+            scheduler.acquire(URL)
+            outcome.append("sent")
+        except CircuitOpenError as e:
+            outcome.append(e.retry_after)
+
+    thread = start_thread("second", second_request)
+    wait_until(lambda: scheduler.stats()["fintel.io"]["waiting"] == 1)
+    time.sleep(0.05)
+    assert outcome == []
+
+    if trial_succeeds:
+        scheduler.record_success(URL)
+    else:
+        scheduler.record_failure(URL)
+    thread.join(5)
+
+    assert outcome == (["sent"] if trial_succeeds else [60])
+    assert scheduler.stats()["fintel.io"] == {"breaker": "closed" if trial_succeeds else "open", "waiting": 0}